@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+Benchmark the pipeline on simulated frames (see utils_sim), e.g.,
+
+    python benchmark.py --ifu LSB,STD,HR --binning 1x1,1x2 --repeat 3
+    python benchmark.py --compare benchmark_results/old.json
+
+Stages of pack -> display -> cut -> trace -> AperMap are timed for each IFU
+type and binning, plus a multi-core scaling report of whole trace jobs.
+Results are saved as json; --compare flags stages slower than --threshold.
+The legacy write_aperMap (from a PypeIt MasterSlits) takes minutes per
+frame, so it is only timed with --legacy.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import io
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import utils_io
+from utils_io import pack_4fits_simple, write_trace_file, write_aperMap, write_master_slits
+from utils_trace import load_trace, reshape_trace_by_curvature, do_trace_v3, create_apermap
+from utils_pipeline import cut_data_by_edges
+from utils_sim import write_raw_frames, get_default_curve
+from utils_profile import start_report
+from utils_display import DisplayPyramid
+
+#### the fiber models are loaded relative to the repo folder
+DIR_REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def _prep_display(data, percent=85.9):
+    """
+    Draw the data as show_image in the GUI, through its DisplayPyramid, on
+    an Agg canvas
+    """
+    fig = Figure(figsize=(6, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    pyramid = DisplayPyramid(data)
+    vmax = pyramid.percentile(percent)
+    xlim, ylim = (-0.5, pyramid.nx-0.5), (-0.5, pyramid.ny-0.5)
+    bbox = ax.get_window_extent()
+    image, extent, factor = pyramid.get_view(xlim, ylim, (bbox.width, bbox.height))
+    ax.imshow(image, origin='lower', cmap='gray', vmin=0.0, vmax=vmax,
+              extent=extent, interpolation='nearest')
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    fig.canvas.draw()
+
+
+def _trace_job(path_trace, curve_params):
+    """Trace one file headless in one process; returns the elapsed time. """
+    os.chdir(DIR_REPO)
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        trace, ifu_type, bin_y = load_trace(path_trace)
+        reshaped = reshape_trace_by_curvature(trace, curve_params)
+        do_trace_v3(reshaped, curve_params, os.path.basename(path_trace)[0],
+                    ifu_type, bin_y, plot=False, headless=True)
+    return time.perf_counter() - t0
+
+
+def run_case(ifu_type, binning, dir_work, repeat=3, seed=0, legacy=False):
+    """
+    Time all stages of one IFU type and binning on the b side
+    Returns {stage: [seconds of each repeat]} and the path of the trace file.
+    """
+    dir_raw = os.path.join(dir_work, 'raw_%s_%s'%(ifu_type, binning))
+    write_raw_frames(dir_raw, '0001', ifu_type, shoes=('b',), binning=binning, seed=seed)
+    curve_params = get_default_curve('b', binning)
+
+    times = {}
+    def _add(name, seconds):
+        times.setdefault(name, []).append(seconds)
+
+    path_trace = None
+    for i in range(repeat):
+        utils_io._cache.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            data, hdr = pack_4fits_simple('0001', dir_raw, 'b')
+            t1 = time.perf_counter()
+            _prep_display(data)
+            t2 = time.perf_counter()
+            data_cut = cut_data_by_edges(data, curve_params)
+            t3 = time.perf_counter()
+            path_trace = write_trace_file(data_cut, hdr, dir_raw, 'b0001')
+            t4 = time.perf_counter()
+            trace, ifu_trace, bin_y = load_trace(path_trace)
+            t5 = time.perf_counter()
+            reshaped = reshape_trace_by_curvature(trace, curve_params)
+            t6 = time.perf_counter()
+            report = start_report('benchmark')
+            traces_array, traces_coefs, n_aper, aper_half_width, _ = do_trace_v3(
+                reshaped, curve_params, 'b', ifu_trace, bin_y, plot=False, headless=True)
+            start_report(enabled=False)
+            t7 = time.perf_counter()
+            map_ap, y_middle = create_apermap(trace.data.shape, curve_params, traces_coefs, aper_half_width)
+            t8 = time.perf_counter()
+            fits.PrimaryHDU(map_ap).writeto(os.path.join(dir_raw, 'apb_bench.fits'), overwrite=True)
+            t9 = time.perf_counter()
+            if legacy:
+                path_slits = os.path.join(dir_raw, 'MasterSlits_bench.fits')
+                write_master_slits(path_slits, traces_coefs, aper_half_width, *map_ap.shape)
+                utils_io._cache.clear()
+                t10 = time.perf_counter()
+                write_aperMap(path_slits, ifu_type, 'b', os.path.join(dir_raw, 'apb_legacy'),
+                              'bench', 1, 2*n_aper, False, '', '', False, [])
+                t11 = time.perf_counter()
+
+        _add('pack_4fits_simple', t1-t0)
+        _add('display_prep', t2-t1)
+        _add('cut_by_edges', t3-t2)
+        _add('write_trace_file', t4-t3)
+        _add('load_trace', t5-t4)
+        _add('reshape_trace_by_curvature', t6-t5)
+        _add('do_trace_v3', t7-t6)
+        for path, seconds in report.get_totals().items():
+            if path.startswith('do_trace_v3/'):
+                _add(path, seconds)
+        _add('create_apermap', t8-t7)
+        _add('write_apermap_fits', t9-t8)
+        if legacy:
+            _add('write_aperMap', t11-t10)
+
+    return times, path_trace, curve_params
+
+
+def run_scaling(jobs, workers_list):
+    """Run the trace jobs with process pools of each size. """
+    results = []
+    for n_workers in workers_list:
+        t0 = time.perf_counter()
+        if n_workers == 1:
+            job_times = [_trace_job(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                job_times = list(executor.map(_trace_job, *zip(*jobs)))
+        seconds = time.perf_counter() - t0
+        results.append({'workers': n_workers, 'jobs': len(jobs), 'seconds': seconds,
+                        'jobs_per_second': len(jobs)/seconds,
+                        'mean_job_seconds': float(np.mean(job_times))})
+    for item in results:
+        item['speedup'] = results[0]['seconds'] / item['seconds']
+    return results
+
+
+def get_meta():
+    """Get the environment of the run. """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=DIR_REPO,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpu_count': os.cpu_count()}
+
+
+def summarize(times):
+    return {name: {'min': float(np.min(t)), 'median': float(np.median(t)),
+                   'n': len(t)} for name, t in times.items()}
+
+
+def compare(results, path_old, threshold=1.2):
+    """Print the stages slower than threshold times the old results. """
+    with open(path_old) as f:
+        old = json.load(f)
+    cases_old = {(c['ifu_type'], c['binning']): c['stages'] for c in old['cases']}
+    n_slow = 0
+    for case in results['cases']:
+        stages_old = cases_old.get((case['ifu_type'], case['binning']), {})
+        for name, stat in case['stages'].items():
+            if name not in stages_old or stages_old[name]['min'] <= 0:
+                continue
+            ratio = stat['min'] / stages_old[name]['min']
+            if ratio > threshold:
+                n_slow += 1
+                print('!!! slower: %s %s %s: %.3f s -> %.3f s (x%.2f)'%(
+                    case['ifu_type'], case['binning'], name,
+                    stages_old[name]['min'], stat['min'], ratio))
+    print('++++ %d stage(s) slower than x%.2f vs. %s'%(n_slow, threshold, path_old))
+    return n_slow
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AperMap pipeline')
+    parser.add_argument('--ifu', default='LSB,STD,HR')
+    parser.add_argument('--binning', default='1x1,1x2,2x2')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', default=None,
+                        help='pool sizes for the scaling report, e.g., 1,2,4')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='output json')
+    parser.add_argument('--compare', default=None, help='json of a previous run')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    parser.add_argument('--legacy', action='store_true', help='also time write_aperMap')
+    args = parser.parse_args()
+
+    os.chdir(DIR_REPO)
+    if args.workers is None:
+        n_cpu = os.cpu_count() or 1
+        workers_list = sorted(set([1, 2, 4, n_cpu]) & set(range(1, n_cpu+1)))
+    else:
+        workers_list = [int(n) for n in args.workers.split(',')]
+
+    dir_work = tempfile.mkdtemp(prefix='ifum_bench_')
+    results = {'meta': get_meta(), 'cases': [], 'scaling': []}
+    jobs = []
+    try:
+        for ifu_type in args.ifu.split(','):
+            for binning in args.binning.split(','):
+                times, path_trace, curve_params = run_case(
+                    ifu_type, binning, dir_work, args.repeat, args.seed, args.legacy)
+                results['cases'].append({'ifu_type': ifu_type, 'binning': binning,
+                                         'stages': summarize(times)})
+                jobs.append((path_trace, curve_params))
+                print('++++ %s %s'%(ifu_type, binning))
+                for name, stat in results['cases'][-1]['stages'].items():
+                    print('    %-45s %8.3f s'%(name, stat['min']))
+
+        results['scaling'] = run_scaling(jobs*max(workers_list), workers_list)
+        print('++++ scaling of %d trace jobs'%(len(jobs)*max(workers_list)))
+        for item in results['scaling']:
+            print('    %2d worker(s): %8.2f s, speedup %.2f'%(
+                item['workers'], item['seconds'], item['speedup']))
+    finally:
+        shutil.rmtree(dir_work, ignore_errors=True)
+
+    path_out = args.out
+    if path_out is None:
+        path_out = os.path.join('benchmark_results', 'bench_%s_%s.json'%(
+            datetime.now().strftime('%y%m%d_%H%M%S'), results['meta']['commit']))
+    if os.path.dirname(path_out) and not os.path.exists(os.path.dirname(path_out)):
+        os.makedirs(os.path.dirname(path_out))
+    with open(path_out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('++++ results saved to %s'%path_out)
+
+    if args.compare is not None:
+        n_slow = compare(results, args.compare, args.threshold)
+        sys.exit(1 if n_slow > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,9 @@ import astropy.units as u
 from ccdproc import Combiner
 from specutils.spectra import Spectrum1D
 
+from utils_profile import timed
+from utils_task import progress
+
 #### code refactored from Matt's m2fs_process.py
 class columnspec:
     def __init__(self,columns=None,spec=None,mask=None,err=None,
@@ -54,6 +57,7 @@ def column_stack(data,col):
     return spec1d
 
 
+@timed()
 def get_columnspec(data, trace_step, n_lines, verbose=False):
     '''
     get a list of column spectra from a 2D data array
@@ -66,6 +70,7 @@ def get_columnspec(data, trace_step, n_lines, verbose=False):
 
     columnspec_array=[]
     for i in range(0,len(trace_cols)-1):
+        progress('columns', i, len(trace_cols)-1)
         if verbose:
             print('working on '+str(i+1)+' of '+str(len(trace_cols))+' trace columns')
         col0=np.arange(n_lines)+trace_cols[i]
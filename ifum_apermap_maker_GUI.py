@@ -15,18 +15,37 @@ from astropy.io import fits
 import numpy.polynomial.polynomial as poly
 from scipy.optimize import curve_fit
 
-from utils_io import IFUM_UNIT, pack_4fits_simple, func_parabola, readFloat_space, write_pypeit_file, write_trace_file, cut_apermap, cached_fits_open
-from utils_trace import load_trace, reshape_trace_by_curvature, do_trace_v3, create_apermap
-
+from utils_io import IFUM_UNIT, func_parabola, readFloat_space, write_pypeit_file, cut_apermap, cached_fits_open, load_trace_coefs, find_prior_trace_coefs, relocate_pypeit_masters
+from utils_pipeline import read_curve_file, cut_data_by_edges, Pipeline, trace_file_worker
+from utils_profile import start_report
+from utils_task import TaskRunner, progress
+from utils_external import get_tool_command, run_tool
+from utils_display import DisplayPyramid, BlitManager
+from utils_curve import solve_curvature, detect_edges_both, get_geometry
+from utils_trace import fill_bundle_gaps
+
+import time
+import queue
 import subprocess
+import traceback
+import multiprocessing as mp
 #from multiprocessing import Process
 
+# seconds before pypeit_trace_edges is killed
+PYPEIT_TIMEOUT = 3600
+
 # default window size of the GUI
 window_width = 1800
 window_height = 930
 img_figsize = (6, 8.8)
 
 
+def _contains(extent_outer, extent_inner):
+    """Check if an imshow extent covers another one."""
+    return extent_outer[0]<=extent_inner[0] and extent_outer[1]>=extent_inner[1] \
+        and extent_outer[2]<=extent_inner[2] and extent_outer[3]>=extent_inner[3]
+
+
 def main():
     #### Create the entire GUI program
     program = IFUM_AperMap_Maker()
@@ -58,9 +77,33 @@ else:
 class IFUM_AperMap_Maker:
 
     def __init__(self):
+        #### opt-in memory instrumentation in the run reports (slow)
+        self.profile_memory = os.environ.get('IFUM_PROFILE_MEMORY', '0')=='1'
+
+        #### artifacts of the current frame are handed over in memory
+        self.pipeline = Pipeline()
+        self.path_apermap = None
+
         self.window = tk.Tk()
         self.window.title("IFUM AperMap Maker")
         self.window.geometry(f"{window_width}x{window_height}")
+        self.window.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        #### long actions run as background tasks, one at a time
+        self.tasks = TaskRunner(self.window, on_state=self.refresh_task_state,
+                                on_progress=self.show_task_progress)
+        self.widget_states = {}
+        self.log_lines = queue.Queue()
+
+        #### display pyramids and images of the b and r panes
+        self.pyramids = {}
+        self.images = {}
+        self.image_factors = {}
+
+        #### persistent overlays (points, curve and edges) blitted over the images
+        self.overlays = {'b': {}, 'r': {}}
+        self.blits = {}
+        self.redraw_jobs = {}
 
         # Configure the main window grid
         self.window.rowconfigure(0, weight=1)
@@ -152,7 +195,7 @@ class IFUM_AperMap_Maker:
         self.menu_file.add_command(label="Load Curve", command=self.load_curve_file)
         self.menu_file.add_command(label="Save Curve", command=self.save_curve_file)
         #self.menu_file.add_command(label="Save as", command=self.save_file_as)
-        self.menu_file.add_command(label="Exit", command=self.window.quit)
+        self.menu_file.add_command(label="Exit", command=self.on_close)
         self.menubar.add_cascade(label="File", menu=self.menu_file)
 
         #### frames
@@ -217,6 +260,7 @@ class IFUM_AperMap_Maker:
         self.pca = tk.StringVar()
         self.state_edge_lock_r = tk.IntVar()
         self.state_edge_lock_b = tk.IntVar()
+        self.state_warm_start = tk.IntVar()
 
         self.txt_param_curve_A_b = tk.StringVar(value=['%.3e'%self.param_curve_b[0]])
         self.txt_param_curve_B_b = tk.StringVar(value=['%.1f'%self.param_curve_b[1]])
@@ -247,6 +291,7 @@ class IFUM_AperMap_Maker:
         self.create_widgets_pypeit(line_start=14, line_num=4) # step 4
         self.create_widgets_mono(line_start=18, line_num=4)   # step 6 (optional)
         self.create_widgets_add_slits(line_start=22, line_num=4)   # step 5 (obsolete)
+        self.create_widgets_tasks(line_start=26, line_num=3)
         self.bind_widgets()
 
         #### initialize widgets
@@ -275,23 +320,19 @@ class IFUM_AperMap_Maker:
         pathname = filedialog.askopenfilename(initialdir=self.folder_curve, title="Select file", filetypes=(("txt files", "*.txt"), ("all files", "*.*")))
         dirname, filename = os.path.split(pathname)
         if os.path.isfile(pathname) and filename.startswith("curve") and filename.endswith(".txt"):
-            file = np.loadtxt(pathname, dtype='str')
-            mask_bside = file[:, 0] == 'b'
+            curve_params = read_curve_file(pathname)
 
             #### update param_curve
-            popt = file[mask_bside, 1:4].astype(np.float64).flatten()
-            self.param_curve_b = np.array(popt)
-
-            popt = file[~mask_bside, 1:4].astype(np.float64).flatten()
-            self.param_curve_r = np.array(popt)
+            self.param_curve_b = curve_params['b'][0:3]
+            self.param_curve_r = curve_params['r'][0:3]
 
             self.renew_param_curve()
 
             #### update param_edges
-            temp = file[mask_bside, 4:6].astype(np.float64).flatten()
+            temp = curve_params['b'][3:5]
             self.param_edges_b = np.array([temp[0], temp[0]+temp[1], temp[1]])
 
-            temp = file[~mask_bside, 4:6].astype(np.float64).flatten()
+            temp = curve_params['r'][3:5]
             self.param_edges_r = np.array([temp[0], temp[0]+temp[1], temp[1]])
 
             self.param_edges_offset = self.param_edges_r[0]-self.param_edges_b[0]
@@ -391,7 +432,13 @@ class IFUM_AperMap_Maker:
 
         #### pick points
         lbl_note_curve = tk.Label(self.frame1, text="Hint: Select 7 points to fit func: x-C = A*(y-B)^2 ", fg=LABEL_COLOR, bg=BG_COLOR)
-        lbl_note_curve.grid(row=rows[1], column=1, columnspan=5, sticky="w")
+        lbl_note_curve.grid(row=rows[1], column=1, columnspan=4, sticky="w")
+
+        self.btn_auto_curve = tk.Button(
+            self.frame1, width=6, text="Auto", 
+            command=self.auto_curve, 
+            state='disabled', highlightbackground=BG_COLOR)
+        self.btn_auto_curve.grid(row=rows[1], column=5, sticky="e", padx=5, pady=5)
 
         self.btn_select_curve_r = tk.Button(
             self.frame1, width=6, text="Select (r)", 
@@ -470,7 +517,13 @@ class IFUM_AperMap_Maker:
 
         #### pick edges
         lbl_note_edges = tk.Label(self.frame1, text="Hint: Select 2 points along y-axis middle line", fg=LABEL_COLOR, bg=BG_COLOR)
-        lbl_note_edges.grid(row=rows[1], column=1, columnspan=5, sticky="w")
+        lbl_note_edges.grid(row=rows[1], column=1, columnspan=4, sticky="w")
+
+        self.btn_auto_edges = tk.Button(
+            self.frame1, width=6, text="Auto", 
+            command=self.auto_edges, 
+            state='disabled', highlightbackground=BG_COLOR)
+        self.btn_auto_edges.grid(row=rows[1], column=5, sticky="e", padx=5, pady=5)
 
         self.btn_select_edges_r = tk.Button(
             self.frame1, width=6, text="Select (r)", 
@@ -631,6 +684,14 @@ class IFUM_AperMap_Maker:
         #self.btn_make_pypeit = tk.Button(self.frame1, width=6, text='Make', command=self.make_file_pypeit, state='disabled', highlightbackground=BG_COLOR)
         #self.btn_make_pypeit.grid(row=rows[1], column=7, sticky='e', padx=5, pady=5)
 
+        #### warm start from the trace coefs of a previous night
+        lbl_warm_start = tk.Label(self.frame1, text="Start from previous trace coefs:", fg=LABEL_COLOR, bg=BG_COLOR)
+        lbl_warm_start.grid(row=rows[1], column=1, columnspan=3, sticky="w")
+        self.cbtn_warm_start = tk.Checkbutton(self.frame1, text='warm start', 
+                variable=self.state_warm_start, onvalue=1, offvalue=0, 
+                fg=LABEL_COLOR, bg=BG_COLOR)
+        self.cbtn_warm_start.grid(row=rows[1], column=4, columnspan=2, sticky="w")
+
         #### step 4b run PypeIt
         #lbl_step4b = tk.Label(self.frame1, text="4b. Run PypeIt to trace slits", fg=LABEL_COLOR, bg=BG_COLOR)
         lbl_step4b = tk.Label(self.frame1, text="Choose a side to make:", fg=LABEL_COLOR, bg=BG_COLOR)
@@ -645,7 +706,11 @@ class IFUM_AperMap_Maker:
         self.shoe2.grid(row=rows[2], column=4, sticky='e')
 
         self.shoe1 = tk.Radiobutton(self.frame1, text='b-side', variable=self.shoe, value='b', fg="cyan", bg=BG_COLOR)
-        self.shoe1.grid(row=rows[2], column=5, columnspan=2, sticky='w')
+        self.shoe1.grid(row=rows[2], column=5, sticky='w')
+
+        #### trace both sides at once in two processes (headless)
+        self.shoe3 = tk.Radiobutton(self.frame1, text='both', variable=self.shoe, value='both', fg=LABEL_COLOR, bg=BG_COLOR)
+        self.shoe3.grid(row=rows[2], column=6, sticky='w')
 
         self.btn_run_pypeit = tk.Button(self.frame1, width=6, text='Make', command=self.run_trace, state='disabled', highlightbackground=BG_COLOR)
         self.btn_run_pypeit.grid(row=rows[2], column=7, sticky='e', padx=5, pady=5)
@@ -746,6 +811,89 @@ class IFUM_AperMap_Maker:
         self.btn_make_apermap_mono = tk.Button(self.frame1, width=6, text="Make", command=self.make_file_apermap_mono, state='disabled', highlightbackground=BG_COLOR)
         self.btn_make_apermap_mono.grid(row=rows[3], column=7, sticky="e", padx=5, pady=5)
 
+    def create_widgets_tasks(self, line_start, line_num):
+        """ progress and cancel of the running task """
+        start, lines = line_start, line_num
+        rows = np.arange(start, start+lines)
+
+        lbl_line = tk.Label(self.frame1, text="-"*80, fg='gray', bg=BG_COLOR)
+        lbl_line.grid(row=rows[0], column=0, columnspan=8, sticky="w")
+
+        self.lbl_task = tk.Label(self.frame1, text="Idle", fg=LABEL_COLOR, bg=BG_COLOR, anchor='w')
+        self.lbl_task.grid(row=rows[1], column=0, columnspan=3, sticky="ew")
+
+        self.bar_task = ttk.Progressbar(self.frame1, orient='horizontal', mode='determinate')
+        self.bar_task.grid(row=rows[1], column=3, columnspan=4, sticky="ew")
+
+        self.btn_cancel_task = tk.Button(self.frame1, width=6, text="Cancel", command=self.tasks.cancel, state='disabled', highlightbackground=BG_COLOR)
+        self.btn_cancel_task.grid(row=rows[1], column=7, sticky="e", padx=5, pady=5)
+
+        #### output of external tools
+        self.txt_log = tk.Text(self.frame1, height=6, width=60, state='disabled', 
+                               fg=LABEL_COLOR, font=('Courier', 10))
+        self.txt_log.grid(row=rows[2], column=0, columnspan=8, sticky="ew", padx=5)
+
+    def refresh_task_state(self, tasks):
+        """Lock the control panel while a task runs, and restore it after."""
+        widgets = [w for w in self.frame1.winfo_children() 
+                   if w not in [self.btn_cancel_task, self.txt_log] and 'state' in w.keys()]
+        if len(tasks)>0:
+            if len(self.widget_states)==0:
+                for w in widgets:
+                    self.widget_states[w] = w['state']
+                    w['state'] = 'disabled'
+            self.menubar.entryconfig("File", state='disabled')
+            self.btn_cancel_task['state'] = 'normal'
+        else:
+            for w, state in self.widget_states.items():
+                w['state'] = state
+            self.widget_states = {}
+            self.menubar.entryconfig("File", state='normal')
+            self.btn_cancel_task['state'] = 'disabled'
+            self.lbl_task['text'] = 'Idle'
+            self.bar_task['value'] = 0
+
+    def show_task_progress(self, tasks):
+        self.show_log_lines()
+        if len(tasks)==0:
+            return
+        task = tasks[0]
+        text, done, total = task.progress
+        if task.cancelled:
+            self.lbl_task['text'] = '%s: cancelling...'%task.name
+        elif total>0:
+            self.lbl_task['text'] = '%s: %s %d/%d'%(task.name, text, done, total)
+        else:
+            self.lbl_task['text'] = '%s: %s'%(task.name, text) if text else task.name
+        if total>0:
+            self.bar_task.config(mode='determinate', maximum=total, value=done)
+        else:
+            self.bar_task.config(mode='determinate', maximum=1, value=0)
+
+    def show_log_lines(self, max_lines=1000):
+        """Append the lines queued by the tasks to the log pane."""
+        lines = []
+        while not self.log_lines.empty():
+            lines.append(self.log_lines.get_nowait())
+        if len(lines)==0:
+            return
+        self.txt_log['state'] = 'normal'
+        self.txt_log.insert(tk.END, '\n'.join(lines)+'\n')
+        n_lines = int(self.txt_log.index('end-1c').split('.')[0])
+        if n_lines>max_lines:
+            self.txt_log.delete('1.0', '%d.0'%(n_lines-max_lines))
+        self.txt_log.see(tk.END)
+        self.txt_log['state'] = 'disabled'
+
+    def show_task_error(self, error):
+        """Print the traceback of a failed task and show its error."""
+        traceback.print_exception(type(error), error, error.__traceback__)
+        self.popup_showinfo('Error', '%s: %s'%(type(error).__name__, error))
+
+    def on_close(self):
+        self.tasks.shutdown()
+        self.window.quit()
+
     def bind_widgets(self):
         """ event bindings """
         self.ent_folder.bind('<Return>', self.refresh_folder)
@@ -795,8 +943,10 @@ class IFUM_AperMap_Maker:
     def update_curve(self, event, shoe, *args):
         """ update the curve parameters """
         self.refresh_param_curve(shoe)
-        self.clear_image(shoe=shoe)
-        self.plot_curve(shoe=shoe)
+        def redraw():
+            self.clear_image(shoe=shoe)
+            self.plot_curve(shoe=shoe)
+        self.schedule_redraw('curve_'+shoe, redraw)
         self.window.focus_force()
 
     def update_edges(self, event, shoe, *args):
@@ -804,11 +954,13 @@ class IFUM_AperMap_Maker:
         self.refresh_param_edges(shoe)
 
         if self.state_edge_lock_r.get() == 0 and self.state_edge_lock_b.get() == 0:
-            self.clear_image(shoe=shoe)
-            self.plot_edges(shoe=shoe)
+            shoe_redraw = shoe
         else:
-            self.clear_image(shoe='both')
-            self.plot_edges(shoe='both')
+            shoe_redraw = 'both'
+        def redraw():
+            self.clear_image(shoe=shoe_redraw)
+            self.plot_edges(shoe=shoe_redraw)
+        self.schedule_redraw('edges_'+shoe_redraw, redraw)
 
         self.window.focus_force()
 
@@ -913,105 +1065,156 @@ class IFUM_AperMap_Maker:
 
     def run_trace(self):
         shoe = self.shoe.get()
+        if shoe=='both':
+            self.run_trace_both()
+            return
         dirname = self.ent_folder_trace.get()
         filename = shoe+self.lbl_file_pypeit['text']
         coef_temp = self.get_curve_params(shoe)
+        warm_start = self.state_warm_start.get()
+        hdr_info = {'config': self.HDR_CONFIG, 'binning': self.HDR_BINNING,
+                    'slide': self.HDR_SLIDE, 'slitname': self.HDR_SLITNAME}
+        report = start_report(filename, memory=self.profile_memory, keep_stages=True)
+
+        def work():
+            try:
+                # trace the cut data (read from the trace file if not in memory)
+                path_traceFile = os.path.join(dirname, filename+'.fits')
+                self.pipeline.load_trace_file(path_traceFile)
+                path_prior = None
+                if warm_start:
+                    ifu_type_trace = self.pipeline.headers[shoe]['IFU']
+                    path_prior = self.find_prior_coefs(dirname, shoe, ifu_type_trace, filename)
+                solution = self.pipeline.trace(shoe, coef_temp, path_prior=path_prior)
+                N_sl, path_prior = solution['N_sl'], solution['warm_start']
+
+                #### make and save AperMap, slits and trace coefs
+                ifu_type = self.get_ifu_type(N_sl)
+                self.pipeline.dir_trace = dirname
+                map_ap = self.pipeline.make_apermap(shoe, ifu_type, hdr_info)['map_ap']
+                path_aperMap = self.pipeline.paths[shoe]['aperMap']
+
+                #### save the run report next to the AperMap
+                report.info.update({'shoe': shoe, 'ifu_type': ifu_type.label, 
+                                    'N_sl': int(N_sl), 'warm_start': path_prior,
+                                    'aperMap': path_aperMap})
+                path_report = report.write_json(path_aperMap.replace('.fits', '_report.json'))
+                print('++++ Run report saved to %s\n%s'%(path_report, report.summary()))
+                return ifu_type, N_sl, map_ap, path_aperMap
+            finally:
+                #### never leave the report (and tracemalloc) running, e.g., after an error
+                start_report(enabled=False)
+
+        def done(result):
+            ifu_type, N_sl, map_ap, path_aperMap = result
+            self.ifu_type = ifu_type
+
+            #### show info
+            info_temp = '%s-side AperMap file made!\n\n Saved to %s\n\n%s'%(shoe, path_aperMap, report.summary())
+            self.popup_showinfo('AperMap', info_temp)
+
+            #### show apermap
+            fname = filename.split('_')[0]+'_apermap'
+            title = '%s (N_sl=%d)'%(fname,N_sl)
+            self.clear_image(shoe=shoe)
+            self.update_image_single(map_ap, title, shoe=shoe, uniform=True)
+            print('++++\n++++ %s-side AperMap file made! \n++++ Saved to %s\n++++\n'%(shoe, path_aperMap))
 
-        # load the trace file and reshape according to the curvature
-        path_traceFile = os.path.join(dirname, filename+'.fits')
-        data_trace, ifu_type_trace, bin_y_trace = load_trace(path_traceFile)
-        data_reshaped = reshape_trace_by_curvature(data_trace, coef_temp)
-
-        # trace the resahped data and create an apermap
-        trace_array, trace_coefs, N_sl, aper_half_width = do_trace_v3(
-            data_reshaped, coef_temp,                          
-            shoe, ifu_type_trace, bin_y_trace, verbose=True)
-        map_ap, y_middle = create_apermap(data_trace, coef_temp, trace_coefs, aper_half_width)
-        #print(len(y_middle), y_middle)
-        #print(np.diff(y_middle))
-
-        #### check the number of slits
-        self.ifu_type = self.get_ifu_type(N_sl)
-        N_ap = np.int32(self.ifu_type.Ntotal/2)
-        if N_ap>N_sl:
-            print('!!! Warning: Missing %d fiber(s). Expected to find %d fibers !!!'%(N_ap-N_sl, N_ap))
-        elif N_ap<N_sl:
-            print('!!! Warning: Found %d more fiber(s). Expected to find %d fibers. !!!'%(N_sl-N_ap, N_ap))
-        else:
-            print('Found all %d fibers.'%N_ap)
-
-        # find the maximum number of pixels in all slits
-        num_ap = np.zeros(N_ap, dtype=np.int32)
-        for i_ap in range(N_ap):
-            num_ap[i_ap] = np.sum(map_ap==i_ap+1)
-        num_max = np.max(num_ap)
-
-        #### save AperMap
-        #### the following header params may require modifying
-        hdu_map = fits.PrimaryHDU(map_ap)
-        hdr_map = hdu_map.header
-        hdr_map['IFUTYPE'] = (self.ifu_type.label, 'type of IFU')
-        #hdr_map.set('IFUTYPE', IFU_type, 'type of IFU')
-        hdr_map['NIFU1'] = (self.ifu_type.Nx, 'number of IFU columns')
-        hdr_map['NIFU2'] = (self.ifu_type.Ny, 'number of IFU rows')
-        hdr_map['NSLITS'] = (N_sl, 'number of slits')
-        hdr_map['NMAX'] = (num_max, 'maximum number of pixels among all apertures')
-        hdr_map['BINNING'] = ('1x1', 'binning')
-        #hdu_map = fits.PrimaryHDU(map_ap, header=hdr_map)
-
-        ## record curve params in header
-        hdr_map['CURVE_A'] = (coef_temp[0], 'curve parameter A')
-        hdr_map['CURVE_B'] = (coef_temp[1], 'curve parameter B')
-        hdr_map['CURVE_C'] = (coef_temp[2], 'curve parameter C')
-        hdr_map['CURVE_X1'] = (coef_temp[3], 'starting X position of edges')
-        hdr_map['CURVE_DX'] = (coef_temp[4], 'length of edges along X axis')
-
-        dir_aperMap = os.path.join(self.ent_folder_trace.get(),'aperMap')
-        if not os.path.exists(dir_aperMap):
-            os.mkdir(dir_aperMap)
-
-        today_temp = datetime.today().strftime("%y%m%d")
-        file_aperMap = 'ap%s_%s_%s_%s_%s_%s_%s_%s.fits'%(
-            shoe, 
-            self.ifu_type.label, 
-            self.HDR_CONFIG, 
-            self.lbl_file_pypeit['text'][0:4],
-            self.HDR_BINNING,
-            self.HDR_SLIDE,
-            self.HDR_SLITNAME, 
-            today_temp)
-
-        path_aperMap = os.path.join(dir_aperMap, file_aperMap)
-        hdu_map.writeto(path_aperMap,overwrite=True)
-
-        #### save slits file
-        dir_slits = os.path.join(dir_aperMap, 'slits')
-        if not os.path.exists(dir_slits):
-            os.mkdir(dir_slits)
-        file_slits = filename.split('_')[0]+'_slits.txt'
-        path_slits = os.path.join(dir_slits, file_slits)
-        np.savetxt(path_slits, y_middle, fmt='%d', delimiter=' ', header='# y_pos (x=middle)', comments='')
-
-        #### save the trace coefs
-        dir_coefs = os.path.join(dir_aperMap, 'trace_coefs')
-        if not os.path.exists(dir_coefs):
-            os.mkdir(dir_coefs)
-        file_coefs = filename.split('_')[0]+'_coefs.txt'
-        path_coefs = os.path.join(dir_coefs, file_coefs)
-        np.savetxt(path_coefs, trace_coefs, fmt='%.6e', delimiter=',', header='# a b c', comments='# aper_half_width = %d\n'%aper_half_width)
-
-        #### show info
-        info_temp = '%s-side AperMap file made!\n\n Saved to %s'%(shoe, path_aperMap)
-        self.popup_showinfo('AperMap', info_temp)
+            self.window.focus_force()
 
-        #### show apermap
-        fname = filename.split('_')[0]+'_apermap'
-        title = '%s (N_sl=%d)'%(fname,N_sl)
-        self.clear_image(shoe=shoe)
-        self.update_image_single(map_ap, title, shoe=shoe, uniform=True)
-        print('++++\n++++ %s-side AperMap file made! \n++++ Saved to %s\n++++\n'%(shoe, path_aperMap))
+        self.tasks.submit('Make %s-side AperMap'%shoe, work, on_done=done,
+                          on_error=self.show_task_error)
 
-        self.window.focus_force()
+    def run_trace_both(self):
+        """
+        Trace the b and r sides in two worker processes at once, and show
+        both AperMaps when both are done. The manual column exclusion needs
+        the main thread, so both sides are traced headless.
+        """
+        dirname = self.ent_folder_trace.get()
+        label = self.lbl_file_pypeit['text']
+        curve_params = {shoe: self.get_curve_params(shoe) for shoe in ['b', 'r']}
+        warm_start = self.state_warm_start.get()
+        hdr_info = {'config': self.HDR_CONFIG, 'binning': self.HDR_BINNING,
+                    'slide': self.HDR_SLIDE, 'slitname': self.HDR_SLITNAME}
+
+        def work():
+            jobs = {}
+            for shoe in ['b', 'r']:
+                filename = shoe+label
+                path_trace = os.path.join(dirname, filename+'.fits')
+                path_prior = None
+                if warm_start:
+                    ifu_type_trace = fits.getheader(path_trace)['IFU']
+                    path_prior = self.find_prior_coefs(dirname, shoe, ifu_type_trace, filename)
+                jobs[shoe] = (path_trace, curve_params[shoe], dirname, hdr_info, path_prior)
+
+            #### spawn, as forking a process with Tk and running threads is unsafe
+            t0 = time.perf_counter()
+            ctx = mp.get_context('spawn')
+            results_queue = ctx.Queue()
+            processes = {shoe: ctx.Process(target=trace_file_worker, args=(results_queue, shoe)+jobs[shoe],
+                                           daemon=True)
+                         for shoe in jobs}
+            results = {}
+            try:
+                for process in processes.values():
+                    process.start()
+                while len(results)<len(jobs):
+                    progress('tracing b and r', len(results), len(jobs))
+                    try:
+                        shoe, result, error = results_queue.get(timeout=0.2)
+                    except queue.Empty:
+                        #### a worker that died without a result, e.g., killed
+                        for shoe, process in processes.items():
+                            if shoe not in results and not process.is_alive() and results_queue.empty():
+                                raise RuntimeError('%s-side worker exited (code %s)'%(shoe, process.exitcode))
+                        continue
+                    if error is not None:
+                        raise RuntimeError('%s-side trace failed:\n%s'%(shoe, error))
+                    results[shoe] = result
+            except BaseException:
+                #### stop the other side on cancel or error
+                for process in processes.values():
+                    if process.is_alive():
+                        process.terminate()
+                raise
+            finally:
+                for process in processes.values():
+                    if process.pid is not None:
+                        process.join(timeout=5)
+                results_queue.close()
+            return results, time.perf_counter()-t0
+
+        def done(output):
+            results, seconds = output
+
+            #### hand the solutions over to the AperMap tools of this session
+            fnum = results['b']['fnum']
+            if self.pipeline.fnum!=fnum:
+                self.pipeline.reset(fnum)
+            self.clear_image(shoe='both')
+            info_temp = 'AperMap files made in %.1f s!\n'%seconds
+            for shoe in ['b', 'r']:
+                result = results[shoe]
+                self.pipeline.solution[shoe] = result['solution']
+                self.pipeline.apermap[shoe] = result['apermap']
+                self.pipeline.paths[shoe] = result['paths']
+                N_sl = result['solution']['N_sl']
+
+                title = '%s%s_apermap (N_sl=%d)'%(shoe, fnum, N_sl)
+                self.update_image_single(result['apermap']['map_ap'], title, shoe=shoe, uniform=True)
+                info_temp += '\n%s-side (%.1f s): saved to %s\n%s\n'%(
+                    shoe, result['seconds'], result['paths']['aperMap'], result['summary'])
+                print('++++\n++++ %s-side AperMap file made in %.1f s! \n++++ Saved to %s\n++++\n'%(
+                    shoe, result['seconds'], result['paths']['aperMap']))
+            self.ifu_type = results['r']['apermap']['ifu_type']
+
+            self.popup_showinfo('AperMap', info_temp)
+            self.window.focus_force()
+
+        self.tasks.submit('Make b- and r-side AperMaps', work, on_done=done,
+                          on_error=self.show_task_error)
 
     def make_file_pypeit(self):
         dirname = self.ent_folder_trace.get()
@@ -1046,22 +1249,25 @@ class IFUM_AperMap_Maker:
         #### run PypeIt
         dir_pypeitFile = os.path.join(dirname, 'pypeit_file')
         path_pypeitFile = os.path.join(dir_pypeitFile, filename+'.pypeit')
-        os.system('pypeit_trace_edges -f %s -s magellan_m2fs_blue'%path_pypeitFile)
+        path_MasterSlits = os.path.join(dir_pypeitFile, 'Masters/MasterSlits_%s.fits.gz'%filename)
+
+        command = get_tool_command('pypeit_trace_edges', 'IFUM_TRACE_EDGES')
+        command += ['-f', os.path.abspath(path_pypeitFile), '-s', 'magellan_m2fs_blue']
 
-        #### handle the PypeIt outputs
-        path_MasterEdges_default = os.path.join(dir_pypeitFile, 'Masters/MasterEdges_A_1_DET01.fits.gz')
-        path_MasterSlits_default = os.path.join(dir_pypeitFile, 'Masters/MasterSlits_A_1_DET01.fits.gz')
-        path_MasterEdges = os.path.join(dir_pypeitFile, 'Masters/MasterEdges_%s.fits.gz'%filename)
-        self.path_MasterSlits = os.path.join(dir_pypeitFile, 'Masters/MasterSlits_%s.fits.gz'%filename)
+        def work():
+            #### the outputs are written to the folder of the PypeIt file
+            run_tool(command, cwd=dir_pypeitFile, timeout=PYPEIT_TIMEOUT, on_line=self.log_lines.put)
 
-        os.system('mv '+path_MasterEdges_default+' '+path_MasterEdges)
-        os.system('mv '+path_MasterSlits_default+' '+self.path_MasterSlits)
-        os.system('rm %s'%os.path.join(dir_pypeitFile,filename+'.calib'))
+            #### handle the PypeIt outputs
+            relocate_pypeit_masters(dir_pypeitFile, filename)
 
+        self.path_MasterSlits = path_MasterSlits
+        self.tasks.submit('PypeIt %s'%filename, work, on_done=lambda _: self.show_pypeit_slits(),
+                          on_error=self.show_task_error)
 
-        N_slits = self.check_file_MasterSlits(message=False)       
+    def show_pypeit_slits(self):
+        N_slits = self.check_file_MasterSlits(message=True)
         #self.lbl_slitnum['text'] = 'N_slits = %d'%N_slits
-        self.make_file_apermap()
 
         self.window.focus_force()
 
@@ -1083,6 +1289,36 @@ class IFUM_AperMap_Maker:
 
         return N_slits
 
+    def find_prior_coefs(self, dirname, shoe, ifu_type, filename):
+        """Find trace coefs of the same setup in dirname and its sibling folders."""
+        dirname = os.path.abspath(dirname)
+        dirname_parent = os.path.dirname(dirname)
+        dirnames = [dirname] + sorted(
+            [os.path.join(dirname_parent, d) for d in os.listdir(dirname_parent) 
+             if os.path.isdir(os.path.join(dirname_parent, d))], reverse=True)
+        path_coefs = os.path.join(dirname, 'aperMap', 'trace_coefs', 
+                                  filename.split('_')[0]+'_coefs.txt')
+        path_prior = find_prior_trace_coefs(dirnames, shoe, ifu_type, 
+                                            self.HDR_CONFIG, self.HDR_BINNING,
+                                            exclude=path_coefs)
+        if path_prior is None:
+            print('!!! Warning: No previous trace coefs found. Trace from scratch. !!!')
+        return path_prior
+
+    def get_trace_coefs(self, shoe):
+        """Get the trace coefs of the AperMap file, from memory if traced in this session."""
+        #### the label holds no frame number, so match the AperMap file written by the pipeline
+        path_pipeline = self.pipeline.paths.get(shoe, {}).get('aperMap')
+        if shoe in self.pipeline.solution and path_pipeline is not None \
+                and self.path_apermap is not None \
+                and os.path.abspath(path_pipeline)==os.path.abspath(self.path_apermap):
+            solution = self.pipeline.solution[shoe]
+            return solution['trace_coefs'], solution['aper_half_width']
+
+        dirname_coefs = os.path.join(self.folder_trace, 'trace_coefs')
+        filename_coefs = self.lbl_file_apermap['text'].split('_')[0][2:]+'_coefs.txt'
+        return load_trace_coefs(os.path.join(dirname_coefs, filename_coefs))
+
     def get_ifu_type(self, Nslits):
         Nslits_IFU = np.array([self.LSB.Ntotal/2, self.STD.Ntotal/2, self.HR.Ntotal/2])
         diff_Nslits = np.abs(Nslits_IFU-Nslits)
@@ -1103,17 +1339,9 @@ class IFUM_AperMap_Maker:
         shoe = self.lbl_file_apermap['text'][2]
 
         #### load the slits coefs
-        dirname_coefs = os.path.join(self.folder_trace, 'trace_coefs')
-        filename_coefs = self.lbl_file_apermap['text'].split('_')[0][2:]+'_coefs.txt'
-        path_coefs = os.path.join(dirname_coefs, filename_coefs)
-        trace_coefs = np.loadtxt(path_coefs, delimiter=',')
+        trace_coefs, aper_half_width = self.get_trace_coefs(shoe)
         N_sl = len(trace_coefs)
 
-        # load path_coefs the first line and get aper_half_width
-        with open(path_coefs, 'r') as f:
-            line = f.readline()
-            aper_half_width = int(line.split('# aper_half_width = ')[1])
-
         x_middle = np.int32(len(self.data_full[0])/2)
         y_middle = np.zeros(N_sl, dtype=np.int32)
         for i_sl in range(N_sl):
@@ -1141,10 +1369,54 @@ class IFUM_AperMap_Maker:
         else:
             print('All %d fibers are found.'%N_ap)
 
+        shape_map = (len(self.data_full),len(self.data_full[0]))
+        ifu_type = self.ifu_type
+        curve_params = self.get_curve_params(shoe)
+        dir_aperMap = self.ent_folder_trace.get()
+        today_temp = datetime.today().strftime('%y%m%d')
+        file_aperMap = 'ap%s_%s_%s_%s_%s_%s_%s_%s.fits'%(
+            self.lbl_file_apermap['text'][2], 
+            self.ifu_type.label, 
+            self.HDR_CONFIG, 
+            self.lbl_file_apermap['text'][3:7],
+            self.HDR_BINNING,
+            self.HDR_SLIDE,
+            self.HDR_SLITNAME, 
+            today_temp)
+        path_aperMap = os.path.join(dir_aperMap, file_aperMap)
+
+        def work():
+            map_ap, hdu_map = self._make_apermap_slits(shape_map, ifu_type, curve_params, trace_coefs, 
+                                                       aper_half_width, y_middle, y_middle_new, N_ap)
+            if not os.path.exists(dir_aperMap):
+                os.mkdir(dir_aperMap)
+            hdu_map.writeto(path_aperMap,overwrite=True)
+            return map_ap
+
+        def done(map_ap):
+            self.clear_image()
+            self.file_current = '%s (Nslits=%d)'%(self.lbl_file_apermap['text'], N_new)
+            self.update_image_single(map_ap, self.file_current, shoe='b', uniform=True)
+
+            info_temp = 'Saved as %s'%path_aperMap
+            self.popup_showinfo('aperMap', info_temp)
+            print('\n++++\n++++ %s\n++++\n'%(info_temp))
+
+            self.window.focus_force()
+
+        self.tasks.submit('Make AperMap with added slits', work, on_done=done,
+                          on_error=self.show_task_error)
+
+    def _make_apermap_slits(self, shape_map, ifu_type, curve_params, trace_coefs, 
+                            aper_half_width, y_middle, y_middle_new, N_ap):
+        """Make an AperMap of the traced and added slits; returns the map and its HDU."""
+        N_new = len(y_middle_new)
+
         #### make a new AperMap
-        map_ap = np.zeros((len(self.data_full),len(self.data_full[0])), dtype=np.int32)
-        x_trace = np.arange(len(self.data_full[0]))
+        map_ap = np.zeros(shape_map, dtype=np.int32)
+        x_trace = np.arange(shape_map[1])
         for i_ap in range(N_new):
+            progress('apertures', i_ap, N_new)
             ap_num = i_ap+1
             y_middle_temp = y_middle_new[i_ap]
 
@@ -1168,7 +1440,7 @@ class IFUM_AperMap_Maker:
                     map_ap[y_temp[j]+shift_temp-aper_half_width:y_temp[j]+shift_temp+aper_half_width, x_trace[j]] = np.int32(ap_num)
 
         #### cut data
-        map_ap = self.cut_data_by_edges(map_ap, shoe)
+        map_ap = cut_data_by_edges(map_ap, curve_params)
 
         #### find the maximum number of pixels in all slits
         num_ap = np.zeros(N_ap, dtype=np.int32)
@@ -1180,46 +1452,16 @@ class IFUM_AperMap_Maker:
         #### the following header params may require modifying
         hdu_map = fits.PrimaryHDU(map_ap)
         hdr_map = hdu_map.header
-        hdr_map['IFUTYPE'] = (self.ifu_type.label, 'type of IFU')
+        hdr_map['IFUTYPE'] = (ifu_type.label, 'type of IFU')
         #hdr_map.set('IFUTYPE', IFU_type, 'type of IFU')
-        hdr_map['NIFU1'] = (self.ifu_type.Nx, 'number of IFU columns')
-        hdr_map['NIFU2'] = (self.ifu_type.Ny, 'number of IFU rows')
+        hdr_map['NIFU1'] = (ifu_type.Nx, 'number of IFU columns')
+        hdr_map['NIFU2'] = (ifu_type.Ny, 'number of IFU rows')
         hdr_map['NSLITS'] = (N_new, 'number of slits')
         hdr_map['NMAX'] = (num_max, 'maximum number of pixels among all apertures')
         hdr_map['BINNING'] = ('1x1', 'binning')
         #hdu_map = fits.PrimaryHDU(map_ap, header=hdr_map)
 
-        dir_aperMap = self.ent_folder_trace.get()
-        if not os.path.exists(dir_aperMap):
-            os.mkdir(dir_aperMap)
-        
-        today_temp = datetime.today().strftime('%y%m%d')
-        file_aperMap = 'ap%s_%s_%s_%s_%s_%s_%s_%s.fits'%(
-            self.lbl_file_apermap['text'][2], 
-            self.ifu_type.label, 
-            self.HDR_CONFIG, 
-            self.lbl_file_apermap['text'][3:7],
-            self.HDR_BINNING,
-            self.HDR_SLIDE,
-            self.HDR_SLITNAME, 
-            today_temp)
-
-        path_aperMap = os.path.join(dir_aperMap, file_aperMap)
-        hdu_map.writeto(path_aperMap,overwrite=True)
-
-        #self.btn_select_slits['state'] = 'disabled'
-        #self.btn_select_slits['state'] = 'disabled'
-
-        ####
-        self.clear_image()
-        self.file_current = '%s (Nslits=%d)'%(self.lbl_file_apermap['text'], N_new)
-        self.update_image_single(map_ap, self.file_current, shoe='b', uniform=True)
-
-        info_temp = 'Saved as %s'%path_aperMap
-        self.popup_showinfo('aperMap', info_temp)
-        print('\n++++\n++++ %s\n++++\n'%(info_temp))
-
-        self.window.focus_force()
+        return map_ap, hdu_map
     
     # def make_file_apermap_slits(self):
     #     #### load MasterSlits file
@@ -1371,10 +1613,7 @@ class IFUM_AperMap_Maker:
         shoe = self.lbl_file_apermap['text'][2]
 
         #### load the slits coefs
-        dirname_coefs = os.path.join(self.folder_trace, 'trace_coefs')
-        filename_coefs = self.lbl_file_apermap['text'].split('_')[0][2:]+'_coefs.txt'
-        path_coefs = os.path.join(dirname_coefs, filename_coefs)
-        trace_coefs = np.loadtxt(path_coefs, delimiter=',')
+        trace_coefs, _ = self.get_trace_coefs(shoe)
         N_sl = len(trace_coefs)
 
         x_middle = np.int32(len(self.data_full[0])/2)
@@ -1403,39 +1642,7 @@ class IFUM_AperMap_Maker:
             return 0
 
         #### add missing slits
-        y_middle_add = np.array([], dtype=np.int32)
-
-        pts_diff = np.diff(pts_pick)
-        pts_gap = pts_pick[0:-1] + pts_diff/2.
-        pts_all = np.append(pts_pick, pts_gap)
-        pts_all = np.append(pts_all, np.array([0, len(self.data_full[0])]))
-        pts_all = np.sort(pts_all)
-        for i in range(n_pick*2):
-            mask_id_temp = np.logical_and(y_middle>pts_all[i], y_middle<=pts_all[i+1])
-            y_middle_temp = y_middle[mask_id_temp]
-            y_diff_med_temp = np.median( np.diff(y_middle_temp) )
-
-            y_middle_temp = np.append(pts_all[i], y_middle_temp)
-            y_middle_temp = np.append(y_middle_temp, pts_all[i+1])
-            y_diff_temp = np.diff(y_middle_temp)
-
-            print('Working on %d/%d to add %d fiber(s)'%(i+1, n_pick*2, self.ifu_type.Nx-len(y_diff_temp)+1))
-            print('==== diff_med', y_diff_med_temp)
-            while len(y_diff_temp)<=self.ifu_type.Nx:
-                mask_diff_temp = y_diff_temp>y_diff_med_temp+np.sqrt(y_diff_med_temp)
-                if np.sum(mask_diff_temp)>0:
-                    if i%2==0:
-                        idx_temp = np.where(mask_diff_temp)[0][-1]
-                        y_middle_add_temp = y_middle_temp[idx_temp] + y_diff_med_temp
-                    else:
-                        idx_temp = np.where(mask_diff_temp)[0][0]
-                        y_middle_add_temp = y_middle_temp[idx_temp+1] - y_diff_med_temp
-                    y_middle_add = np.sort( np.append(y_middle_add, y_middle_add_temp) )
-                    y_middle_temp = np.sort( np.append(y_middle_temp, y_middle_add_temp) )
-                    y_diff_temp = np.diff(y_middle_temp)
-                    print(len(y_middle_add), y_middle_add_temp)
-
-            y_middle = np.sort( np.append(y_middle[~mask_id_temp], y_middle_temp) )
+        y_middle_add = fill_bundle_gaps(y_middle, pts_pick, len(self.data_full[0]), self.ifu_type.Nx)
 
         ####
         print("Auto-fix found %d fiber(s) to add"%len(y_middle_add))
@@ -1783,8 +1990,8 @@ class IFUM_AperMap_Maker:
         self.folder_trace = self.ent_folder_trace.get()
         self.disable_make_apermap()
 
-    def load_4fits(self):
-        """Load the selected fits file."""
+    def load_4fits(self, on_loaded=None):
+        """Load the selected fits file in the background; on_loaded(fnum) is called after."""
         #shoe_i = self.shoe.get()
         dirname = self.ent_folder.get()
         idxs = self.box_files.curselection()
@@ -1797,21 +2004,24 @@ class IFUM_AperMap_Maker:
                 # get header info
                 tmp = self.get_header_info(fname)
 
+                start_report(fnum, memory=self.profile_memory)
                 self.data_full = None
-                self.hdr_c1_b = None
-                self.data_full, self.hdr_c1_b = pack_4fits_simple(fnum, dirname, 'b')
-                self.file_current = fnum
-
                 self.data_full2 = None
-                self.hdr_c1_r = None
-                self.data_full2, self.hdr_c1_r = pack_4fits_simple(fnum, dirname, 'r')
+                self.pipeline.dir_raw = dirname
 
-                #### show the fits image
-                self.clear_image()
-                self.update_image()
-                return fnum #shoe_i+fnum
-        else:
-            return '0000'
+                def done(packed):
+                    self.data_full = packed['b']
+                    self.data_full2 = packed['r']
+                    self.file_current = fnum
+
+                    #### show the fits image
+                    self.clear_image()
+                    self.update_image()
+                    if on_loaded is not None:
+                        on_loaded(fnum) #shoe_i+fnum
+
+                self.tasks.submit('Load %s'%fnum, self.pipeline.pack, fnum,
+                                  on_done=done, on_error=self.show_task_error)
 
     def get_header_info(self, pathname):
         """Get header info from the fits file."""
@@ -1833,8 +2043,10 @@ class IFUM_AperMap_Maker:
     def disable_dependent_btns(self):
         self.btn_select_curve_b['state'] = 'disabled'
         self.btn_select_curve_r['state'] = 'disabled'
+        self.btn_auto_curve['state'] = 'disabled'
         self.btn_select_edges_b['state'] = 'disabled'
         self.btn_select_edges_r['state'] = 'disabled'
+        self.btn_auto_edges['state'] = 'disabled'
         self.btn_make_trace['state'] = 'disabled'
         #self.btn_make_pypeit['state'] = 'disabled'
         self.btn_run_pypeit['state'] = 'disabled'
@@ -1857,28 +2069,31 @@ class IFUM_AperMap_Maker:
         _dummy_lbl.destroy()
 
     def load_4fits_curve(self):
-        label = self.load_4fits()
-        if label!='0000':
+        def loaded(label):
             self.lbl_file_curve["text"] = label
             self.gray_all_lbl_file()
             self.lbl_file_curve.config(bg='yellow')
             self.disable_dependent_btns()
             self.btn_select_curve_b['state'] = 'normal'
             self.btn_select_curve_r['state'] = 'normal'
+            self.btn_auto_curve['state'] = 'normal'
+
+        self.load_4fits(on_loaded=loaded)
 
     def load_4fits_edges(self):
-        label = self.load_4fits()
-        if label!='0000':
+        def loaded(label):
             self.lbl_file_edges["text"] = label
             self.gray_all_lbl_file()
             self.lbl_file_edges.config(bg='yellow')
             self.disable_dependent_btns()
             self.btn_select_edges_b['state'] = 'normal'
             self.btn_select_edges_r['state'] = 'normal'
+            self.btn_auto_edges['state'] = 'normal'
+
+        self.load_4fits(on_loaded=loaded)
 
     def load_4fits_trace(self):
-        label = self.load_4fits()
-        if label!='0000':
+        def loaded(label):
             self.filename_trace = label+'_trace'
             self.lbl_file_trace["text"] = label
             self.gray_all_lbl_file()
@@ -1886,6 +2101,8 @@ class IFUM_AperMap_Maker:
             self.disable_dependent_btns()
             self.btn_make_trace['state'] = 'normal'
 
+        self.load_4fits(on_loaded=loaded)
+
     def open_fits_trace(self):
         self.folder_trace = self.ent_folder_trace.get()
         path_tmp = filedialog.askopenfilename(initialdir=self.folder_trace)
@@ -1894,12 +2111,13 @@ class IFUM_AperMap_Maker:
     def load_fits_trace(self, pathname):
         if os.path.isfile(pathname) and pathname.endswith("_trace.fits"):
             #hdul_temp = cached_fits_open(filename)
+            #### the trace files just made are kept in memory
             dirname, fname = os.path.split(pathname)
             fname = fname[1:]
-            hdul_temp = fits.open(os.path.join(dirname, 'b'+fname))
-            self.data_full = np.float32(hdul_temp[0].data)
-            hdul_temp = fits.open(os.path.join(dirname, 'r'+fname))
-            self.data_full2 = np.float32(hdul_temp[0].data)
+            self.pipeline.load_trace_file(os.path.join(dirname, 'b'+fname))
+            self.pipeline.load_trace_file(os.path.join(dirname, 'r'+fname))
+            self.data_full = self.pipeline.cut['b']
+            self.data_full2 = self.pipeline.cut['r']
 
             #### get config info from header
             tmp = self.get_header_info(pathname)
@@ -2001,6 +2219,7 @@ class IFUM_AperMap_Maker:
             self.ent_folder_trace.insert(tk.END, self.folder_trace)
 
             self.filename_trace = filename
+            self.path_apermap = pathname
             file_temp = "ap%s_%s"%(fnum_temp, str_temp[4].split('.')[0])
             self.lbl_file_apermap['text'] = file_temp
             self.file_current = file_temp+" (Nslits=%s)"%N_slits_file
@@ -2033,6 +2252,7 @@ class IFUM_AperMap_Maker:
         else:
             self.data_full = np.ones((4048, 4048), dtype=np.int32)
             self.filename_trace = "apx0000_0000.fits"
+            self.path_apermap = None
             self.file_current = "0000"
             self.lbl_file_apermap['text'] = self.filename_trace.split('.')[0]
             self.btn_select_bundles['state'] = 'disabled'
@@ -2051,6 +2271,7 @@ class IFUM_AperMap_Maker:
         # creating the Tkinter canvas
         # containing the Matplotlib figure
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.frame2)  # A tk.DrawingArea.
+        self.blits['b'] = BlitManager(self.canvas)
         self.canvas.draw()
 
         # placing the canvas on the Tkinter window
@@ -2072,6 +2293,7 @@ class IFUM_AperMap_Maker:
         # creating the Tkinter canvas
         # containing the Matplotlib figure
         self.canvas2 = FigureCanvasTkAgg(self.fig2, master=self.frame3)  # A tk.DrawingArea.
+        self.blits['r'] = BlitManager(self.canvas2)
         self.canvas2.draw()
 
         # placing the canvas on the Tkinter window
@@ -2088,75 +2310,139 @@ class IFUM_AperMap_Maker:
     def remove_image(self, shoe='both'):
         if shoe=='b' or shoe=='both':
             self.fig.clf()
+            self.reset_overlays('b')
             self.canvas.draw_idle()
         if shoe=='r' or shoe=='both':
             self.fig2.clf()
+            self.reset_overlays('r')
             self.canvas2.draw_idle()
 
     def clear_image(self, shoe='both'):
         if shoe=='b' or shoe=='both':
             self.fig.clf()
+            self.reset_overlays('b')
             self.ax = self.fig.add_subplot(111)
         if shoe=='r' or shoe=='both':
             self.fig2.clf()
+            self.reset_overlays('r')
             self.ax2 = self.fig2.add_subplot(111)
 
+    def reset_overlays(self, shoe):
+        self.overlays[shoe] = {}
+        self.blits[shoe].reset()
+
+    def get_overlay(self, shoe, name, fmt='r--'):
+        """Get the persistent line of an overlay on the image of a shoe."""
+        ax = self.ax if shoe=='b' else self.ax2
+        line = self.overlays[shoe].get(name)
+        if line is None or line.axes is not ax:
+            line, = ax.plot([], [], fmt, zorder=10)
+            self.overlays[shoe][name] = self.blits[shoe].add_artist(line)
+        return line
+
+    def refresh_overlays(self, shoe):
+        """Blit the overlays, or draw the image first if the pane has none."""
+        ax = self.ax if shoe=='b' else self.ax2
+        image = self.images.get(shoe)
+        if image is not None and image.axes is ax:
+            self.blits[shoe].update()
+        else:
+            self.update_image(shoe=shoe)
+
+    def schedule_redraw(self, key, func, delay_ms=300):
+        """Run func once typing or clicking pauses for delay_ms."""
+        if key in self.redraw_jobs:
+            self.window.after_cancel(self.redraw_jobs[key])
+        def run():
+            del self.redraw_jobs[key]
+            func()
+        self.redraw_jobs[key] = self.window.after(delay_ms, run)
+
     def update_image(self, shoe='both', percent=85.9, uniform=False):
         if shoe=='b' or shoe=='both':
-            if uniform:
-                self.ax.imshow(self.data_full, origin='lower', cmap='gray', vmin=np.min(self.data_full), vmax=np.min(self.data_full)+1)
-            else:
-                self.ax.imshow(self.data_full, origin='lower', cmap='gray', vmin=0.0, vmax=np.percentile(self.data_full, percent))
-            self.ax.set_title("b%s"%self.file_current)
-            self.fig.set_tight_layout(True)
-            self.canvas.draw_idle()
+            self.show_image('b', self.data_full, "b%s"%self.file_current, percent, uniform)
         if shoe=='r' or shoe=='both':
-            if uniform:
-                self.ax2.imshow(self.data_full2, origin='lower', cmap='gray', vmin=np.min(self.data_full2), vmax=np.min(self.data_full2)+1)
-            else:
-                self.ax2.imshow(self.data_full2, origin='lower', cmap='gray', vmin=0.0, vmax=np.percentile(self.data_full2, percent))
-            self.ax2.set_title("r%s"%self.file_current)
-            self.fig2.set_tight_layout(True)
-            self.canvas2.draw_idle()
+            self.show_image('r', self.data_full2, "r%s"%self.file_current, percent, uniform)
 
     def update_image_single(self, data, title, shoe='b', percent=85.9, uniform=False):
-        if shoe=='b':
-            if uniform:
-                self.ax.imshow(data, origin='lower', cmap='gray', vmin=np.min(data), vmax=np.min(data)+1)
-            else:
-                self.ax.imshow(data, origin='lower', cmap='gray', vmin=0.0, vmax=np.percentile(data, percent))
-            self.ax.set_title(title)
-            self.fig.set_tight_layout(True)
-            self.canvas.draw_idle()
-        if shoe=='r':
-            if uniform:
-                self.ax2.imshow(data, origin='lower', cmap='gray', vmin=np.min(data), vmax=np.min(data)+1)
-            else:
-                self.ax2.imshow(data, origin='lower', cmap='gray', vmin=0.0, vmax=np.percentile(data, percent))
-            self.ax2.set_title(title)
-            self.fig2.set_tight_layout(True)
-            self.canvas2.draw_idle()
+        if shoe=='b' or shoe=='r':
+            self.show_image(shoe, data, title, percent, uniform)
+
+    def show_image(self, shoe, data, title, percent=85.9, uniform=False):
+        """Show data in the image pane of a shoe at the level of its display pyramid."""
+        ax, fig, canvas = (self.ax, self.fig, self.canvas) if shoe=='b' else \
+            (self.ax2, self.fig2, self.canvas2)
+
+        #### the pyramid is kept until the data of the pane change
+        pyramid = self.pyramids.get(shoe)
+        if pyramid is None or pyramid.data is not data:
+            pyramid = self.pyramids[shoe] = DisplayPyramid(data)
+        if uniform:
+            vmin, vmax = pyramid.min(), pyramid.min()+1
+        else:
+            vmin, vmax = 0.0, pyramid.percentile(percent)
+
+        for image in list(ax.images):
+            image.remove()
+        xlim, ylim = (-0.5, pyramid.nx-0.5), (-0.5, pyramid.ny-0.5)
+        image, extent, factor = pyramid.get_view(xlim, ylim, self.get_screen_size(ax))
+        self.images[shoe] = ax.imshow(image, origin='lower', cmap='gray', vmin=vmin, vmax=vmax, 
+                                      extent=extent, interpolation='nearest')
+        self.image_factors[shoe] = factor
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
+
+        #### swap levels and tiles when the toolbar zooms or pans
+        if getattr(ax, 'view_shoe', None) is None:
+            ax.view_shoe = shoe
+            ax.callbacks.connect('xlim_changed', lambda ax: self.refresh_view(ax.view_shoe))
+            ax.callbacks.connect('ylim_changed', lambda ax: self.refresh_view(ax.view_shoe))
+
+        ax.set_title(title)
+        fig.set_tight_layout(True)
+        canvas.draw_idle()
+
+    def get_screen_size(self, ax):
+        bbox = ax.get_window_extent()
+        return bbox.width, bbox.height
+
+    def refresh_view(self, shoe):
+        """Show the level (or full-resolution tile) of the current view."""
+        image = self.images.get(shoe)
+        pyramid = self.pyramids.get(shoe)
+        if image is None or pyramid is None or image.axes is None:
+            return
+        ax = image.axes
+        xlim, ylim, screen_size = ax.get_xlim(), ax.get_ylim(), self.get_screen_size(ax)
+        factor = pyramid.choose_factor(xlim, ylim, screen_size)
+        if factor==self.image_factors[shoe]:
+            # a level covers the frame; a tile only the view it was cut for
+            view = (min(xlim), max(xlim), min(ylim), max(ylim))
+            if factor>1 or _contains(image.get_extent(), view):
+                return
+        data, extent, factor = pyramid.get_view(xlim, ylim, screen_size)
+        image.set_data(data)
+        image.set_extent(extent)
+        self.image_factors[shoe] = factor
+        ax.figure.canvas.draw_idle()
 
     def plot_curve(self, shoe='both'):
         if shoe=='b' or shoe=='both':
-            yy = np.arange(len(self.data_full))
-            xx = func_parabola(yy, self.param_curve_b[0], self.param_curve_b[1], self.param_curve_b[2])
-            self.ax.plot(xx, yy, 'r--')
-            self.update_image(shoe='b')
+            geometry = get_geometry(self.get_curve_params('b'), self.data_full.shape)
+            self.get_overlay('b', 'curve').set_data(geometry.curve, geometry.yy)
+            self.refresh_overlays('b')
         if shoe=='r' or shoe=='both':
-            yy = np.arange(len(self.data_full2))
-            xx = func_parabola(yy, self.param_curve_r[0], self.param_curve_r[1], self.param_curve_r[2])
-            self.ax2.plot(xx, yy, 'r--')
-            self.update_image(shoe='r')
+            geometry = get_geometry(self.get_curve_params('r'), self.data_full2.shape)
+            self.get_overlay('r', 'curve').set_data(geometry.curve, geometry.yy)
+            self.refresh_overlays('r')
 
     def plot_edges(self, shoe='both'):
         if shoe=='b' or shoe=='both':
-            yy = np.arange(len(self.data_full))
-            x1 = func_parabola(yy, self.param_curve_b[0], self.param_curve_b[1], self.param_edges_b[0])
-            self.ax.plot(x1, yy, 'r--')
-            x2 = func_parabola(yy, self.param_curve_b[0], self.param_curve_b[1], self.param_edges_b[1])
-            self.ax.plot(x2, yy, 'r--')
-            self.update_image(shoe='b')
+            geometry = get_geometry(self.get_curve_params('b'), self.data_full.shape)
+            x1, x2 = geometry.x1, geometry.x2
+            self.get_overlay('b', 'edge1').set_data(x1, geometry.yy)
+            self.get_overlay('b', 'edge2').set_data(x2, geometry.yy)
+            self.refresh_overlays('b')
 
             # check if any values in x1 and x2 are out of bounds, set the number in Step 2 to red
             if np.any(x1 < 0) or np.any(x1 > len(self.data_full[0])):
@@ -2171,12 +2457,11 @@ class IFUM_AperMap_Maker:
 
 
         if shoe=='r' or shoe=='both':
-            yy = np.arange(len(self.data_full2))
-            x1 = func_parabola(yy, self.param_curve_r[0], self.param_curve_r[1], self.param_edges_r[0])
-            self.ax2.plot(x1, yy, 'r--')
-            x2 = func_parabola(yy, self.param_curve_r[0], self.param_curve_r[1], self.param_edges_r[1])
-            self.ax2.plot(x2, yy, 'r--')
-            self.update_image(shoe='r')
+            geometry = get_geometry(self.get_curve_params('r'), self.data_full2.shape)
+            x1, x2 = geometry.x1, geometry.x2
+            self.get_overlay('r', 'edge1').set_data(x1, geometry.yy)
+            self.get_overlay('r', 'edge2').set_data(x2, geometry.yy)
+            self.refresh_overlays('r')
 
             # check if any values in x1 and x2 are out of bounds, set the number in Step 2 to red
             if np.any(x1 < 0) or np.any(x1 > len(self.data_full2[0])):
@@ -2205,6 +2490,53 @@ class IFUM_AperMap_Maker:
                      fontsize=10, color='white', ha='left', va='top',
                      bbox=dict(facecolor='black', alpha=0.5, edgecolor='none'))
 
+    def auto_curve(self):
+        """Solve the curvature of both shoes from the edges of the loaded flat frame."""
+        data = {'b': self.data_full, 'r': self.data_full2}
+        for shoe in ['b', 'r']:
+            self.get_overlay(shoe, 'points', 'rx').set_data([], [])
+
+        def work():
+            solutions = {}
+            for i, shoe in enumerate(['b', 'r']):
+                progress('curvature (%s)'%shoe, i, 2)
+                solutions[shoe] = solve_curvature(data[shoe])
+            return solutions
+
+        def done(solutions):
+            info_temp = ''
+            for shoe in ['b', 'r']:
+                sol = solutions[shoe]
+                popt = np.array([sol['A'], sol['B'], sol['C']])
+                if shoe=='b':
+                    self.txt_param_curve_A_b.set("%.3e"%(popt[0]))
+                    self.txt_param_curve_B_b.set("%.1f"%(popt[1]))
+                    self.txt_param_curve_C_b.set("%.1f"%(popt[2]))
+                    self.param_curve_b = popt
+                elif shoe=='r':
+                    self.txt_param_curve_A_r.set("%.3e"%(popt[0]))
+                    self.txt_param_curve_B_r.set("%.1f"%(popt[1]))
+                    self.txt_param_curve_C_r.set("%.1f"%(popt[2]))
+                    self.param_curve_r = popt
+
+                #### show the edge points used by the fit
+                mask = sol['mask']
+                self.get_overlay(shoe, 'points', 'rx').set_data(sol['x'][mask], sol['y'][mask])
+                self.plot_curve(shoe=shoe)
+
+                info_temp += '%s-side:\n'%shoe \
+                    + '  A = %.3e +- %.1e\n'%(sol['A'], sol['err_A']) \
+                    + '  B = %.1f +- %.2f\n'%(sol['B'], sol['err_B']) \
+                    + '  C = %.1f +- %.2f\n'%(sol['C'], sol['err_C']) \
+                    + '  %d/%d edge points, rms = %.2f pix\n\n'%(
+                        sol['n_used'], sol['n_total'], sol['rms'])
+
+            self.enable_others()
+            info_temp += 'Accept, or adjust A, B and C and Plot again.'
+            self.popup_left_aligned('Curvature', info_temp)
+
+        self.tasks.submit('Auto curvature', work, on_done=done, on_error=self.show_task_error)
+
     def pick_points(self, shoe):
         """Pick points on the image to select the curve points."""
         if shoe=='b':
@@ -2239,6 +2571,38 @@ class IFUM_AperMap_Maker:
 
         self.window.focus_force()
 
+    def auto_edges(self):
+        """Detect the edges of both shoes along the curvature of Step 1; X1_r is searched near X1_b + dX1."""
+        # reset lock conditions
+        self.state_edge_lock_b.set(0)
+        self.state_edge_lock_r.set(0)
+
+        data = {'b': self.data_full, 'r': self.data_full2}
+        curve_params = {'b': np.copy(self.param_curve_b), 'r': np.copy(self.param_curve_r)}
+        offset = float(self.param_edges_offset)
+        for shoe in ['b', 'r']:
+            self.get_overlay(shoe, 'points', 'rx').set_data([], [])
+
+        def done(edges):
+            self.param_edges_b = np.array([edges['b']['X1'], edges['b']['X2'], edges['b']['dX']])
+            self.param_edges_r = np.array([edges['r']['X1'], edges['r']['X2'], edges['r']['dX']])
+            self.param_edges_offset = self.param_edges_r[0]-self.param_edges_b[0]
+            self.renew_param_edges()
+
+            #### plot the edges
+            self.plot_edges(shoe='both')
+
+            self.enable_others()
+            info_temp = \
+                'b-side: X1 = %.1f, dX = %.1f\n'%(self.param_edges_b[0], self.param_edges_b[2]) \
+                + 'r-side: X1 = %.1f, dX = %.1f\n'%(self.param_edges_r[0], self.param_edges_r[2]) \
+                + 'dX1 (r - b) = %.1f (prior %.0f)\n\n'%(self.param_edges_offset, offset) \
+                + 'Accept, or adjust X1 and dX and Plot again.'
+            self.popup_left_aligned('Edges', info_temp)
+
+        self.tasks.submit('Auto edges', detect_edges_both, data, curve_params, offset,
+                          on_done=done, on_error=self.show_task_error)
+
     def pick_edges(self, shoe):
         """Pick points on the image to select the edges."""
         if shoe=='b':
@@ -2351,9 +2715,11 @@ class IFUM_AperMap_Maker:
             if step=='curve':
                 self.btn_select_curve_b['state'] = 'normal'
                 self.btn_select_curve_r['state'] = 'normal'
+                self.btn_auto_curve['state'] = 'normal'
             elif step=='edges':
                 self.btn_select_edges_b['state'] = 'normal'
                 self.btn_select_edges_r['state'] = 'normal'
+                self.btn_auto_edges['state'] = 'normal'
 
             #### break the mpl connection
             self.break_mpl_connect(shoe=shoe)
@@ -2364,9 +2730,9 @@ class IFUM_AperMap_Maker:
                 self.points.append([event.xdata, event.ydata])
                 print(len(self.points), event.xdata, event.ydata)
                 self.x_last, self.y_last = event.xdata, event.ydata
-                self.ax.scatter(len(self.data_full[0])/2, event.ydata, c='r', marker='x', zorder=10)
-                #self.update_image(uniform=True)
-                self.update_image_single(self.data_full, self.file_current, shoe='b', uniform=True)
+                pts = np.array(self.points)
+                self.get_overlay('b', 'points', 'rx').set_data(np.full(len(pts), len(self.data_full[0])/2), pts[:, 1])
+                self.refresh_overlays('b')
 
     def on_click_curve(self, event, shoe):
         if event.button is MouseButton.RIGHT:
@@ -2375,11 +2741,9 @@ class IFUM_AperMap_Maker:
                 print(len(self.points), event.xdata, event.ydata)
                 self.x_last, self.y_last = event.xdata, event.ydata
 
-                if shoe=='b':
-                    self.ax.scatter(event.xdata, event.ydata, c='r', marker='x', zorder=10)
-                elif shoe=='r':
-                    self.ax2.scatter(event.xdata, event.ydata, c='r', marker='x', zorder=10)
-                self.update_image(shoe=shoe)
+                pts = np.array(self.points)
+                self.get_overlay(shoe, 'points', 'rx').set_data(pts[:, 0], pts[:, 1])
+                self.refresh_overlays(shoe)
 
             if len(self.points)==7:
                 pts = np.array(self.points)
@@ -2409,6 +2773,7 @@ class IFUM_AperMap_Maker:
                 
                 self.btn_select_curve_b['state'] = 'normal' 
                 self.btn_select_curve_r['state'] = 'normal' 
+                self.btn_auto_curve['state'] = 'normal'
 
                 #### break the mpl connection
                 self.break_mpl_connect(shoe=shoe)
@@ -2424,11 +2789,10 @@ class IFUM_AperMap_Maker:
                 print(len(self.points), event.xdata, event.ydata)
                 self.x_last, self.y_last = event.xdata, event.ydata
 
-                if shoe=='b':
-                    self.ax.scatter(event.xdata, len(self.data_full)/2, c='r', marker='x', zorder=10)
-                elif shoe=='r':
-                    self.ax2.scatter(event.xdata, len(self.data_full2)/2, c='r', marker='x', zorder=10)
-                self.update_image(shoe=shoe)
+                pts = np.array(self.points)
+                n_y = len(self.data_full) if shoe=='b' else len(self.data_full2)
+                self.get_overlay(shoe, 'points', 'rx').set_data(pts[:, 0], np.full(len(pts), n_y/2))
+                self.refresh_overlays(shoe)
 
             if len(self.points) == 2:
 
@@ -2451,6 +2815,7 @@ class IFUM_AperMap_Maker:
                 self.enable_others()
                 self.btn_select_edges_b['state'] = 'normal'
                 self.btn_select_edges_r['state'] = 'normal'
+                self.btn_auto_edges['state'] = 'normal'
 
                 #### break the mpl connection
                 self.break_mpl_connect(shoe=shoe)
@@ -2544,6 +2909,8 @@ class IFUM_AperMap_Maker:
         self.btn_select_curve_b['state'] = 'disabled'
         self.btn_select_edges_b['state'] = 'disabled'
         self.btn_select_curve_r['state'] = 'disabled'
+        self.btn_auto_curve['state'] = 'disabled'
+        self.btn_auto_edges['state'] = 'disabled'
         self.btn_select_edges_r['state'] = 'disabled'
         self.btn_make_trace['state'] = 'disabled'
         self.btn_select_bundles['state'] = 'disabled'
@@ -2566,34 +2933,29 @@ class IFUM_AperMap_Maker:
             self.fig2.canvas.mpl_disconnect(self.cidexit)
 
     def cut_data_by_edges(self, data_raw, shoe):
-        data_mask = np.zeros_like(data_raw)
-        yy = np.arange(len(data_raw))
-        if shoe == 'b':
-            x1 = np.int32(np.round(func_parabola(yy, self.param_curve_b[0], self.param_curve_b[1], self.param_edges_b[0])))
-            x2 = np.int32(np.round(func_parabola(yy, self.param_curve_b[0], self.param_curve_b[1], self.param_edges_b[1])))
-        elif shoe == 'r':
-            x1 = np.int32(np.round(func_parabola(yy, self.param_curve_r[0], self.param_curve_r[1], self.param_edges_r[0])))
-            x2 = np.int32(np.round(func_parabola(yy, self.param_curve_r[0], self.param_curve_r[1], self.param_edges_r[1])))
+        return cut_data_by_edges(data_raw, self.get_curve_params(shoe))
 
-        for iy in range(len(yy)):
-            data_mask[iy, x1[iy-1]:x2[iy]] = data_raw[iy, x1[iy-1]:x2[iy]]
+    def make_file_trace(self):
+        #### cut the data and write the trace files
+        self.folder_trace = self.ent_folder_trace.get()
+        self.pipeline.dir_trace = self.folder_trace
+        curve_params = {shoe: self.get_curve_params(shoe) for shoe in ['b', 'r']}
 
-        return data_mask
+        def work():
+            return [self.pipeline.cut_by_edges(shoe, curve_params[shoe]) for shoe in ['b', 'r']]
 
-    def make_file_trace(self):
-        self.data_full = self.cut_data_by_edges(self.data_full, 'b')
-        self.data_full2 = self.cut_data_by_edges(self.data_full2, 'r')
+        self.tasks.submit('Make trace files', work, on_done=self.show_file_trace,
+                          on_error=self.show_task_error)
+
+    def show_file_trace(self, data_cut):
+        self.data_full, self.data_full2 = data_cut
+        path_trace_r = self.pipeline.paths['r']['trace']
         self.file_current = self.file_current+"_trace"
 
         #### show the fits image
         self.clear_image(shoe='both')
         self.plot_edges(shoe='both')
 
-        #### write the fits file
-        self.folder_trace = self.ent_folder_trace.get()
-        path_trace_b = write_trace_file(self.data_full, self.hdr_c1_b, self.folder_trace, 'b'+self.file_current)
-        path_trace_r = write_trace_file(self.data_full2, self.hdr_c1_r, self.folder_trace, 'r'+self.file_current)
-
         #### control widgets
         self.btn_make_trace['state'] = 'disabled'
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Make AperMaps without the GUI, e.g.,
+
+    python ifum_apermap_maker_cli.py data_raw curve_files/curve_STD_0000.txt 0001 0005-0009
+    python ifum_apermap_maker_cli.py data_raw curve.txt --all --workers 8 --warm-start data_trace
+
+Each frame and shoe is packed, cut by the edges of the curve file, traced
+and turned into an AperMap in a process pool. The trace files and the
+products (AperMap, slits, trace coefs and run report) are the same as
+those of the GUI; --weights adds the fractional aperture weights
+(ap..._weights.fits). The output of each job is logged to
+{dir_trace}/aperMap/logs/{shoe}{fnum}.log.
+"""
+import os
+
+#### one thread per process, as frames are run in a process pool
+for _name in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+    os.environ.setdefault(_name, '1')
+
+import sys
+import time
+import argparse
+import contextlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from astropy.io import fits
+
+from utils_io import find_prior_trace_coefs
+from utils_pipeline import read_curve_file, list_frames, get_header_info, Pipeline
+from utils_profile import start_report
+
+#### the fiber models are loaded relative to the repo folder
+DIR_REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_frames(items):
+    """Get frame numbers from items like 0001 or 0005-0009. """
+    fnums = []
+    for item in items:
+        if '-' in item:
+            first, last = item.split('-')
+            fnums += ['%04d'%i for i in range(int(first), int(last)+1)]
+        else:
+            fnums.append('%04d'%int(item))
+    return fnums
+
+
+def run_job(fnum, shoe, dir_raw, dir_trace, curve_params, path_prior=None, qa=False,
+            weights=False):
+    """
+    Pack, cut, trace and write the AperMap of one frame and shoe
+    Returns a dict of the job status, products and timings.
+    """
+    os.chdir(DIR_REPO)
+    dir_logs = os.path.join(dir_trace, 'aperMap', 'logs')
+    os.makedirs(dir_logs, exist_ok=True)
+    path_log = os.path.join(dir_logs, '%s%s.log'%(shoe, fnum))
+    job = {'fnum': fnum, 'shoe': shoe, 'log': path_log, 'status': 'failed'}
+
+    t0 = time.perf_counter()
+    with open(path_log, 'w') as f_log, contextlib.redirect_stdout(f_log), \
+            contextlib.redirect_stderr(f_log):
+        try:
+            report = start_report(shoe+fnum)
+            fig_dir = os.path.join(dir_trace, 'aperMap', 'qa') if qa else None
+            pipeline = Pipeline(dir_raw, dir_trace, weights=weights)
+            apermap = pipeline.run(fnum, {shoe: curve_params}, shoes=(shoe,),
+                                   path_priors={shoe: path_prior}, plot=qa,
+                                   headless=True, fig_dir=fig_dir)[shoe]
+            solution = pipeline.solution[shoe]
+            ifu_type = apermap['ifu_type']
+            path_aperMap = pipeline.paths[shoe]['aperMap']
+
+            report.info.update({'shoe': shoe, 'ifu_type': ifu_type.label,
+                                'N_sl': int(solution['N_sl']),
+                                'warm_start': solution['warm_start'],
+                                'aperMap': path_aperMap})
+            report.write_json(path_aperMap.replace('.fits', '_report.json'))
+            start_report(enabled=False)
+
+            job.update({'status': 'done', 'ifu_type': ifu_type.label,
+                        'N_sl': int(solution['N_sl']), 'N_expected': ifu_type.Ntotal//2,
+                        'aperMap': path_aperMap, 'warm_start': solution['warm_start']})
+        except Exception:
+            traceback.print_exc()
+    job['seconds'] = time.perf_counter() - t0
+    return job
+
+
+def find_prior(dirs_prior, fnum, shoe, dir_raw):
+    """Find the trace coefs of a previous night for a warm start. """
+    hdr_info = get_header_info(fits.getheader(os.path.join(dir_raw, '%s%sc1.fits'%(shoe, fnum))))
+    return find_prior_trace_coefs(dirs_prior, shoe, hdr_info['ifu_type'],
+                                  hdr_info['config'], hdr_info['binning'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Make IFUM AperMaps without the GUI')
+    parser.add_argument('dir_raw', help='folder of the raw 4-amplifier files')
+    parser.add_argument('path_curve', help='curve file saved by the GUI')
+    parser.add_argument('frames', nargs='*', help='frame numbers, e.g., 0001 0005-0009')
+    parser.add_argument('--all', action='store_true', help='all frames in dir_raw')
+    parser.add_argument('--dir-trace', default='./data_trace',
+                        help='output folder of the trace files and aperMap')
+    parser.add_argument('--shoes', default='b,r')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes')
+    parser.add_argument('--warm-start', action='append', default=[], metavar='DIR',
+                        help='trace folder of a previous night (repeatable)')
+    parser.add_argument('--qa', action='store_true',
+                        help='save diagnostic figures to aperMap/qa')
+    parser.add_argument('--weights', action='store_true',
+                        help='also write the fractional aperture weights of each AperMap')
+    args = parser.parse_args()
+
+    dir_raw = os.path.abspath(args.dir_raw)
+    dir_trace = os.path.abspath(args.dir_trace)
+    dirs_prior = [os.path.abspath(d) for d in args.warm_start]
+    curve_params = read_curve_file(args.path_curve)
+    fnums = list_frames(dir_raw) if args.all else parse_frames(args.frames)
+    shoes = args.shoes.split(',')
+    if len(fnums)==0:
+        parser.error('no frames given; list frame numbers or use --all')
+    os.makedirs(dir_trace, exist_ok=True)
+
+    # the priors are found before any job writes new trace coefs
+    jobs = []
+    for fnum in fnums:
+        for shoe in shoes:
+            path_prior = find_prior(dirs_prior, fnum, shoe, dir_raw) if dirs_prior else None
+            jobs.append((fnum, shoe, dir_raw, dir_trace, curve_params[shoe],
+                         path_prior, args.qa, args.weights))
+    print('++++ %d job(s) of %d frame(s) with %d worker(s)'%(len(jobs), len(fnums), args.workers))
+
+    t0 = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(run_job, *job) for job in jobs]
+        for future in as_completed(futures):
+            job = future.result()
+            results.append(job)
+            if job['status']=='done':
+                flag = '' if job['N_sl']==job['N_expected'] else \
+                    ' !!!! %d fibers expected'%job['N_expected']
+                print('++++ %s%s: %s N_sl=%d in %.1f s -> %s%s'%(
+                    job['shoe'], job['fnum'], job['ifu_type'], job['N_sl'],
+                    job['seconds'], job['aperMap'], flag))
+            else:
+                print('!!!! %s%s failed, see %s'%(job['shoe'], job['fnum'], job['log']))
+
+    n_failed = sum(job['status']!='done' for job in results)
+    print('++++ %d done, %d failed in %.1f s'%(len(results)-n_failed, n_failed,
+                                              time.perf_counter()-t0))
+    sys.exit(1 if n_failed > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+A stand-in for pypeit_trace_edges, e.g., to test run_pypeit without PypeIt:
+
+    IFUM_TRACE_EDGES="python stub_trace_edges.py --nslits 276" python ifum_apermap_maker_GUI.py
+
+It prints some lines, optionally sleeps or fails, and writes
+Masters/MasterEdges_A_1_DET01.fits.gz, Masters/MasterSlits_A_1_DET01.fits.gz
+and {name}.calib in the current folder, as PypeIt does. The slits are
+straight, at the fiber peaks in the middle of the trace file (--nslits
+empty slits if the trace file is not found).
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from astropy.io import fits
+from scipy.signal import find_peaks
+
+from utils_io import write_master_slits
+
+
+def get_data_file(path_pypeitFile):
+    """Get the path of the trace file in the data block of a PypeIt file. """
+    dirname, filename = None, None
+    with open(path_pypeitFile) as f:
+        for line in f:
+            items = line.split()
+            if len(items)==2 and items[0]=='path':
+                dirname = items[1]
+            elif line.startswith('|') and 'trace' in line.split('|')[2]:
+                filename = line.split('|')[1].strip()
+    if dirname is None or filename is None:
+        return None
+    return os.path.join(dirname, filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub of pypeit_trace_edges')
+    parser.add_argument('-f', '--pypeit_file', required=True)
+    parser.add_argument('-s', '--spectrograph', default='magellan_m2fs_blue')
+    parser.add_argument('--nslits', type=int, default=276)
+    parser.add_argument('--sleep', type=float, default=0., help='seconds to run')
+    parser.add_argument('--exit-code', type=int, default=0, help='fail with this code')
+    args = parser.parse_args()
+
+    print('[INFO] :: Stub of pypeit_trace_edges for %s'%args.spectrograph, flush=True)
+    if not os.path.isfile(args.pypeit_file):
+        print('[ERROR] :: %s not found'%args.pypeit_file, file=sys.stderr, flush=True)
+        sys.exit(2)
+    for i in range(10):
+        print('[INFO] :: Tracing edges %d/10'%(i+1), flush=True)
+        time.sleep(args.sleep/10.)
+    if args.exit_code != 0:
+        print('[ERROR] :: Failed on purpose', file=sys.stderr, flush=True)
+        sys.exit(args.exit_code)
+
+    os.makedirs('Masters', exist_ok=True)
+    name = os.path.splitext(os.path.basename(args.pypeit_file))[0]
+    path_slits = os.path.join('Masters', 'MasterSlits_A_1_DET01.fits.gz')
+    path_data = get_data_file(args.pypeit_file)
+    if path_data is not None and os.path.isfile(path_data):
+        #### straight slits at the peaks of the middle columns
+        data = fits.getdata(path_data).astype(np.float32)
+        nspat, nspec = data.shape
+        profile = np.median(data[:, int(nspec*0.45):int(nspec*0.55)], axis=1)
+        peaks, _ = find_peaks(profile, distance=3, prominence=0.1*np.max(profile))
+        aper_half_width = max(1, int(np.median(np.diff(peaks))//2)) if len(peaks)>1 else 2
+        write_master_slits(path_slits, np.float64(peaks)[:, None], aper_half_width, nspat, nspec)
+        nslits = len(peaks)
+    else:
+        hdu_slits = fits.BinTableHDU.from_columns(
+            [fits.Column(name='spat_id', format='J', array=np.arange(args.nslits, dtype=np.int32))])
+        hdu_slits.header['NSLITS'] = args.nslits
+        fits.HDUList([fits.PrimaryHDU(), hdu_slits]).writeto(path_slits, overwrite=True)
+        nslits = args.nslits
+    fits.HDUList([fits.PrimaryHDU()]).writeto(
+        os.path.join('Masters', 'MasterEdges_A_1_DET01.fits.gz'), overwrite=True)
+    with open(name+'.calib', 'w') as f:
+        f.write('# stub\n')
+    print('[INFO] :: Found %d slits'%nslits, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+import argparse
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.ndimage import uniform_filter1d
+
+from utils_io import func_parabola, pack_4fits_simple
+from utils_task import progress
+
+#### geometries of the latest curve params and shapes, see get_geometry;
+#### shared by the Tk main thread and the task threads
+_geometries = {}
+_geometries_lock = threading.Lock()
+N_GEOMETRIES = 8
+
+
+class CurvatureGeometry:
+    """
+    The curve and edges of curve_params [A, B, C, X1, dX] on a frame of shape
+        x(y) = A*(y-B)^2 + C, x1(y) = A*(y-B)^2 + X1, x2(y) = x1(y) + dX
+    Pixels x1 <= x < x2 of a row are inside the edges. The edges are rounded
+    to the nearest pixels ('round', as the trace files are cut) or outwards
+    ('outer', as the AperMaps are trimmed); the masks of the inside pixels
+    are cached bit-packed. Use get_geometry to share one per params.
+    """
+    def __init__(self, curve_params, shape):
+        A, B, C, X1, dX = np.float64(curve_params)
+        self.shape = tuple(shape)
+        self.yy = np.arange(self.shape[0])
+        self.curve = func_parabola(self.yy, A, B, C)
+        self.x1 = func_parabola(self.yy, A, B, X1)
+        self.x2 = func_parabola(self.yy, A, B, X1+dX)
+        self.width = int(dX)
+        self._masks = {}
+
+    def get_bounds(self, rounding='round'):
+        """Get the first and last+1 pixels inside the edges of each row. """
+        if rounding == 'round':
+            lo, hi = np.rint(self.x1), np.rint(self.x2)
+        elif rounding == 'outer':
+            lo, hi = np.floor(self.x1), np.ceil(self.x2)
+        else:
+            raise ValueError('Unknown rounding %s'%rounding)
+        n_x = self.shape[1]
+        return np.clip(lo, 0, n_x).astype(int), np.clip(hi, 0, n_x).astype(int)
+
+    def get_mask(self, rounding='round'):
+        """Get the boolean mask of the pixels inside the edges. """
+        if rounding not in self._masks:
+            lo, hi = self.get_bounds(rounding)
+            xx = np.arange(self.shape[1])
+            mask = (xx[None, :] >= lo[:, None]) & (xx[None, :] < hi[:, None])
+            self._masks[rounding] = np.packbits(mask, axis=1)
+        return np.unpackbits(self._masks[rounding], axis=1, count=self.shape[1]).view(bool)
+
+    def cut(self, data, rounding='round'):
+        """Keep the data inside the edges, zero outside. """
+        return np.where(self.get_mask(rounding), data, data.dtype.type(0))
+
+    def rectify(self, data):
+        """
+        Get the dX pixels from the rounded x1 of each row, i.e., the data
+        between the edges as a rectangle (zero outside of the frame)
+        """
+        x1 = np.rint(self.x1).astype(int)
+        pad_l, pad_r = max(0, -np.min(x1)), max(0, np.max(x1)+self.width-self.shape[1])
+        if pad_l > 0 or pad_r > 0:
+            data = np.pad(data, ((0, 0), (pad_l, pad_r)))
+        windows = sliding_window_view(data, self.width, axis=1)
+        return windows[self.yy, x1+pad_l]
+
+
+def get_geometry(curve_params, shape):
+    """Get the (cached) CurvatureGeometry of curve_params and shape. """
+    key = (tuple(float(p) for p in curve_params[:5]), tuple(shape))
+    with _geometries_lock:
+        geometry = _geometries.get(key)
+        if geometry is None:
+            if len(_geometries) >= N_GEOMETRIES:
+                del _geometries[next(iter(_geometries))]
+            geometry = _geometries[key] = CurvatureGeometry(curve_params, shape)
+    return geometry
+
+
+def detect_block_edges(data, band=16, smooth=9, min_signal=0.2):
+    """
+    Detect the left and right edges of the illuminated fiber block (e.g.,
+    of a flat or twilight frame) in bands of rows of the packed mosaic
+        band: number of rows averaged per band
+        smooth: boxcar width (pixels) along x before the gradient
+        min_signal: bands fainter than min_signal x the brightest band are
+            skipped, e.g., the gaps between fiber groups
+    The edges are the extrema of the gradient along x on either side of the
+    block, refined by a parabola.
+    Returns the y of the bands and the x of the left and right edges.
+    """
+    n_y, n_x = data.shape
+    n_band = n_y // band
+    profiles = np.float32(data[:n_band*band]).reshape(n_band, band, n_x).mean(axis=1)
+    profiles = uniform_filter1d(profiles, smooth, axis=1, mode='nearest')
+    y_band = (np.arange(n_band) + 0.5) * band - 0.5
+
+    #### bright enough bands only
+    level = np.percentile(profiles, 90, axis=1)
+    mask = level > min_signal*np.max(level)
+
+    #### split each band at the middle of its lit part (above half the level)
+    lit = profiles > 0.5*level[:, None]
+    x_first = np.argmax(lit, axis=1)
+    x_last = n_x - 1 - np.argmax(lit[:, ::-1], axis=1)
+    x_mid = (0.5*(x_first+x_last)).astype(int)
+
+    grad = np.gradient(profiles, axis=1)
+    left_side = np.arange(n_x)[None, :] < x_mid[:, None]
+    i_left = np.argmax(np.where(left_side, grad, -np.inf), axis=1)
+    i_right = np.argmax(np.where(left_side, -np.inf, -grad), axis=1)
+    x_left = _refine_extremum(grad, i_left)
+    x_right = _refine_extremum(-grad, i_right)
+
+    #### edges at the borders of the mosaic are not edges
+    mask &= (i_left > 1) & (i_right < n_x-2) & (i_left < i_right)
+    return y_band[mask], x_left[mask], x_right[mask]
+
+
+def _refine_extremum(values, idx):
+    """Refine the argmax idx of each row of values by a parabola. """
+    rows = np.arange(len(values))
+    n = values.shape[1]
+    v0 = values[rows, np.clip(idx-1, 0, n-1)]
+    v1 = values[rows, idx]
+    v2 = values[rows, np.clip(idx+1, 0, n-1)]
+    denom = v0 - 2*v1 + v2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.where(denom < 0, 0.5*(v0-v2)/denom, 0.)
+    return idx + np.clip(delta, -0.5, 0.5)
+
+
+def fit_parabola_clipped(y, x, side=None, n_sigma=3.0, max_iter=10, min_scale=0.05):
+    """
+    Fit x = A*(y-B)^2 + C + dX*side by least squares with iterative sigma
+    clipping (MAD), i.e., one curvature shared by the edges of both sides
+        side: 0 (left edge) or 1 (right edge) of each point; all 0 by default
+        min_scale: lower limit (pixels) of the clipping scale
+    Returns a dict of the params (A, B, C, dX), their 1-sigma errors, the rms
+    of the used points, and the mask of the used points.
+    """
+    y = np.asarray(y, dtype=float)
+    x = np.asarray(x, dtype=float)
+    side = np.zeros(len(y)) if side is None else np.asarray(side, dtype=float)
+    two_sides = np.any(side > 0) and np.any(side == 0)
+
+    #### linear in x = a2*t^2 + a1*t + a0 (+ d*side), with t = y - y_mid
+    y_mid = 0.5*(np.max(y)+np.min(y))
+    t = y - y_mid
+    design = np.stack([t**2, t, np.ones_like(t)] + ([side] if two_sides else []), axis=1)
+
+    mask = np.isfinite(x) & np.isfinite(y)
+    for i in range(max_iter):
+        if np.sum(mask) <= design.shape[1]:
+            raise ValueError('Too few edge points left to fit the curvature')
+        coefs, _, _, _ = np.linalg.lstsq(design[mask], x[mask], rcond=None)
+        res = x - design @ coefs
+        med = np.median(res[mask])
+        scale = max(1.4826*np.median(np.abs(res[mask]-med)), min_scale)
+        mask_new = np.isfinite(res) & (np.abs(res-med) <= n_sigma*scale)
+        if np.array_equal(mask_new, mask):
+            break
+        mask = mask_new
+
+    n_used, n_coef = np.sum(mask), design.shape[1]
+    rms = np.sqrt(np.sum(res[mask]**2) / max(n_used-n_coef, 1))
+    cov = np.linalg.inv(design[mask].T @ design[mask]) * rms**2
+
+    #### vertex form, with errors propagated by the Jacobian
+    a2, a1, a0 = coefs[:3]
+    A = a2
+    B = y_mid - a1/(2*a2)
+    C = a0 - a1**2/(4*a2)
+    jac = np.zeros((4, n_coef))
+    jac[0, 0] = 1.
+    jac[1, :2] = [a1/(2*a2**2), -1./(2*a2)]
+    jac[2, :3] = [a1**2/(4*a2**2), -a1/(2*a2), 1.]
+    if two_sides:
+        jac[3, 3] = 1.
+    errors = np.sqrt(np.diag(jac @ cov @ jac.T))
+
+    return {'A': A, 'B': B, 'C': C, 'dX': coefs[3] if two_sides else np.nan,
+            'err_A': errors[0], 'err_B': errors[1], 'err_C': errors[2],
+            'err_dX': errors[3] if two_sides else np.nan,
+            'rms': rms, 'n_used': int(n_used), 'n_total': len(y), 'mask': mask}
+
+
+def solve_curvature(data, band=16, smooth=9, min_signal=0.2, n_sigma=3.0):
+    """
+    Solve the curvature x = A*(y-B)^2 + C of a packed flat (or twilight)
+    frame from the edges of its illuminated block; C is the left edge
+    Returns the dict of fit_parabola_clipped, plus the edge points (y, x).
+    """
+    progress('Detect edges')
+    y_band, x_left, x_right = detect_block_edges(data, band, smooth, min_signal)
+    y = np.concatenate([y_band, y_band])
+    x = np.concatenate([x_left, x_right])
+    side = np.concatenate([np.zeros(len(y_band)), np.ones(len(y_band))])
+
+    progress('Fit curvature')
+    solution = fit_parabola_clipped(y, x, side, n_sigma)
+    solution.update({'y': y, 'x': x})
+    print('++++ Curvature: A=%.3e+-%.1e B=%.1f+-%.2f C=%.1f+-%.2f (%d/%d points, rms %.2f)'%(
+        solution['A'], solution['err_A'], solution['B'], solution['err_B'],
+        solution['C'], solution['err_C'], solution['n_used'], solution['n_total'],
+        solution['rms']))
+    return solution
+
+
+def rectify_by_curvature(data, A, B, row_step=1):
+    """
+    Shift the rows of data along x by the curvature, so that the curves
+    x = A*(y-B)^2 + C become the columns u = C (linear interpolation)
+        row_step: use every row_step-th row only
+    Returns the rectified rows (NaN outside of data) and their y.
+    """
+    n_y, n_x = data.shape
+    yy = np.arange(0, n_y, row_step)
+    xx = np.arange(n_x)[None, :] + (A*(yy-B)**2)[:, None]
+    i0 = np.floor(xx).astype(int)
+    frac = np.float32(xx - i0)
+    inside = (i0 >= 0) & (i0 < n_x-1)
+    i0 = np.clip(i0, 0, n_x-2)
+    rows = data[yy]
+    v0 = np.take_along_axis(rows, i0, axis=1)
+    v1 = np.take_along_axis(rows, i0+1, axis=1)
+    rect = np.where(inside, v0*(1-frac) + v1*frac, np.nan)
+    return np.float32(rect), yy
+
+
+def detect_edges_along_curve(data, A, B, x1_prior=None, window=100., smooth=5,
+                             min_signal=0.2, row_step=2):
+    """
+    Detect the edges X1 and X2 = X1+dX of the illuminated region, i.e., of
+    x1(y) = A*(y-B)^2 + X1, from the median profile of the bright rows of
+    data rectified by the curvature
+        x1_prior: expected X1 (e.g., of the other shoe plus the b/r offset);
+            X1 is then searched within x1_prior +- window only
+        smooth: boxcar width (pixels) of the profile before the gradient
+        min_signal: rows fainter than min_signal x the brightest row are
+            skipped, e.g., the gaps between fiber groups
+    Returns a dict of X1, X2, dX and the profile.
+    """
+    rect, _ = rectify_by_curvature(data, A, B, row_step)
+    n_x = rect.shape[1]
+
+    #### median profile of the bright rows, each normalized by its level
+    level = np.percentile(np.nan_to_num(rect), 90, axis=1)
+    rows = level > min_signal*np.max(level)
+    if np.sum(rows) == 0:
+        raise ValueError('No illuminated rows to detect the edges')
+    profile = np.median(np.nan_to_num(rect[rows]) / level[rows, None], axis=0)
+    profile = uniform_filter1d(profile, smooth, mode='nearest')
+    grad = np.gradient(profile)
+
+    #### left edge: the steepest rise before the middle of the lit part
+    uu = np.arange(n_x)
+    lit = np.where(profile > 0.5*np.percentile(profile, 90))[0]
+    if len(lit) == 0:
+        raise ValueError('No illuminated columns to detect the edges')
+    u_mid = 0.5*(lit[0]+lit[-1])
+    search = uu < u_mid
+    if x1_prior is not None:
+        search &= np.abs(uu - x1_prior) <= window
+        if not np.any(search):
+            raise ValueError('X1 prior %.0f is out of the frame'%x1_prior)
+    i_left = int(np.argmax(np.where(search, grad, -np.inf)))
+    i_right = int(np.argmax(np.where(uu > max(u_mid, i_left), -grad, -np.inf)))
+    X1 = _refine_extremum(grad[None, :], np.array([i_left]))[0]
+    X2 = _refine_extremum(-grad[None, :], np.array([i_right]))[0]
+    print('++++ Edges: X1=%.1f X2=%.1f dX=%.1f (%d rows)'%(X1, X2, X2-X1, np.sum(rows)))
+    return {'X1': X1, 'X2': X2, 'dX': X2-X1, 'profile': profile}
+
+
+def detect_edges_both(data, curve_params, offset=None, window=100.):
+    """
+    Detect the edges of both shoes; the r-side X1 is searched near the b-side
+    X1 plus offset (X1_r - X1_b), if given
+        data, curve_params: {shoe: packed data}, {shoe: [A, B, ...]}
+    Returns {shoe: dict of detect_edges_along_curve}.
+    """
+    edges = {}
+    for i, shoe in enumerate(['b', 'r']):
+        progress('edges (%s)'%shoe, i, 2)
+        x1_prior = None
+        if shoe == 'r' and offset is not None:
+            x1_prior = edges['b']['X1'] + offset
+        A, B = curve_params[shoe][:2]
+        edges[shoe] = detect_edges_along_curve(data[shoe], A, B, x1_prior, window)
+    return edges
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Solve the curvature (A, B, C) and the edges (X1, dX) of both shoes')
+    parser.add_argument('dir_raw', help='folder of the raw 4-amplifier files')
+    parser.add_argument('fnum', help='frame number of a flat frame, e.g., 0001')
+    parser.add_argument('--fnum-edges', default=None,
+                        help='frame number for the edges, e.g., of a solar/SCI frame (by default, fnum)')
+    parser.add_argument('--band', type=int, default=16, help='rows per band')
+    parser.add_argument('--output', default=None, help='write a curve file, as the GUI saves')
+    args = parser.parse_args()
+
+    fnum_edges = args.fnum if args.fnum_edges is None else args.fnum_edges
+    curve_params, data_edges = {}, {}
+    for shoe in ['b', 'r']:
+        data = pack_4fits_simple(args.fnum, args.dir_raw, shoe)[0]
+        solution = solve_curvature(data, args.band)
+        curve_params[shoe] = [solution['A'], solution['B'], solution['C']]
+        if fnum_edges != args.fnum:
+            data = pack_4fits_simple(fnum_edges, args.dir_raw, shoe)[0]
+        data_edges[shoe] = data
+    edges = detect_edges_both(data_edges, curve_params)
+
+    lines = ["#side A B C X1 dX\n"]
+    for shoe in ['b', 'r']:
+        lines.append("%s %.3e %.1f %.1f %.0f %.0f\n"%(
+            shoe, *curve_params[shoe], edges[shoe]['X1'], edges[shoe]['dX']))
+    print(''.join(lines), end='')
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            file.writelines(lines)
+        print('++++ Saved %s'%args.output)
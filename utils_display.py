@@ -0,0 +1,120 @@
+import numpy as np
+
+
+class DisplayPyramid:
+    """
+    Block-mean levels of a 2D image for display, so that the image panes
+    never draw more pixels than the screen shows
+        factors: block sizes of the levels; 1 is the data itself
+        n_sample: number of pixels of the strided sample for percentiles
+    Levels and statistics are computed on first use and cached.
+    """
+    def __init__(self, data, factors=(1, 2, 4, 8), n_sample=2**18):
+        self.data = data
+        self.factors = sorted(factors)
+        self.ny, self.nx = data.shape
+        self._levels = {1: data}
+        self._stride = max(1, int(np.ceil(np.sqrt(data.size/n_sample))))
+        self._sample = None
+        self._min = None
+
+    def get_level(self, factor):
+        """Get the image binned by factor x factor blocks (mean). """
+        if factor not in self._levels:
+            # each level is made from the previous one, by 2x2 blocks
+            prev = self.get_level(factor//2)
+            ny, nx = prev.shape[0]//2*2, prev.shape[1]//2*2
+            self._levels[factor] = np.float32(prev[:ny, :nx]).reshape(
+                ny//2, 2, nx//2, 2).mean(axis=(1, 3))
+        return self._levels[factor]
+
+    def get_extent(self, factor):
+        """Get the imshow extent of a level in the pixels of the data. """
+        ny, nx = self.get_level(factor).shape
+        return (-0.5, nx*factor-0.5, -0.5, ny*factor-0.5)
+
+    def percentile(self, percent):
+        """Estimate a percentile of the data from a strided sample. """
+        if self._sample is None:
+            self._sample = np.ravel(self.data[::self._stride, ::self._stride])
+        return np.percentile(self._sample, percent)
+
+    def min(self):
+        if self._min is None:
+            self._min = np.min(self.data)
+        return self._min
+
+    def choose_factor(self, xlim, ylim, screen_size):
+        """
+        Choose the largest factor that still has a level pixel per screen
+        pixel in the view
+            screen_size: (width, height) of the axes in screen pixels
+        """
+        ratio = min(abs(xlim[1]-xlim[0])/max(screen_size[0], 1),
+                    abs(ylim[1]-ylim[0])/max(screen_size[1], 1))
+        factor = self.factors[0]
+        for f in self.factors:
+            if f <= ratio:
+                factor = f
+        return factor
+
+    def get_view(self, xlim, ylim, screen_size, margin=0.25):
+        """
+        Get the image and extent to show the view of xlim and ylim; only the
+        tile in view (plus a margin) of the full-resolution data is returned
+        Returns the image, its extent and the factor.
+        """
+        factor = self.choose_factor(xlim, ylim, screen_size)
+        if factor > 1:
+            return self.get_level(factor), self.get_extent(factor), factor
+
+        x0, x1 = sorted(xlim)
+        y0, y1 = sorted(ylim)
+        dx, dy = (x1-x0)*margin, (y1-y0)*margin
+        x0, x1 = max(0, int(np.floor(x0-dx))), min(self.nx, int(np.ceil(x1+dx))+1)
+        y0, y1 = max(0, int(np.floor(y0-dy))), min(self.ny, int(np.ceil(y1+dy))+1)
+        if x1 <= x0 or y1 <= y0:
+            return self.data, self.get_extent(1), 1
+        return self.data[y0:y1, x0:x1], (x0-0.5, x1-0.5, y0-0.5, y1-0.5), 1
+
+
+class BlitManager:
+    """
+    Redraw the animated artists of a canvas over a cached background, so
+    that overlays (e.g., picked points) update without a full draw
+    The background is recaptured at every full draw of the canvas.
+    """
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.artists = []
+        self._bg = None
+        self.cid = canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        self._bg = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self._draw_animated()
+
+    def add_artist(self, artist):
+        artist.set_animated(True)
+        self.artists.append(artist)
+        return artist
+
+    def reset(self):
+        """Forget the artists, e.g., after the figure is cleared. """
+        self.artists = []
+        self._bg = None
+
+    def _draw_animated(self):
+        for artist in self.artists:
+            if artist.figure is not None:
+                self.canvas.figure.draw_artist(artist)
+
+    def update(self):
+        """Blit the artists, or draw the canvas if there is no background yet. """
+        if self._bg is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._bg)
+        self._draw_animated()
+        self.canvas.blit(self.canvas.figure.bbox)
+        self.canvas.flush_events()
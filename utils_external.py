@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import shlex
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from astropy.io import fits
+
+from utils_io import IFUM_UNIT, write_pypeit_file, relocate_pypeit_masters, write_aperMap
+from utils_task import progress
+
+
+def get_tool_command(name, env_var=None):
+    """
+    Get the command line of an external tool as a list; env_var (e.g.,
+    IFUM_TRACE_EDGES) may replace it, e.g., by a stub for tests.
+    """
+    if env_var is not None and os.environ.get(env_var):
+        return shlex.split(os.environ[env_var])
+    return [name]
+
+
+def run_tool(args, cwd=None, timeout=None, on_line=None, poll=0.2):
+    """
+    Run an external tool and stream its output (stdout and stderr merged)
+    line by line to on_line (print by default), e.g., from a background task
+        timeout: seconds before the tool is killed
+    Raises subprocess.TimeoutExpired after the timeout, and
+    subprocess.CalledProcessError on a non-zero exit code. The tool is also
+    killed if the current task is cancelled (see utils_task.progress).
+    Returns the output lines.
+    """
+    if on_line is None:
+        on_line = print
+    name = os.path.basename(args[0])
+    print('++++ Run: %s'%' '.join(args))
+    proc = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True, bufsize=1)
+
+    #### read the output in a thread, so the timeout and cancel are checked
+    lines = []
+    def _read():
+        for line in proc.stdout:
+            line = line.rstrip('\n')
+            lines.append(line)
+            on_line(line)
+    reader = threading.Thread(target=_read, daemon=True)
+    reader.start()
+
+    t0 = time.perf_counter()
+    try:
+        while True:
+            seconds = time.perf_counter() - t0
+            progress('%s (%.0f s)'%(name, seconds))
+            if timeout is not None and seconds > timeout:
+                raise subprocess.TimeoutExpired(args, timeout, output='\n'.join(lines))
+            try:
+                proc.wait(timeout=poll)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        reader.join(timeout=5)
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, output='\n'.join(lines))
+    return lines
+
+
+def run_trace_edges(path_trace, dir_pypeitFile, command=None, timeout=None,
+                    on_line=None, pca='off', smash_range='0.4,0.6'):
+    """
+    Run pypeit_trace_edges on one trace file in its own scratch folder, so
+    that runs never share the default Master files, and move the renamed
+    MasterEdges and MasterSlits to dir_pypeitFile/Masters
+        command: the tool as a list, see get_tool_command
+    Returns the paths of MasterEdges and MasterSlits.
+    """
+    if command is None:
+        command = get_tool_command('pypeit_trace_edges', 'IFUM_TRACE_EDGES')
+    path_trace = os.path.abspath(path_trace)
+    filename = os.path.basename(path_trace)[:-len('.fits')]
+    dir_masters = os.path.join(dir_pypeitFile, 'Masters')
+    os.makedirs(dir_masters, exist_ok=True)
+
+    #### in dir_pypeitFile, so the outputs are moved on the same file system
+    dir_scratch = tempfile.mkdtemp(prefix='scratch_%s_'%filename, dir=dir_pypeitFile)
+    try:
+        path_link = os.path.join(dir_scratch, filename+'.fits')
+        try:
+            os.symlink(path_trace, path_link)
+        except OSError:
+            shutil.copy(path_trace, path_link)
+        write_pypeit_file(dir_scratch, filename, pca, smash_range)
+        dir_run = os.path.join(dir_scratch, 'pypeit_file')
+        run_tool(command + ['-f', os.path.join(dir_run, filename+'.pypeit'),
+                            '-s', 'magellan_m2fs_blue'],
+                 cwd=dir_run, timeout=timeout, on_line=on_line)
+
+        paths = []
+        for path in relocate_pypeit_masters(dir_run, filename):
+            path_new = os.path.join(dir_masters, os.path.basename(path))
+            os.replace(path, path_new)
+            paths.append(path_new)
+        shutil.copy(os.path.join(dir_run, filename+'.pypeit'), dir_pypeitFile)
+    finally:
+        shutil.rmtree(dir_scratch, ignore_errors=True)
+    return paths
+
+
+def trace_edges_job(path_trace, dir_trace, command=None, timeout=None):
+    """
+    Run pypeit_trace_edges on a trace file, and rasterize its MasterSlits
+    with write_aperMap into dir_trace/aperMap; the output is logged to
+    dir_trace/pypeit_file/logs/{name}.log.
+    Returns a dict of the job status, products and timings.
+    """
+    filename = os.path.basename(path_trace)[:-len('.fits')]
+    dir_pypeitFile = os.path.join(dir_trace, 'pypeit_file')
+    dir_logs = os.path.join(dir_pypeitFile, 'logs')
+    os.makedirs(dir_logs, exist_ok=True)
+    path_log = os.path.join(dir_logs, filename+'.log')
+    job = {'trace': path_trace, 'log': path_log, 'status': 'failed'}
+
+    t0 = time.perf_counter()
+    with open(path_log, 'w') as f_log, contextlib.redirect_stdout(f_log), \
+            contextlib.redirect_stderr(f_log):
+        try:
+            path_edges, path_slits = run_trace_edges(path_trace, dir_pypeitFile, command,
+                                                     timeout, on_line=print)
+            job['seconds_tool'] = time.perf_counter() - t0
+
+            #### same names as the AperMaps of the GUI
+            hdr = fits.getheader(path_trace)
+            ifu_type = IFUM_UNIT(hdr['IFU'])
+            config = hdr['CONFIGFL'].replace('Config', 'c').replace('unknown', 'c?')
+            dir_aperMap = os.path.join(dir_trace, 'aperMap')
+            os.makedirs(dir_aperMap, exist_ok=True)
+            file_name = os.path.join(dir_aperMap, 'ap%s_%s_%s_%s_%s_%s_%s'%(
+                filename[0], ifu_type.label, config, filename[1:5], hdr['BINNING'],
+                hdr['SLIDE'], hdr['SLITNAME']))
+            file_date = filename.split('_')[1]
+            write_aperMap(path_slits, ifu_type.label, filename[0], file_name, file_date,
+                          ifu_type.Nx, ifu_type.Ny, False, '', '', False, [])
+
+            job.update({'status': 'done', 'MasterSlits': path_slits,
+                        'N_sl': int(fits.getheader(path_slits, 1)['NSLITS']),
+                        'N_expected': ifu_type.Ntotal//2,
+                        'aperMap': file_name+'_'+file_date+'.fits'})
+        except Exception:
+            traceback.print_exc()
+    job['seconds'] = time.perf_counter() - t0
+    return job
+
+
+def run_trace_edges_batch(paths_trace, dir_trace, max_workers=2, command=None, timeout=None):
+    """
+    Run trace_edges_job on many trace files, at most max_workers at once
+    Returns the job dicts in the order of completion.
+    """
+    jobs = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(trace_edges_job, os.path.abspath(path), 
+                                   os.path.abspath(dir_trace), command, timeout)
+                   for path in paths_trace]
+        for future in as_completed(futures):
+            job = future.result()
+            jobs.append(job)
+            if job['status']=='done':
+                print('++++ %s: N_sl=%d in %.1f s -> %s'%(os.path.basename(job['trace']),
+                      job['N_sl'], job['seconds'], job['aperMap']))
+            else:
+                print('!!!! %s failed, see %s'%(os.path.basename(job['trace']), job['log']))
+    return jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run pypeit_trace_edges on trace files in parallel, and make their AperMaps')
+    parser.add_argument('paths_trace', nargs='+', help='trace files, e.g., data_trace/b*_trace.fits')
+    parser.add_argument('--dir-trace', default=None,
+                        help='output folder (by default, that of the first trace file)')
+    parser.add_argument('--workers', type=int, default=2, help='number of runs at once')
+    parser.add_argument('--timeout', type=float, default=3600.)
+    args = parser.parse_args()
+
+    dir_trace = args.dir_trace or os.path.dirname(os.path.abspath(args.paths_trace[0]))
+    jobs = run_trace_edges_batch(args.paths_trace, dir_trace, args.workers, timeout=args.timeout)
+    n_failed = sum(job['status']!='done' for job in jobs)
+    print('++++ %d done, %d failed'%(len(jobs)-n_failed, n_failed))
+    sys.exit(1 if n_failed > 0 else 0)
@@ -0,0 +1,193 @@
+import numpy as np
+import numpy.polynomial.chebyshev as cheb
+from scipy import sparse
+from scipy.sparse.linalg import lsqr
+from scipy.special import comb
+
+
+def _get_cheb2poly_matrix(order):
+    """Get the matrix converting Chebyshev to power series coefficients. """
+    matrix = np.zeros((order+1, order+1))
+    for k in range(order+1):
+        coefs_k = cheb.cheb2poly(np.eye(order+1)[k])
+        matrix[:len(coefs_k), k] = coefs_k
+    return matrix
+
+
+def _unscale_poly_coefs(coefs_t, x_mid, x_half):
+    """
+    Convert power series coefficients in t = (x-x_mid)/x_half to those in x
+        coefs_t: (n_fit, order+1)
+        x_mid, x_half: (n_fit,)
+    """
+    order = coefs_t.shape[1]-1
+    coefs_x = np.zeros_like(coefs_t)
+    for k in range(order+1):
+        a_k = coefs_t[:, k] / x_half**k
+        for j in range(k+1):
+            coefs_x[:, j] += a_k * comb(k, j) * (-x_mid)**(k-j)
+    return coefs_x
+
+
+def polyfit_batch(x, y, order, mask=None):
+    """
+    Fit polynomials to many data sets at once by masked least squares
+        x: (n_fit, n_sample), or (n_sample,) if shared by all fits
+        y: (n_fit, n_sample)
+        mask: samples to use; by default, where both x and y are finite
+    The fits are solved together by the normal equations in a Chebyshev
+    basis of x normalized to [-1, 1] for each fit. Returns the power series
+    coefficients in the raw x (n_fit, order+1), as poly.polyfit, and the
+    residual rms of each fit (n_fit,). Fits without samples are NaN.
+    """
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    x = np.broadcast_to(np.asarray(x, dtype=float), y.shape)
+    if mask is None:
+        mask = np.isfinite(x) & np.isfinite(y)
+    else:
+        mask = np.asarray(mask, dtype=bool) & np.isfinite(x) & np.isfinite(y)
+    w = mask.astype(float)
+    n_used = np.sum(w, axis=1)
+
+    # normalize x of each fit to [-1, 1] by its used samples
+    x_min = np.min(np.where(mask, x, np.inf), axis=1)
+    x_max = np.max(np.where(mask, x, -np.inf), axis=1)
+    x_min[n_used == 0], x_max[n_used == 0] = 0., 0.
+    x_mid = np.where(n_used > 0, 0.5*(x_max+x_min), 0.)
+    x_half = np.where(n_used > 0, 0.5*(x_max-x_min), 1.)
+    x_half[x_half <= 0] = 1.
+    t = np.where(mask, (x - x_mid[:, None]) / x_half[:, None], 0.)
+    y0 = np.where(mask, y, 0.)
+
+    # grouped normal equations, (n_fit, order+1, order+1)
+    vander = cheb.chebvander(t, order)
+    vander_w = vander * w[:, :, None]
+    lhs = np.einsum('fsi,fsj->fij', vander_w, vander)
+    rhs = np.einsum('fsi,fs->fi', vander_w, y0)
+    coefs_cheb = np.einsum('fij,fj->fi', np.linalg.pinv(lhs), rhs)
+
+    # residual rms
+    res = np.einsum('fsi,fi->fs', vander, coefs_cheb) - y0
+    rms = np.sqrt(np.sum(w * res**2, axis=1) / np.maximum(n_used, 1))
+
+    # back to the power series in the raw x
+    coefs_t = coefs_cheb @ _get_cheb2poly_matrix(order).T
+    coefs = _unscale_poly_coefs(coefs_t, x_mid, x_half)
+
+    coefs[n_used == 0] = np.nan
+    rms[n_used == 0] = np.nan
+
+    return coefs, rms
+
+
+class TraceSurface:
+    """
+    Global model of the traces y(fiber, x) over all fibers and columns
+        y = offset[fiber] + sum_{i, j>=1} c_ij T_i(u) T_j(t)
+    where T are Chebyshev polynomials, and u, t are the fiber index and x
+    normalized to [-1, 1]. Each fiber has its own offset, and the shape of
+    the traces varies smoothly across the fibers.
+    """
+    def __init__(self, n_fiber, order_x=4, order_fiber=4):
+        self.n_fiber = n_fiber
+        self.order_x = order_x
+        self.order_fiber = order_fiber
+        self.offsets = None
+        self.coefs = None
+        self.x_mid, self.x_half = 0., 1.
+
+    def _get_u(self, fiber):
+        return 2.*np.asarray(fiber, dtype=float)/np.max([self.n_fiber-1, 1]) - 1.
+
+    def _get_t(self, x):
+        return (np.asarray(x, dtype=float) - self.x_mid) / self.x_half
+
+    def _get_shape_vander(self, fiber, x):
+        """Get the design matrix of the shape term, (n_sample, n_coef). """
+        vander_u = cheb.chebvander(self._get_u(fiber), self.order_fiber)
+        vander_t = cheb.chebvander(self._get_t(x), self.order_x)[:, 1:]
+        return (vander_u[:, :, None] * vander_t[:, None, :]).reshape(len(vander_u), -1)
+
+    def fit(self, fiber, x, y, fiber_pos=None, n_iter=5, c_tukey=4.685):
+        """
+        Fit the surface to all peaks in a single sparse least-squares solve
+        with robust iterative reweighting (Tukey biweight)
+            fiber, x, y: 1d arrays of the fiber index and position of peaks
+            fiber_pos: rough positions of all fibers, used to interpolate
+                offsets of fibers without any peaks; the index by default
+        """
+        fiber = np.asarray(fiber, dtype=int)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        n_sample = len(y)
+        self.x_mid = 0.5*(np.max(x)+np.min(x))
+        self.x_half = np.max([0.5*(np.max(x)-np.min(x)), 1.])
+
+        # subtract a reference level of each fiber for a better conditioning
+        mask_fit = np.bincount(fiber, minlength=self.n_fiber) > 0
+        y_ref = np.zeros(self.n_fiber)
+        for f in np.where(mask_fit)[0]:
+            y_ref[f] = np.median(y[fiber==f])
+        y_rel = y - y_ref[fiber]
+
+        # design matrix: one-hot offsets and the shape term
+        design = sparse.hstack([
+            sparse.csr_matrix((np.ones(n_sample), (np.arange(n_sample), fiber)),
+                              shape=(n_sample, self.n_fiber)),
+            sparse.csr_matrix(self._get_shape_vander(fiber, x))]).tocsr()
+
+        weights = np.ones(n_sample)
+        for i in range(n_iter):
+            sqrt_w = np.sqrt(weights)
+            solution = lsqr(sparse.diags(sqrt_w) @ design, sqrt_w * y_rel,
+                            atol=1e-12, btol=1e-12)[0]
+            residuals = y_rel - design @ solution
+
+            # tukey biweight by the MAD of the residuals
+            scale = 1.4826 * np.median(np.abs(residuals[weights > 0]))
+            if scale <= 0:
+                break
+            r = residuals / (c_tukey * scale)
+            weights_new = np.where(np.abs(r) < 1, (1 - r**2)**2, 0.)
+            if np.allclose(weights_new, weights, atol=1e-3):
+                break
+            weights = weights_new
+        self.weights = weights
+
+        self.coefs = solution[self.n_fiber:].reshape(self.order_fiber+1, self.order_x)
+        offsets = solution[:self.n_fiber] + y_ref
+
+        # fibers without peaks are constrained by their neighbours
+        if np.any(~mask_fit):
+            if fiber_pos is None:
+                fiber_pos = np.arange(self.n_fiber)
+            fiber_pos = np.asarray(fiber_pos, dtype=float)
+            offsets[~mask_fit] = fiber_pos[~mask_fit] + np.interp(
+                fiber_pos[~mask_fit], fiber_pos[mask_fit], 
+                offsets[mask_fit] - fiber_pos[mask_fit])
+        self.offsets = offsets
+
+        return self
+
+    def __call__(self, fiber, x):
+        """Evaluate the surface at any (fractional) fiber index and x. """
+        fiber, x = np.broadcast_arrays(np.asarray(fiber, dtype=float), 
+                                       np.asarray(x, dtype=float))
+        offsets = np.interp(fiber.ravel(), np.arange(self.n_fiber), self.offsets)
+        shape = self._get_shape_vander(fiber.ravel(), x.ravel()) @ self.coefs.ravel()
+        return (offsets + shape).reshape(fiber.shape)
+
+    def get_poly_coefs(self, fibers=None):
+        """
+        Get the power series coefficients in the raw x of each fiber, as
+        poly.polyfit, (n, order_x+1)
+        """
+        if fibers is None:
+            fibers = np.arange(self.n_fiber)
+        fibers = np.atleast_1d(np.asarray(fibers, dtype=float))
+        coefs_cheb = np.zeros((len(fibers), self.order_x+1))
+        coefs_cheb[:, 0] = np.interp(fibers, np.arange(self.n_fiber), self.offsets)
+        coefs_cheb[:, 1:] = cheb.chebvander(self._get_u(fibers), self.order_fiber) @ self.coefs
+        coefs_t = coefs_cheb @ _get_cheb2poly_matrix(self.order_x).T
+        return _unscale_poly_coefs(coefs_t, np.full(len(fibers), self.x_mid),
+                                   np.full(len(fibers), self.x_half))
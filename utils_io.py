@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import os
 import numpy as np
+import numpy.polynomial.polynomial as poly
 from datetime import datetime
 
 from astropy.io import fits
@@ -422,6 +423,44 @@ def write_aperMap(path_MasterSlits, IFU_type, Channel, file_name, file_date, N_x
     hdu_map.writeto(file_name+'_'+file_date+'.fits',overwrite=True)
 
 
+def write_master_slits(path, traces_coefs, aper_half_width, nspat, nspec):
+    """Write a MasterSlits-like file of the traces, the input of write_aperMap. """
+    xx = np.arange(nspec)
+    y_traces = poly.polyval(xx, traces_coefs.T)
+    n_sl = len(traces_coefs)
+    cols = [fits.Column(name='spat_id', format='J',
+                        array=np.int32(np.round(y_traces[:, nspec//2]))),
+            fits.Column(name='left_init', format='%dD'%nspec,
+                        array=y_traces - aper_half_width),
+            fits.Column(name='right_init', format='%dD'%nspec,
+                        array=y_traces + aper_half_width)]
+    hdu = fits.BinTableHDU.from_columns(cols)
+    hdu.header['NSLITS'] = n_sl
+    hdu.header['NSPEC'] = nspec
+    hdu.header['NSPAT'] = nspat
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, overwrite=True)
+
+
+def write_weightmap(path, start, weights, aper_half_width):
+    """
+    Write the fractional aperture weights of create_weightmap next to an
+    AperMap; the weights are stored as uint8 in steps of 1/255.
+    """
+    hdu = fits.PrimaryHDU()
+    hdu.header['NSLITS'] = (len(start), 'number of slits')
+    hdu.header['APHW'] = (aper_half_width, 'aperture half width')
+    hdu_start = fits.ImageHDU(np.int16(start), name='START')
+    hdu_weights = fits.ImageHDU(np.float32(weights), name='WEIGHTS')
+    hdu_weights.scale('uint8', bscale=1/255., bzero=0.)
+    fits.HDUList([hdu, hdu_start, hdu_weights]).writeto(path, overwrite=True)
+
+
+def load_weightmap(path):
+    """Load the start rows and weights written by write_weightmap. """
+    with fits.open(path) as hdul:
+        return hdul['START'].data, hdul['WEIGHTS'].data
+
+
 def write_pypeit_file(dirname, filename, pca='off', smash_range="0.4,0.6"):
     dirname_output = os.path.join(dirname, 'pypeit_file')
     filename_output = filename+'.pypeit'
@@ -457,6 +496,27 @@ def write_pypeit_file(dirname, filename, pca='off', smash_range="0.4,0.6"):
     file.close()
 
 
+def relocate_pypeit_masters(dir_pypeitFile, filename):
+    """
+    Rename the Master files of a pypeit_trace_edges run after the trace file,
+    and remove its .calib file. Returns the paths of MasterEdges and MasterSlits.
+    """
+    dir_masters = os.path.join(dir_pypeitFile, 'Masters')
+    paths = []
+    for kind in ['Edges', 'Slits']:
+        path_default = os.path.join(dir_masters, 'Master%s_A_1_DET01.fits.gz'%kind)
+        path_new = os.path.join(dir_masters, 'Master%s_%s.fits.gz'%(kind, filename))
+        if not os.path.isfile(path_default):
+            raise FileNotFoundError('PypeIt did not write %s'%path_default)
+        os.replace(path_default, path_new)
+        paths.append(path_new)
+
+    path_calib = os.path.join(dir_pypeitFile, filename+'.calib')
+    if os.path.isfile(path_calib):
+        os.remove(path_calib)
+    return paths
+
+
 def write_trace_file(data, header, dirname, filename):
     #### write to a fits file
     X2 = len(data[0])/2
@@ -520,3 +580,52 @@ def cut_apermap(data, header, dirname, filename):
     today_temp = datetime.today().strftime("%y%m%d")
     path_trace = os.path.join(dirname, filename+'_%s.fits'%today_temp)
     hdul_full.writeto(path_trace,overwrite=True)
+
+
+def load_trace_coefs(path_coefs):
+    """
+    Load a trace coefs file made by run_trace
+    Returns the coefs (n_aper, order+1) and aper_half_width (None if absent)
+    """
+    aper_half_width = None
+    with open(path_coefs) as f:
+        line = f.readline()
+    if 'aper_half_width' in line:
+        aper_half_width = int(line.split('=')[1])
+    trace_coefs = np.atleast_2d(np.loadtxt(path_coefs, delimiter=','))
+
+    return trace_coefs, aper_half_width
+
+
+def find_prior_trace_coefs(dirnames, shoe, ifu_type, config, binning, exclude=None):
+    """
+    Find the latest trace coefs file made with the same shoe/IFU/config/binning
+        dirnames: folders of trace files, each may have an aperMap folder
+        exclude: path of a coefs file to skip, e.g., the one to be made
+    The matching is done by the AperMap file names,
+    ap{shoe}_{IFU}_{config}_{fnum}_{binning}_{slide}_{slitname}_{yymmdd}.fits
+    Returns the path of the coefs file, or None if not found.
+    """
+    candidates = []
+    for dirname in dirnames:
+        dir_aperMap = os.path.join(dirname, 'aperMap')
+        if not os.path.isdir(dir_aperMap):
+            continue
+        for file_aperMap in os.listdir(dir_aperMap):
+            if not (file_aperMap.startswith('ap') and file_aperMap.endswith('.fits')):
+                continue
+            items = file_aperMap[2:-5].split('_')
+            if len(items) < 6 or items[0] != shoe or items[1] != ifu_type \
+                or items[2] != config or items[4] != binning:
+                continue
+            path_coefs = os.path.join(dir_aperMap, 'trace_coefs', 
+                                      '%s%s_coefs.txt'%(shoe, items[3]))
+            if not os.path.isfile(path_coefs):
+                continue
+            if exclude is not None and os.path.abspath(path_coefs)==os.path.abspath(exclude):
+                continue
+            candidates.append((items[-1], os.path.getmtime(path_coefs), path_coefs))
+
+    if len(candidates)==0:
+        return None
+    return sorted(candidates)[-1][2]
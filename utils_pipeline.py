@@ -0,0 +1,350 @@
+import os
+import time
+import traceback
+import numpy as np
+from datetime import datetime
+
+from astropy.io import fits
+
+from utils_io import IFUM_UNIT, pack_4fits_simple, write_trace_file, load_trace_coefs, write_weightmap
+from utils_trace import make_trace, reshape_trace_by_curvature, do_trace_v3, do_trace_warm, create_apermap, create_weightmap
+from utils_curve import get_geometry
+from utils_profile import stage, start_report
+from utils_task import progress
+
+#### IFU types that can be told apart by the number of slits
+IFU_TYPES = [IFUM_UNIT('LSB'), IFUM_UNIT('STD'), IFUM_UNIT('HR')]
+
+
+def read_curve_file(path_curve):
+    """
+    Read a curve file saved by the GUI (#side A B C X1 dX)
+    Returns {shoe: curve_params [A, B, C, X1, dX]}.
+    """
+    #### skip the header explicitly, as np.loadtxt warns about it
+    curve_params = {}
+    with open(path_curve) as f:
+        for line in f:
+            row = line.split()
+            if len(row)==0 or row[0].startswith('#'):
+                continue
+            curve_params[row[0]] = np.array(row[1:6], dtype=np.float64)
+    return curve_params
+
+
+def list_frames(dir_raw):
+    """List the frame numbers of the b-side raw files in dir_raw. """
+    fnames = [f[1:5] for f in os.listdir(dir_raw)
+              if os.path.isfile(os.path.join(dir_raw, f))
+              and f.lower().endswith('c1.fits') and f.lower().startswith('b')]
+    return sorted(fnames)
+
+
+def get_header_info(hdr_tmp):
+    """Get the IFU, binning, config, slide and slit name from a fits header. """
+    config = hdr_tmp['CONFIGFL'].replace('Config', 'c').replace('unknown', 'c?')
+    return {'ifu_type': hdr_tmp['IFU'], 'binning': hdr_tmp['BINNING'],
+            'config': config, 'slide': hdr_tmp['SLIDE'],
+            'slitname': hdr_tmp['SLITNAME']}
+
+
+def get_ifu_type(N_sl):
+    """Get the IFU whose number of slits per shoe is closest to N_sl. """
+    Nslits_IFU = np.array([ifu.Ntotal/2 for ifu in IFU_TYPES])
+    return IFU_TYPES[int(np.argmin(np.abs(Nslits_IFU-N_sl)))]
+
+
+def cut_data_by_edges(data_raw, curve_params):
+    """Keep the data between the two parabolic edges X1 and X1+dX. """
+    return get_geometry(curve_params, data_raw.shape).cut(data_raw)
+
+
+def trace_data(trace, curve_params, shoe, ifu_type, bin_y, path_prior=None,
+               verbose=True, plot=True, headless=False, fig_dir=None):
+    """
+    Trace the data cut by the edges, see load_trace or make_trace
+        path_prior: trace coefs of a previous night for a warm start; falls
+            back to tracing from scratch if they do not match
+    Returns a dict of the trace solution.
+    """
+    data_reshaped = reshape_trace_by_curvature(trace, curve_params)
+
+    if path_prior is not None:
+        print('++++ Warm start from %s'%path_prior)
+        prior_coefs, prior_aper_half_width = load_trace_coefs(path_prior)
+        try:
+            trace_array, trace_coefs, N_sl, aper_half_width, _ = do_trace_warm(
+                data_reshaped, curve_params, prior_coefs,
+                prior_aper_half_width, verbose=verbose)
+        except ValueError as e:
+            print('!!! Warning: %s Trace from scratch. !!!'%e)
+            path_prior = None
+    if path_prior is None:
+        trace_array, trace_coefs, N_sl, aper_half_width, _ = do_trace_v3(
+            data_reshaped, curve_params,
+            shoe, ifu_type, bin_y, verbose=verbose, plot=plot,
+            headless=headless, fig_dir=fig_dir)
+
+    return {'trace_coefs': trace_coefs, 'N_sl': N_sl,
+            'aper_half_width': aper_half_width, 'warm_start': path_prior}
+
+
+def check_N_slits(ifu_type, N_sl):
+    """Print a warning if N_sl is not the number of fibers of the IFU. """
+    N_ap = np.int32(ifu_type.Ntotal/2)
+    if N_ap>N_sl:
+        print('!!! Warning: Missing %d fiber(s). Expected to find %d fibers !!!'%(N_ap-N_sl, N_ap))
+    elif N_ap<N_sl:
+        print('!!! Warning: Found %d more fiber(s). Expected to find %d fibers. !!!'%(N_sl-N_ap, N_ap))
+    else:
+        print('Found all %d fibers.'%N_ap)
+    return N_ap
+
+
+def write_trace_products(dir_trace, filename, shoe, fnum, hdr_info, ifu_type,
+                         curve_params, map_ap, y_middle, trace_coefs,
+                         aper_half_width, N_sl):
+    """
+    Write the AperMap, slits and trace coefs files of a traced shoe
+        filename: name of the trace file without .fits, e.g., b0001_250101_trace
+        hdr_info: see get_header_info, of the raw frame
+    Returns the paths of the AperMap, slits and trace coefs files.
+    """
+    N_ap = check_N_slits(ifu_type, N_sl)
+
+    # find the maximum number of pixels in all slits
+    num_ap = np.bincount(map_ap.ravel().astype(np.int64), minlength=N_ap+1)[1:N_ap+1]
+    num_max = np.max(num_ap)
+
+    #### save AperMap
+    #### the following header params may require modifying
+    hdu_map = fits.PrimaryHDU(map_ap)
+    hdr_map = hdu_map.header
+    hdr_map['IFUTYPE'] = (ifu_type.label, 'type of IFU')
+    hdr_map['NIFU1'] = (ifu_type.Nx, 'number of IFU columns')
+    hdr_map['NIFU2'] = (ifu_type.Ny, 'number of IFU rows')
+    hdr_map['NSLITS'] = (N_sl, 'number of slits')
+    hdr_map['NMAX'] = (num_max, 'maximum number of pixels among all apertures')
+    hdr_map['BINNING'] = ('1x1', 'binning')
+
+    ## record curve params in header
+    hdr_map['CURVE_A'] = (curve_params[0], 'curve parameter A')
+    hdr_map['CURVE_B'] = (curve_params[1], 'curve parameter B')
+    hdr_map['CURVE_C'] = (curve_params[2], 'curve parameter C')
+    hdr_map['CURVE_X1'] = (curve_params[3], 'starting X position of edges')
+    hdr_map['CURVE_DX'] = (curve_params[4], 'length of edges along X axis')
+
+    dir_aperMap = os.path.join(dir_trace, 'aperMap')
+    os.makedirs(dir_aperMap, exist_ok=True)
+
+    today_temp = datetime.today().strftime("%y%m%d")
+    file_aperMap = 'ap%s_%s_%s_%s_%s_%s_%s_%s.fits'%(
+        shoe,
+        ifu_type.label,
+        hdr_info['config'],
+        fnum[0:4],
+        hdr_info['binning'],
+        hdr_info['slide'],
+        hdr_info['slitname'],
+        today_temp)
+
+    path_aperMap = os.path.join(dir_aperMap, file_aperMap)
+    with stage('write_aperMap'):
+        hdu_map.writeto(path_aperMap,overwrite=True)
+
+    #### save slits file
+    dir_slits = os.path.join(dir_aperMap, 'slits')
+    os.makedirs(dir_slits, exist_ok=True)
+    file_slits = filename.split('_')[0]+'_slits.txt'
+    path_slits = os.path.join(dir_slits, file_slits)
+    with stage('write_slits'):
+        np.savetxt(path_slits, y_middle, fmt='%d', delimiter=' ', header='# y_pos (x=middle)', comments='')
+
+    #### save the trace coefs
+    dir_coefs = os.path.join(dir_aperMap, 'trace_coefs')
+    os.makedirs(dir_coefs, exist_ok=True)
+    file_coefs = filename.split('_')[0]+'_coefs.txt'
+    path_coefs = os.path.join(dir_coefs, file_coefs)
+    with stage('write_coefs'):
+        np.savetxt(path_coefs, trace_coefs, fmt='%.6e', delimiter=',', header='# a b c', comments='# aper_half_width = %d\n'%aper_half_width)
+
+    return path_aperMap, path_slits, path_coefs
+
+
+class Pipeline:
+    """
+    Stages of making the AperMaps of one frame, handing over artifacts in
+    memory, by shoe:
+        pack -> cut_by_edges -> trace -> make_apermap
+        packed (float32 mosaic), cut (float32), solution (trace coefs),
+        apermap (AperMap and y_middle)
+    Writing the trace files and products to dir_trace is a side effect
+    (save=False to skip); later stages never read them back. With
+    weights=True, the fractional aperture weights (see create_weightmap)
+    are made and written along with each AperMap.
+    """
+    def __init__(self, dir_raw=None, dir_trace=None, save=True, weights=False):
+        self.dir_raw = dir_raw
+        self.dir_trace = dir_trace
+        self.save = save
+        self.weights = weights
+        self.reset()
+
+    def reset(self, fnum=None):
+        """Drop all artifacts and start a new frame. """
+        self.fnum = fnum
+        self.headers = {}
+        self.curve_params = {}
+        self.packed = {}
+        self.cut = {}
+        self.solution = {}
+        self.apermap = {}
+        self.paths = {}
+
+    def get_header_info(self, shoe):
+        return get_header_info(self.headers[shoe])
+
+    def pack(self, fnum, shoes=('b', 'r')):
+        """Pack the 4 amplifiers of each shoe. """
+        self.reset(fnum)
+        with stage('pack'):
+            for i, shoe in enumerate(shoes):
+                progress('packing %s%s'%(shoe, fnum), i, len(shoes))
+                self.packed[shoe], self.headers[shoe] = pack_4fits_simple(fnum, self.dir_raw, shoe)
+        return self.packed
+
+    def cut_by_edges(self, shoe, curve_params):
+        """Cut the packed data by the edges, and write the trace file. """
+        self.curve_params[shoe] = np.asarray(curve_params, dtype=np.float64)
+        progress('cutting %s%s'%(shoe, self.fnum))
+        with stage('cut'):
+            self.cut[shoe] = cut_data_by_edges(self.packed[shoe], self.curve_params[shoe])
+        self.paths[shoe] = {}
+        if self.save:
+            progress('writing the %s-side trace file'%shoe)
+            with stage('write_trace'):
+                self.paths[shoe]['trace'] = os.path.abspath(write_trace_file(
+                    self.cut[shoe], self.headers[shoe], self.dir_trace, shoe+self.fnum))
+        return self.cut[shoe]
+
+    def load_trace_file(self, path_trace):
+        """
+        Load a trace file {shoe}{fnum}_*_trace.fits as the cut data of its
+        shoe; nothing is read if the cut data were written to that file.
+        Returns the shoe.
+        """
+        fname = os.path.basename(path_trace)
+        shoe, fnum = fname[0], fname[1:5]
+        if self.paths.get(shoe, {}).get('trace')==os.path.abspath(path_trace) \
+                and shoe in self.cut:
+            return shoe
+        if fnum!=self.fnum:
+            self.reset(fnum)
+        with fits.open(path_trace) as hdul:
+            self.cut[shoe] = np.float32(hdul[0].data)
+            self.headers[shoe] = hdul[0].header.copy()
+        self.packed.pop(shoe, None)
+        self.solution.pop(shoe, None)
+        self.apermap.pop(shoe, None)
+        self.paths[shoe] = {'trace': os.path.abspath(path_trace)}
+        return shoe
+
+    def trace(self, shoe, curve_params=None, path_prior=None, **kwargs):
+        """Trace the cut data of a shoe, see trace_data for kwargs. """
+        if curve_params is not None:
+            self.curve_params[shoe] = np.asarray(curve_params, dtype=np.float64)
+        progress('tracing %s%s'%(shoe, self.fnum))
+        trace, ifu_type, bin_y = make_trace(self.cut[shoe], self.headers[shoe])
+        self.solution[shoe] = trace_data(trace, self.curve_params[shoe], shoe,
+                                         ifu_type, bin_y, path_prior=path_prior, **kwargs)
+        return self.solution[shoe]
+
+    def make_apermap(self, shoe, ifu_type=None, hdr_info=None):
+        """
+        Make the AperMap of a shoe from its trace solution, and write the
+        AperMap, slits and trace coefs files
+            ifu_type: IFUM_UNIT; by default, guessed from the number of slits
+            hdr_info: names of the products, see get_header_info; by default,
+                from the header of the shoe
+        """
+        solution = self.solution[shoe]
+        map_ap, y_middle = create_apermap(self.cut[shoe].shape, self.curve_params[shoe],
+                                          solution['trace_coefs'], solution['aper_half_width'])
+        if ifu_type is None:
+            ifu_type = get_ifu_type(solution['N_sl'])
+        self.apermap[shoe] = {'map_ap': map_ap, 'y_middle': y_middle, 'ifu_type': ifu_type}
+        if self.weights:
+            progress('weights of the %s-side apertures'%shoe)
+            with stage('weightmap'):
+                self.apermap[shoe]['start'], self.apermap[shoe]['weights'] = create_weightmap(
+                    map_ap.shape, self.curve_params[shoe], solution['trace_coefs'],
+                    solution['aper_half_width'])
+
+        if self.save:
+            progress('writing the %s-side AperMap'%shoe)
+            if hdr_info is None:
+                hdr_info = self.get_header_info(shoe)
+            path_aperMap, path_slits, path_coefs = write_trace_products(
+                self.dir_trace, shoe+self.fnum, shoe, self.fnum, hdr_info,
+                ifu_type, self.curve_params[shoe], map_ap, y_middle,
+                solution['trace_coefs'], solution['aper_half_width'], solution['N_sl'])
+            self.paths[shoe].update({'aperMap': path_aperMap, 'slits': path_slits,
+                                     'coefs': path_coefs})
+            if self.weights:
+                path_weights = path_aperMap.replace('.fits', '_weights.fits')
+                with stage('write_weightmap'):
+                    write_weightmap(path_weights, self.apermap[shoe]['start'],
+                                    self.apermap[shoe]['weights'], solution['aper_half_width'])
+                self.paths[shoe]['weights'] = path_weights
+        return self.apermap[shoe]
+
+    def run(self, fnum, curve_params, shoes=('b', 'r'), path_priors=None, **kwargs):
+        """
+        Run all stages of a frame
+            curve_params: {shoe: [A, B, C, X1, dX]}, see read_curve_file
+            path_priors: {shoe: path of prior trace coefs} for warm starts
+        """
+        if path_priors is None:
+            path_priors = {}
+        self.pack(fnum, shoes)
+        for shoe in shoes:
+            self.cut_by_edges(shoe, curve_params[shoe])
+            del self.packed[shoe]
+            self.trace(shoe, path_prior=path_priors.get(shoe), **kwargs)
+            self.make_apermap(shoe)
+        return self.apermap
+
+
+def trace_file_job(path_trace, curve_params, dir_trace, hdr_info=None, path_prior=None):
+    """
+    Trace a trace file headless and write its AperMap products, e.g., in a
+    worker process; the run report is saved next to the AperMap.
+    Returns a dict of the shoe, trace solution, AperMap, paths and timings.
+    """
+    t0 = time.perf_counter()
+    pipeline = Pipeline(dir_trace=dir_trace)
+    shoe = pipeline.load_trace_file(path_trace)
+    report = start_report(os.path.basename(path_trace).split('_')[0])
+    solution = pipeline.trace(shoe, curve_params, path_prior=path_prior, headless=True)
+    apermap = pipeline.make_apermap(shoe, hdr_info=hdr_info)
+    path_aperMap = pipeline.paths[shoe]['aperMap']
+
+    report.info.update({'shoe': shoe, 'ifu_type': apermap['ifu_type'].label,
+                        'N_sl': int(solution['N_sl']), 'warm_start': solution['warm_start'],
+                        'aperMap': path_aperMap})
+    report.write_json(path_aperMap.replace('.fits', '_report.json'))
+    start_report(enabled=False)
+    return {'shoe': shoe, 'fnum': pipeline.fnum, 'solution': solution, 'apermap': apermap,
+            'paths': pipeline.paths[shoe], 'seconds': time.perf_counter()-t0,
+            'summary': report.summary()}
+
+
+def trace_file_worker(results, shoe, *args):
+    """
+    Run trace_file_job(*args) in a worker process, and put (shoe, job, None)
+    on the results queue, or (shoe, None, traceback) if it failed.
+    """
+    try:
+        results.put((shoe, trace_file_job(*args), None))
+    except Exception:
+        results.put((shoe, None, traceback.format_exc()))
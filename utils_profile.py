@@ -0,0 +1,259 @@
+import os
+import gc
+import sys
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+_NULL_STAGE = nullcontext()
+
+
+def get_rss_mb():
+    """Get the current resident set size (MB), or None if unavailable. """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+def get_max_rss_mb():
+    """Get the high-water mark of the resident set size (MB), or None. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+
+def get_largest_arrays(n=5, min_mb=1.):
+    """
+    Get the largest live numpy arrays, with the names they are held by
+    Arrays are found in dicts (e.g., globals), object attributes, lists and
+    tuples, and the local variables of running frames; views count as 
+    their base.
+    """
+    found = {}
+
+    def _add(arr, name):
+        base = arr
+        while isinstance(base.base, np.ndarray):
+            base = base.base
+        if base.nbytes < min_mb * 2**20:
+            return
+        if id(base) not in found:
+            found[id(base)] = {'mb': base.nbytes / 2**20, 'shape': list(base.shape),
+                               'dtype': str(base.dtype), 'names': set()}
+        found[id(base)]['names'].add(name)
+
+    def _scan(items, prefix, depth=2):
+        # containers holding only arrays are not tracked by gc, so look inside
+        try:
+            for key, value in list(items):
+                if isinstance(value, np.ndarray):
+                    _add(value, prefix+str(key))
+                elif depth > 0 and isinstance(value, (dict, list, tuple)) \
+                        and not gc.is_tracked(value):
+                    _scan(value.items() if isinstance(value, dict) else enumerate(value),
+                          prefix+str(key)+'.', depth-1)
+        except RuntimeError:
+            pass
+
+    for obj in gc.get_objects():
+        if isinstance(obj, dict):
+            _scan(obj.items(), '')
+        elif isinstance(obj, (list, tuple)):
+            _scan(enumerate(obj), '<%s>.'%type(obj).__name__)
+        elif not isinstance(obj, type) and hasattr(obj, '__dict__'):
+            try:
+                _scan(vars(obj).items(), '%s.'%type(obj).__name__)
+            except TypeError:
+                pass
+    for frame in sys._current_frames().values():
+        while frame is not None:
+            _scan(frame.f_locals.items(), '')
+            frame = frame.f_back
+
+    arrays = sorted(found.values(), key=lambda item: item['mb'], reverse=True)[:n]
+    for item in arrays:
+        item['names'] = sorted(item['names'])[:5]
+    return arrays
+
+
+class RunReport:
+    """
+    Timings of stages and counters of one run
+        stages are nested by a per-thread stack, e.g., 'do_trace_v3/propagate'
+        memory: also record RSS and tracemalloc peaks of each stage, and the
+            largest live arrays at its end (slow; for diagnosis only)
+    """
+    def __init__(self, name='', enabled=True, memory=False):
+        self.name = name
+        self.enabled = enabled
+        self.memory = memory and enabled
+        self.stages = []
+        self.memory_stages = []
+        self.counters = {}
+        self.info = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._t_start = time.perf_counter()
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _get_stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _get_peaks(self):
+        if not hasattr(self._local, 'peaks'):
+            self._local.peaks = []
+        return self._local.peaks
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage in a with statement. """
+        stack = self._get_stack()
+        stack.append(name)
+        path = '/'.join(stack)
+        if self.memory:
+            self._enter_memory()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            t1 = time.perf_counter()
+            if self.memory:
+                self._exit_memory(path)
+            stack.pop()
+            with self._lock:
+                self.stages.append({'stage': path,
+                                    'start': t0 - self._t_start,
+                                    'seconds': t1 - t0})
+
+    def _enter_memory(self):
+        # tracemalloc has one peak, so the peak so far is passed to the parent
+        peaks = self._get_peaks()
+        current, peak = tracemalloc.get_traced_memory()
+        if len(peaks) > 0:
+            peaks[-1] = max(peaks[-1], peak)
+        tracemalloc.reset_peak()
+        peaks.append(current)
+        self._local.rss_before = get_rss_mb()
+
+    def _exit_memory(self, path):
+        peaks = self._get_peaks()
+        peak = max(peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if len(peaks) > 0:
+            peaks[-1] = max(peaks[-1], peak)
+        with self._lock:
+            self.memory_stages.append({
+                'stage': path,
+                'tracemalloc_peak_mb': peak / 2**20,
+                'rss_after_mb': get_rss_mb(),
+                'max_rss_mb': get_max_rss_mb(),
+                'largest_arrays': get_largest_arrays()})
+
+    def count(self, name, n=1):
+        """Add n to a counter. """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def get_totals(self):
+        """Get the total seconds of each stage (summed over calls). """
+        totals = {}
+        for item in self.stages:
+            totals[item['stage']] = totals.get(item['stage'], 0.) + item['seconds']
+        return totals
+
+    def to_dict(self):
+        return {'name': self.name,
+                'seconds': time.perf_counter() - self._t_start,
+                'totals': self.get_totals(),
+                'stages': self.stages,
+                'counters': self.counters,
+                'memory': self.memory_stages,
+                'info': self.info}
+
+    def write_json(self, path):
+        """Write the report to a json file. """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        return path
+
+    def summary(self, depth=1):
+        """Get a short text of the stages up to the depth, and counters. """
+        lines = []
+        for path, seconds in self.get_totals().items():
+            if path.count('/') < depth:
+                lines.append('%s: %.2f s'%(path, seconds))
+        for name, n in self.counters.items():
+            lines.append('%s: %d'%(name, n))
+        for item in self.memory_stages:
+            if item['stage'].count('/') < depth:
+                lines.append('%s: peak %.0f MB'%(item['stage'], item['tracemalloc_peak_mb']))
+        return '\n'.join(lines)
+
+
+#### the report of the current run, disabled unless start_report is called
+_report = RunReport(enabled=False)
+
+
+def start_report(name='', enabled=True, memory=False, keep_stages=False):
+    """
+    Start a new report for the current run.
+        keep_stages: carry over the stages of the current report, e.g., of 
+            packing and cutting before tracing
+    """
+    global _report
+    report_prev = _report
+    if report_prev.memory and not memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _report = RunReport(name, enabled=enabled, memory=memory)
+    if keep_stages and report_prev.enabled:
+        _report.stages = report_prev.stages + _report.stages
+        _report.memory_stages = report_prev.memory_stages + _report.memory_stages
+    return _report
+
+
+def get_report():
+    return _report
+
+
+def stage(name):
+    """Time a stage of the current report; nearly free if disabled. """
+    if not _report.enabled:
+        return _NULL_STAGE
+    return _report.stage(name)
+
+
+def count(name, n=1):
+    """Add n to a counter of the current report. """
+    if _report.enabled:
+        _report.count(name, n)
+
+
+def timed(name=None):
+    """Decorator to time a function as a stage of the current report. """
+    def decorator(func):
+        stage_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
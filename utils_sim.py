@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+import os
+import argparse
+import numpy as np
+
+from astropy.io import fits
+
+from utils_io import func_parabola
+
+#### size of one amplifier (unbinned), and the overscan width
+AMP_NX, AMP_NY = 2048, 2056
+AMP_NX_OVERSCAN = 128
+
+#### default curve params [A, B, C, X1, dX] in 1x2 binned pixels
+CURVE_DEFAULT = {'b': [-2.194e-04, 961.8, 1456.9, 300, 3700],
+                 'r': [-2.220e-04, 1044.7, 1497.7, 342, 3700]}
+
+
+def parse_binning(binning):
+    """Get (bin_x, bin_y) from a BINNING string like '1x2'. """
+    bin_x, bin_y = binning.lower().split('x')
+    return int(bin_x), int(bin_y)
+
+
+def get_default_curve(shoe, binning):
+    """Scale the default curve params from 1x2 to the binning. """
+    bin_x, bin_y = parse_binning(binning)
+    A, B, C, X1, dX = CURVE_DEFAULT[shoe]
+    return np.array([A*(bin_y/2.)**2/bin_x, B*2./bin_y, C/bin_x, X1/bin_x, dX/bin_x])
+
+
+def load_fiber_model(ifu_type, shoe, bin_y, dir_model='./fiber_positions_250804'):
+    """Get fiber positions (binned pixels from fiber 1) and good flags. """
+    path_model = os.path.join(dir_model, '%s_LoRes_Fiber_Position.txt'%ifu_type)
+    fiber_model = np.loadtxt(path_model, dtype='float', skiprows=4)
+    if shoe == 'b':
+        return fiber_model[:, 2]/bin_y, fiber_model[:, 1] > 0
+    else:
+        return fiber_model[:, 5]/bin_y, fiber_model[:, 4] > 0
+
+
+def get_true_traces(truth, x):
+    """Get the true y of every fiber at columns x, (n_fiber, len(x)). """
+    x = np.asarray(x, dtype=float)
+    dx = (x - truth['x_center']) / truth['x_center']
+    return truth['y0'] + truth['pos'][:, None] \
+        + truth['tilt']*(x - truth['x_center']) + truth['bow']*dx**2
+
+
+def simulate_frame(ifu_type='STD', shoe='b', binning='1x2', curve_params=None,
+                   missing=(), flux=20000., sigma=2.2, y0=None, tilt=0.002,
+                   bow=1.5, throughput_scatter=0.1, seed=0):
+    """
+    Simulate the packed frame of a LoRes trace (electrons, noise-free)
+    Fibers follow the fiber_positions model (dead fibers by the good flags
+    and missing fibers are dark), tilted and bowed along x, and are lit
+    between the two parabolic edges x1(y) = parabola(y; A, B, X1), x1+dX.
+        missing: ids (1-based) of extra missing fibers
+        sigma: unbinned gaussian sigma of the fiber profile
+        bow: maximum bow (binned pixels) of the traces at the frame edges
+    Returns the frame and the truth dict (see get_true_traces).
+    """
+    rng = np.random.default_rng(seed)
+    bin_x, bin_y = parse_binning(binning)
+    n_x, n_y = 2*AMP_NX//bin_x, 2*AMP_NY//bin_y
+    if curve_params is None:
+        curve_params = get_default_curve(shoe, binning)
+
+    pos, good = load_fiber_model(ifu_type, shoe, bin_y)
+    lit = good.copy()
+    lit[np.asarray(missing, dtype=int)-1] = False
+    if y0 is None:
+        y0 = 0.5*(n_y - pos[-1])
+    throughput = 1. + throughput_scatter*rng.standard_normal(len(pos))
+    truth = {'ifu_type': ifu_type, 'shoe': shoe, 'binning': binning,
+             'y0': y0, 'pos': pos, 'good': good, 'lit': lit, 'tilt': tilt,
+             'bow': bow, 'x_center': 0.5*n_x, 'curve_params': curve_params}
+
+    # render the fibers row-window by row-window
+    sig = sigma/bin_y
+    half = int(np.ceil(5*sig))+1
+    xx = np.arange(n_x)
+    yc_all = get_true_traces(truth, xx)
+    frame = np.zeros((n_y, n_x), dtype=np.float32)
+    for i_fib in np.where(lit)[0]:
+        yc = yc_all[i_fib]
+        y_lo = int(np.floor(np.min(yc)))-half
+        rows = np.arange(y_lo, int(np.ceil(np.max(yc)))+half+1)
+        rows = rows[(rows >= 0) & (rows < n_y)]
+        if len(rows) == 0:
+            continue
+        profile = np.exp(-0.5*((rows[:, None] - yc[None, :])/sig)**2)
+        frame[rows] += np.float32(flux*throughput[i_fib]*profile)
+
+    # illuminate between the edges, with a smooth blaze and soft edges
+    yy = np.arange(n_y)[:, None]
+    x1 = func_parabola(yy, curve_params[0], curve_params[1], curve_params[3])
+    x2 = x1 + curve_params[4]
+    u = (xx[None, :] - x1)/(x2 - x1)
+    blaze = 0.6 + 0.4*np.sin(np.pi*np.clip(u, 0, 1))
+    edges = 1./(1.+np.exp(-(xx[None, :]-x1)/2.)) / (1.+np.exp((xx[None, :]-x2)/2.))
+    frame *= np.float32(blaze*edges)
+
+    return frame, truth
+
+
+def split_frame(frame):
+    """
+    Split a packed frame into the data of the 4 amplifiers c1-c4, the
+    inverse of pack_4fits_simple:
+        4 3
+        1 2
+    """
+    n_y, n_x = frame.shape
+    half2, half1 = frame[:n_y//2], frame[n_y//2:]
+    c1 = np.flip(half1[:, :n_x//2], axis=0)
+    c2 = np.flip(half1[:, n_x//2:])
+    c3 = np.flip(half2[:, n_x//2:], axis=1)
+    c4 = half2[:, :n_x//2]
+    return [c1, c2, c3, c4]
+
+
+def write_raw_frames(dirname, fnum, ifu_type='STD', shoes=('b', 'r'),
+                     binning='1x2', config='Config1', slide='SIM',
+                     slitname='sim', egain=(0.68, 0.70, 0.69, 0.71),
+                     enoise=(2.5, 2.6, 2.4, 2.7), bias=1000., noise=True,
+                     seed=0, **kwargs):
+    """
+    Write simulated raw 4-amplifier frames {shoe}{fnum}c[1-4].fits
+        egain, enoise: gain (e-/ADU) and read noise (e-) of c1-c4
+        noise: add photon and read noise
+        kwargs: passed to simulate_frame
+    Returns the list of paths and the truth dict of each shoe.
+    """
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    bin_x, bin_y = parse_binning(binning)
+    nx_amp, ny_amp = AMP_NX//bin_x, AMP_NY//bin_y
+    nx_overscan = AMP_NX_OVERSCAN//bin_x
+
+    paths, truths = [], {}
+    for i_shoe, shoe in enumerate(shoes):
+        # each shoe gets its own deterministic stream
+        rng = np.random.default_rng([seed, i_shoe])
+        frame, truths[shoe] = simulate_frame(ifu_type, shoe, binning,
+                                             seed=rng.integers(2**31), **kwargs)
+        if noise:
+            frame = rng.poisson(np.clip(frame, 0, None)).astype(np.float32)
+
+        for i_amp, data_amp in enumerate(split_frame(frame)):
+            # electrons to ADU, with overscan and read noise
+            raw = np.zeros((ny_amp, nx_amp+nx_overscan), dtype=np.float32)
+            raw[:, :nx_amp] = data_amp / egain[i_amp]
+            bias_rows = bias + 5.*np.sin(np.arange(ny_amp)/ny_amp*np.pi)
+            raw += np.float32(bias_rows[:, None])
+            if noise:
+                raw += np.float32(rng.normal(0, enoise[i_amp]/egain[i_amp], raw.shape))
+            raw = np.uint16(np.clip(np.rint(raw), 0, 65535))
+
+            hdu = fits.PrimaryHDU(raw)
+            hdr = hdu.header
+            hdr['FILENAME'] = ('%s%sc%d'%(shoe, fnum, i_amp+1), '')
+            hdr['OBJECT'] = ('Trace', 'object name')
+            hdr['EXPTYPE'] = ('Object', '')
+            hdr['EXPTIME'] = (10., 'exposure time (s)')
+            hdr['OPAMP'] = (i_amp+1, 'amplifier')
+            hdr['BINNING'] = (binning, 'binning')
+            hdr['EGAIN'] = (egain[i_amp], 'gain (e-/ADU)')
+            hdr['ENOISE'] = (enoise[i_amp], 'read noise (e-)')
+            hdr['DATASEC'] = ('[1:%d,1:%d]'%(nx_amp, ny_amp), 'NOAO: data section')
+            hdr['TRIMSEC'] = ('[1:%d,1:%d]'%(nx_amp, ny_amp), 'NOAO: trim section')
+            hdr['BIASSEC'] = ('[%d:%d,1:%d]'%(nx_amp+1, nx_amp+nx_overscan, ny_amp),
+                              'NOAO: bias section')
+            hdr['IFU'] = (ifu_type, 'type of IFU')
+            hdr['CONFIGFL'] = (config, 'configuration')
+            hdr['SLIDE'] = (slide, 'slide')
+            hdr['SLITNAME'] = (slitname, 'slit name')
+            hdr['SIMSEED'] = (seed, 'seed of the simulation')
+
+            path_amp = os.path.join(dirname, '%s%sc%d.fits'%(shoe, fnum, i_amp+1))
+            hdu.writeto(path_amp, overwrite=True)
+            paths.append(path_amp)
+
+    return paths, truths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate raw IFUM trace frames')
+    parser.add_argument('dirname', help='output folder')
+    parser.add_argument('fnum', help='frame number, e.g., 0001')
+    parser.add_argument('--ifu', default='STD', choices=['LSB', 'STD', 'HR'])
+    parser.add_argument('--binning', default='1x2')
+    parser.add_argument('--missing', default='', help='ids of missing fibers, e.g., 40,41')
+    parser.add_argument('--flux', type=float, default=20000.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-noise', action='store_true')
+    args = parser.parse_args()
+
+    missing = [int(i) for i in args.missing.split(',') if i.strip()]
+    paths, _ = write_raw_frames(args.dirname, args.fnum, args.ifu, binning=args.binning,
+                                missing=missing, flux=args.flux, noise=not args.no_noise,
+                                seed=args.seed)
+    print('\n'.join(paths))
@@ -0,0 +1,209 @@
+import queue
+import threading
+import traceback
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TaskCancelled(Exception):
+    """Raised in a cancelled task at its next progress point. """
+
+
+class Task:
+    """
+    A function run by a TaskRunner in a worker thread
+        progress: (text, done, total) of the latest progress report
+    """
+    def __init__(self, name, runner):
+        self.name = name
+        self.runner = runner
+        self.progress = ('', 0, 0)
+        self.future = None
+        self.callbacks = {}
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        """Ask the task to stop at its next progress point. """
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+
+#### the task of each worker thread, None outside tasks
+_local = threading.local()
+
+
+def get_task():
+    return getattr(_local, 'task', None)
+
+
+def progress(text, done=0, total=0):
+    """
+    Report the progress of the current task, e.g., from long loops; this is
+    also where a cancelled task stops (raises TaskCancelled). Nearly free
+    outside tasks.
+    """
+    task = getattr(_local, 'task', None)
+    if task is None:
+        return
+    if task.cancelled:
+        raise TaskCancelled(task.name)
+    task.progress = (text, done, total)
+
+
+def bind_task(func):
+    """Wrap func to report to the current task when run in another thread. """
+    task = get_task()
+    if task is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _local.task = task
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.task = None
+    return wrapper
+
+
+def run_in_main(func, *args, **kwargs):
+    """
+    Call func in the Tk main thread and wait for its result, e.g., for an
+    interactive matplotlib window; a direct call outside tasks.
+    """
+    task = get_task()
+    if task is None:
+        return func(*args, **kwargs)
+    return task.runner._call_in_main(func, args, kwargs)
+
+
+class TaskRunner:
+    """
+    Run functions in worker threads, so the Tk window stays responsive
+    Results, errors and progress are handed to callbacks in the main thread
+    by polling with window.after.
+        on_state: called with the list of running tasks whenever a task
+            starts or ends, e.g., to enable and disable widgets
+        on_progress: called with the list of running tasks at each poll
+    """
+    def __init__(self, window, on_state=None, on_progress=None, max_workers=1,
+                 poll_ms=100):
+        self.window = window
+        self.on_state = on_state
+        self.on_progress = on_progress
+        self.poll_ms = poll_ms
+        self.tasks = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='task')
+        self._calls = queue.Queue()
+        self._polling = False
+
+    def submit(self, name, func, *args, on_done=None, on_error=None,
+               on_cancel=None, **kwargs):
+        """
+        Run func(*args, **kwargs) as a task
+            on_done: called with the result
+            on_error: called with the exception; by default, its traceback
+                is printed
+            on_cancel: called if the task stopped after cancel
+        """
+        task = Task(name, self)
+        task.callbacks = {'done': on_done, 'error': on_error, 'cancel': on_cancel}
+        task.future = self._executor.submit(self._run, task, func, args, kwargs)
+        self.tasks.append(task)
+        print('++++ Task started: %s'%name)
+        self._notify(self.on_state)
+        if not self._polling:
+            self._polling = True
+            self.window.after(self.poll_ms, self._poll)
+        return task
+
+    def is_busy(self):
+        return len(self.tasks) > 0
+
+    def cancel(self):
+        """Cancel all running tasks. """
+        for task in self.tasks:
+            task.cancel()
+
+    def shutdown(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _run(self, task, func, args, kwargs):
+        _local.task = task
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.task = None
+
+    def _call_in_main(self, func, args, kwargs):
+        done = threading.Event()
+        box = {}
+        self._calls.put((func, args, kwargs, done, box))
+        done.wait()
+        if 'error' in box:
+            raise box['error']
+        return box['result']
+
+    def _notify(self, callback):
+        if callback is not None:
+            try:
+                callback(list(self.tasks))
+            except Exception:
+                traceback.print_exc()
+
+    def _poll(self):
+        # calls the tasks wait for in the main thread
+        while True:
+            try:
+                func, args, kwargs, done, box = self._calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                box['result'] = func(*args, **kwargs)
+            except Exception as e:
+                box['error'] = e
+            finally:
+                done.set()
+
+        # hand over the finished tasks; widgets are restored before the
+        # callbacks, which may change them again
+        finished = [task for task in self.tasks if task.future.done()]
+        for task in finished:
+            self.tasks.remove(task)
+        if len(finished) > 0:
+            self._notify(self.on_state)
+        for task in finished:
+            self._finish(task)
+
+        self._notify(self.on_progress)
+        if len(self.tasks) > 0:
+            self.window.after(self.poll_ms, self._poll)
+        else:
+            self._polling = False
+
+    def _finish(self, task):
+        callbacks = task.callbacks
+        try:
+            try:
+                result = task.future.result()
+            except TaskCancelled:
+                print('---- Task cancelled: %s'%task.name)
+                if callbacks['cancel'] is not None:
+                    callbacks['cancel']()
+            except Exception as e:
+                print('!!! Task failed: %s !!!'%task.name)
+                if callbacks['error'] is not None:
+                    callbacks['error'](e)
+                else:
+                    traceback.print_exception(type(e), e, e.__traceback__)
+            else:
+                print('++++ Task done: %s'%task.name)
+                if callbacks['done'] is not None:
+                    callbacks['done'](result)
+        except Exception:
+            traceback.print_exc()
@@ -1,15 +1,24 @@
+import os
 import numpy as np
 import numpy.polynomial.polynomial as poly
 import scipy.stats as stats
 import scipy.signal as signal
+import scipy.ndimage as ndimage
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 from astropy.nddata import CCDData
 
 from utils_io import func_parabola
+from utils_curve import get_geometry
+from utils_fit import polyfit_batch, TraceSurface
+from utils_profile import timed, stage, count
+from utils_task import progress, run_in_main
 from columnspec import get_columnspec
 
 
+@timed()
 def load_trace(file_path):
     """Load trace from a fits file using CCDData. """
 
@@ -25,25 +34,26 @@ def load_trace(file_path):
     return trace, ifu_type, bin_y
 
 
-def reshape_trace_by_curvature(trace, curve_params):
-    """Reshape trace by curvature. """
+def make_trace(data, header):
+    """Make a trace from data in memory, the same as load_trace. """
+
+    trace = CCDData(data, unit='electron', meta=header)
+    trace.mask = np.zeros_like(trace.data, dtype=bool)
+    trace.uncertainty = np.ones_like(trace.data, dtype=float)
 
-    # Get the trace data
-    trace_data = trace.data
+    # get the ifu type from the header
+    ifu_type = header['IFU']
+    bin_y = 4112./len(data)
+
+    return trace, ifu_type, bin_y
 
-    # Get the trace shape
-    trace_shape = trace_data.shape
+
+@timed()
+def reshape_trace_by_curvature(trace, curve_params):
+    """Reshape trace by curvature. """
 
     # cut the data into the range between two parabolic curves
-    data_new = []
-    for y_idx in range(trace_shape[0]):
-        x_1 = func_parabola(y_idx, curve_params[0], 
-                            curve_params[1], curve_params[3])
-        # round x_1 to the lower integer, and x_2 to the higher integer
-        x_1 = int(np.rint(x_1))
-        x_2 = x_1 + int(curve_params[4])
-        data_new.append(trace_data[y_idx, x_1:x_2])
-    data_new = np.array(data_new)
+    data_new = get_geometry(curve_params, trace.data.shape).rectify(trace.data)
 
     trace_new =  CCDData(data_new, unit='electron')
     trace_new.mask = np.zeros_like(trace_new, dtype=bool)
@@ -52,15 +62,17 @@ def reshape_trace_by_curvature(trace, curve_params):
     return trace_new
 
 
-def create_apermap(trace, curve_params, traces_coefs, aper_half_width, verbose=False):
-    """Create aperture map. """
+@timed()
+def create_apermap(shape, curve_params, traces_coefs, aper_half_width, verbose=False):
+    """Create aperture map of the shape of the trace data. """
 
-    aper_map_full = np.zeros_like(trace.data, dtype=np.int32)
-    x_middle = int(trace.data.shape[1]/2)
-    x_trace = np.arange(trace.data.shape[1])
+    aper_map_full = np.zeros(shape, dtype=np.int32)
+    x_middle = int(shape[1]/2)
+    x_trace = np.arange(shape[1])
 
     y_middle = np.array([], dtype=np.int32)
     for i in range(len(traces_coefs)):
+        progress('apertures', i, len(traces_coefs))
         y_middle = np.append(y_middle, np.round(poly.polyval(x_middle, traces_coefs[i])).astype(np.int32))
         y_trace = poly.polyval(x_trace, traces_coefs[i])
         y_trace = np.round(y_trace).astype(np.int32)
@@ -68,16 +80,54 @@ def create_apermap(trace, curve_params, traces_coefs, aper_half_width, verbose=F
             aper_map_full[y_trace[j]-aper_half_width:y_trace[j]+aper_half_width, x_trace[j]] = i+1
 
     # trim the aperture map according to the curvature
-    aper_map_trim = np.zeros_like(trace.data, dtype=np.int32)
-    for y_idx in range(aper_map_full.shape[0]):
-        x_1 = func_parabola(y_idx, curve_params[0], curve_params[1], curve_params[3])
-        x_2 = func_parabola(y_idx, curve_params[0], curve_params[1], curve_params[3]+curve_params[4])
-        x_1 = int(np.floor(x_1))
-        x_2 = int(np.ceil(x_2))
-        aper_map_trim[y_idx, x_1:x_2] = aper_map_full[y_idx, x_1:x_2]
+    aper_map_trim = get_geometry(curve_params, aper_map_full.shape).cut(aper_map_full, 'outer')
 
     return aper_map_trim, y_middle
 
+
+@timed()
+def create_weightmap(shape, curve_params, traces_coefs, aper_half_width):
+    """
+    Create fractional aperture weights, the companion of create_apermap: the
+    coverage of each pixel by the box trace +- aper_half_width of each
+    aperture, i.e., centred on the trace instead of its rounded row, and
+    trimmed by the curvature as the AperMap
+    The weights of aperture i at column x are those of the rows
+    start[i, x] + (0, 1, ..., 2*aper_half_width).
+    Returns start (N_ap, n_x) and weights (N_ap, n_x, 2*aper_half_width+1).
+    """
+    n_y, n_x = shape
+    x_trace = np.arange(n_x)
+    y_trace = poly.polyval(x_trace, np.asarray(traces_coefs, dtype=np.float64).T)
+    y_lo = y_trace - aper_half_width
+    y_hi = y_trace + aper_half_width
+
+    # the pixel y spans y-0.5 to y+0.5; the box covers 2*aper_half_width+1 pixels at most
+    start = np.floor(y_lo + 0.5).astype(np.int32)
+    rows = start[:, :, None] + np.arange(2*aper_half_width+1)
+    weights = np.minimum(rows+0.5, y_hi[:, :, None]) - np.maximum(rows-0.5, y_lo[:, :, None])
+    weights = np.clip(weights, 0., 1.).astype(np.float32)
+
+    # trim by the curvature and the frame
+    mask = get_geometry(curve_params, shape).get_mask('outer')
+    inside = (rows >= 0) & (rows < n_y)
+    inside &= mask[np.clip(rows, 0, n_y-1), x_trace[None, :, None]]
+    weights[~inside] = 0.
+
+    return start, weights
+
+
+def extract_weighted(data, start, weights):
+    """
+    Extract the spectra of all apertures by the fractional weights of
+    create_weightmap; returns the weighted sums (N_ap, n_x).
+    """
+    n_y, n_x = data.shape
+    rows = start[:, :, None] + np.arange(weights.shape[2])
+    values = data[np.clip(rows, 0, n_y-1), np.arange(n_x)[None, :, None]]
+    return np.sum(weights*values, axis=2)
+
+
 def _determine_signal_height(columnspec_array, min_height=100.):
     """Determine signal height. """
 
@@ -92,22 +142,97 @@ def _determine_signal_height(columnspec_array, min_height=100.):
     return signal_height
 
 
-def _preanalyze_columnspec_array(columnspec_array, ifu_type):
-    """Preanalyze columnspec array. """
+def _get_autocorr_pitch(specs, min_pitch=3.):
+    """
+    Get the pitch from the mean autocorrelation of spectra (n_spec, n_pix)
+    Returns the pitch and the normalized autocorrelation at it (confidence).
+    """
+    specs = np.atleast_2d(specs)
+    n_pix = specs.shape[1]
+    power = np.abs(np.fft.rfft(specs, 2*n_pix, axis=1))**2
+    autocorr = np.mean(np.fft.irfft(power, 2*n_pix, axis=1)[:, :n_pix//2], axis=0)
+    if autocorr[0] <= 0:
+        return np.nan, 0.
+    autocorr = autocorr / autocorr[0]
+
+    # the first strong local maximum beyond min_pitch
+    lags, _ = signal.find_peaks(autocorr)
+    lags = lags[lags >= min_pitch]
+    if len(lags) == 0:
+        return np.nan, 0.
+    lag = lags[np.argmax(autocorr[lags] >= 0.5*np.max(autocorr[lags]))]
+    pitch = _get_parabolic_peak(autocorr[None, :], np.array([lag]))[0]
+
+    return pitch, np.clip(autocorr[lag], 0., 1.)
+
+
+def _estimate_fiber_pitch(columnspec_array, n_columns=5, min_pitch=3., 
+                          verbose=False):
+    """
+    Estimate the fiber pitch from the autocorrelation of a few high-SNR 
+    columns. The brightest column is also split into bundles at the gaps of 
+    its smoothed envelope to report the pitch per bundle.
+    Returns the pitch, the confidence (0-1), and a list of (lower, upper, 
+    pitch) of bundles.
+    """
+    specs = np.array([np.asarray(columnspec_array[col].spec, dtype=float) 
+                      for col in range(len(columnspec_array))])
+    specs = specs - np.median(specs, axis=1, keepdims=True)
+    specs[specs < 0] = 0.
+
+    # a few columns with the highest signal
+    signal_col = np.percentile(specs, 95, axis=1)
+    cols_best = np.argsort(signal_col)[::-1][:n_columns]
+    pitch, confidence = _get_autocorr_pitch(specs[cols_best], min_pitch)
+
+    # pitch per bundle
+    bundles = []
+    if np.isfinite(pitch):
+        spec = specs[cols_best[0]]
+        envelope = ndimage.uniform_filter1d(spec, int(np.ceil(2*pitch)))
+        mask_on = envelope > 0.2*np.percentile(envelope, 95)
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], mask_on.astype(int), [0]])))
+        for lower, upper in zip(edges[::2], edges[1::2]):
+            if upper - lower < 4*pitch:
+                continue
+            pitch_bundle, _ = _get_autocorr_pitch(spec[lower:upper], min_pitch)
+            bundles.append((lower, upper, pitch_bundle))
 
-    # get the inital peaks and properties from columnspec_array
-    peaks_diff_array = np.array([])
-    for column in range(len(columnspec_array)):
-        spec = columnspec_array[column].spec
-        _, properties = signal.find_peaks(
-            spec, prominence=10, width=1, rel_height=0.5)
-        peaks_left = properties['left_ips']
-        peaks_right = properties['right_ips']
-        peaks = (peaks_left + peaks_right)/2
-        peaks_diff_array = np.append(peaks_diff_array, np.diff(peaks))
+    if verbose:
+        print("++++ pitch, confidence: %.3f, %.3f"%(pitch, confidence))
+        for lower, upper, pitch_bundle in bundles:
+            print("++++ bundle [%d, %d]: pitch = %.3f"%(lower, upper, pitch_bundle))
+
+    return pitch, confidence, bundles
+
+
+@timed()
+def _preanalyze_columnspec_array(columnspec_array, ifu_type, min_confidence=0.3):
+    """
+    Preanalyze columnspec array.
+    The pitch is estimated by autocorrelation; if its confidence is below 
+    min_confidence, the median spacing of peaks in all columns is used.
+    """
+
+    pitch, confidence, _ = _estimate_fiber_pitch(columnspec_array)
+
+    if not (confidence >= min_confidence):
+        print("!!!! low confidence of the pitch (%.3f), use peak spacings"%confidence)
+
+        # get the inital peaks and properties from columnspec_array
+        peaks_diff_array = np.array([])
+        for column in range(len(columnspec_array)):
+            spec = columnspec_array[column].spec
+            _, properties = signal.find_peaks(
+                spec, prominence=10, width=1, rel_height=0.5)
+            peaks_left = properties['left_ips']
+            peaks_right = properties['right_ips']
+            peaks = (peaks_left + peaks_right)/2
+            peaks_diff_array = np.append(peaks_diff_array, np.diff(peaks))
+        pitch = np.median(peaks_diff_array)
 
     # get the aperture half width
-    aper_half_width = int(np.median(peaks_diff_array)/2)
+    aper_half_width = int(pitch/2)
 
     # get the width and distance cut
     width_cut = int( aper_half_width - 2 )
@@ -371,70 +496,87 @@ def _fit_template_to_column_max(peaks_gap_template, peaks_gap_cmax,
     return coefs, peaks_template_cmax
 
 
-def _find_missing_fibers(y_data, y_pred, delta_y=3.0, verbose=False):
-    """find missing fibers in the column max. """
-
+def align_peaks_to_model(y_data, y_model, tol, gap_cost=1.0, spurious_cost=2.0,
+                         max_skip=16, anchor=False, verbose=False):
+    """
+    Align the detected peaks to the fiber model (Needleman-Wunsch style) by
+    comparing their spacings, so that the model needs no offset
+        y_data: y of the detected peaks (sorted)
+        y_model: y of all the fibers of the model, e.g., a template file
+        tol: spacing mismatch (pixels) that costs as much as one gap
+        gap_cost: cost of a model fiber without a peak (missing)
+        spurious_cost: cost of a peak without a model fiber (spurious)
+        max_skip: max. number of consecutive missing fibers
+        anchor: y_model is in the pixels of y_data, so the first match
+                also costs its offset
+    The model is scaled by the ratio of the median spacings. The table is
+    filled one peak (row) at a time, vectorized over the model fibers.
+    Returns a dict of matched (pairs of data and model IDs), missing
+    (model IDs) and spurious (data IDs); all IDs are 1-based.
+    """
+    y_data = np.asarray(y_data, dtype=np.float64)
+    y_model = np.asarray(y_model, dtype=np.float64)
+    n, m = len(y_data), len(y_model)
+    scale = np.median(np.diff(y_data))/np.median(np.diff(y_model)) if n > 1 else 1.
+    y_model_s = y_model*scale
+    j_all = np.arange(m)
+
+    #### steps to fiber j from fiber j-dj, dj = 1..max_skip (dj-1 missing)
+    dj = np.arange(1, max(min(max_skip, m-1), 1)+1)[:, None]
+    j_prev = j_all[None, :] - dj
+    valid = j_prev >= 0
+    j_prev = np.where(valid, j_prev, 0)
+    dy_model = y_model_s[None, :] - y_model_s[j_prev]
+    cost_skip = np.where(valid, (dj-1)*gap_cost, np.inf)
+
+    #### cost[i, j]: best alignment of peaks <= i with peak i on fiber j
+    cost = np.full((n, m), np.inf)
+    back_i = np.full((n, m), -1, dtype=int)
+    back_j = np.full((n, m), -1, dtype=int)
+    for i in range(n):
+        # peak i is the first matched one
+        row = i*spurious_cost + j_all*gap_cost
+        if anchor:
+            row = row + np.abs(y_data[i]-y_model[j_all])/tol
+        # peak i follows the matched peak i-di, skipping di-1 spurious ones
+        for di in (1, 2):
+            if i-di < 0:
+                break
+            cand = cost[i-di][j_prev] + cost_skip + (di-1)*spurious_cost \
+                + np.abs(y_data[i]-y_data[i-di]-dy_model)/tol
+            k = np.argmin(cand, axis=0)
+            cand = cand[k, j_all]
+            better = cand < row
+            row[better] = cand[better]
+            back_i[i, better] = i-di
+            back_j[i, better] = j_prev[k, j_all][better]
+        cost[i] = row
+
+    #### the last matched peak, leaving the rest missing or spurious
+    total = cost + (n-1-np.arange(n))[:, None]*spurious_cost \
+        + (m-1-j_all)[None, :]*gap_cost
+    i, j = np.unravel_index(np.argmin(total), total.shape)
+    total_min = total[i, j]
+    pairs = []
+    while i >= 0:
+        pairs.append((i, j))
+        i, j = back_i[i, j], back_j[i, j]
+    pairs = np.array(pairs[::-1])
+
+    matched = pairs + 1
+    missing = np.setdiff1d(np.arange(1, m+1), matched[:, 1])
+    spurious = np.setdiff1d(np.arange(1, n+1), matched[:, 0])
     if verbose:
-        print("!!!! Finding missing fibers for HR or STD")
-        print("!!!! # of default fibers: ", len(y_pred))
-        n_missing = len(y_pred) - len(y_data)
-        print("!!!! # of missing fibers: ", n_missing)
-        print("!!!! cut of delta_y: ", delta_y)
-
-    # count_add = 0
-    # count_del = 0
-    # ids = []
-    # y_new = np.zeros_like(y_pred)
-    # for i_pred in range(len(y_pred)):
-    #     i_data = i_pred-count_add+count_del
-    #     if np.abs(y_data[i_data] - y_pred[i_pred]) > delta_y:
-    #         y_new[i_pred] = y_pred[i_pred]
-    #         count_add += 1
-    #         ids.append(i_pred+1)
-
-    #         if verbose:
-    #             print('!!!! Missing %d: %.2f - %.2f = %.2f'%
-    #                   (i_pred+1, y_data[i_data], y_pred[i_pred],
-    #                    y_data[i_data]-y_pred[i_pred])
-    #                    )
-    #     else:
-    #         y_new[i_pred] = y_data[i_data]
-
-    # rewrite by comparing diff array
-    diff_y_pred = np.diff(y_pred, axis=0)
-    diff_y_data = np.diff(y_data, axis=0)
-
-    ids = []
-    y_data_temp = y_data.copy()
-    for i_pred in range(len(y_pred)-1):
-        if i_pred >= len(diff_y_data):
-            break
-        elif np.abs(diff_y_data[i_pred] - diff_y_pred[i_pred]) > delta_y:
-            if verbose:
-                print('!!!! Missing %d: %.2f - %.2f = %.2f'%
-                      (i_pred+2, diff_y_data[i_pred], diff_y_pred[i_pred],
-                       diff_y_data[i_pred]-diff_y_pred[i_pred])
-                       )
-            y_data_temp = np.insert(
-                y_data_temp, i_pred+1, 
-                np.abs(y_data_temp[i_pred]) + diff_y_pred[i_pred])
-            diff_y_data = np.diff(y_data_temp, axis=0)
-            ids.append(i_pred+2)
-            i_pred -= 1  # adjust the index since we added an element
-
-    # if the last element is missing, add it
-    if (len(diff_y_pred) - len(diff_y_data) == 1):
-        if verbose:
-            print('!!!! Missing %d (the last fiber)' % (len(y_pred)))
-        ids.append(len(y_pred))
-    elif (len(diff_y_pred) - len(diff_y_data) > 1):
-        print('!!!! Warning: possible missing fiber at the start!')
-
-        # add the missing fibers to the end
-        for i in range(len(diff_y_pred) - len(diff_y_data) ):
-            ids.append(len(y_data_temp) + i + 1)
+        print("---- Alignment of %d peaks to %d fibers (cost %.2f)"%(n, m, total_min))
+        print("---- # of matched, missing, spurious: %d, %d, %d"%(
+            len(matched), len(missing), len(spurious)))
+        for id in missing:
+            print("!!!! Missing %d"%id)
+        for id in spurious:
+            print("!!!! Spurious peak %d at y=%.2f"%(id, y_data[id-1]))
 
-    return ids
+    return {'matched': matched, 'missing': missing, 'spurious': spurious, 
+            'cost': total_min}
 
 
 def _add_missing_fibers(peaks_array, peaks_template, ids,
@@ -446,16 +588,11 @@ def _add_missing_fibers(peaks_array, peaks_template, ids,
     for id in ids:
         peaks_array_new = np.insert(peaks_array_new, id-1, np.nan, axis=1)
 
-    # fill the missing fibers by fitting with the template
-    for i in range(peaks_array_new.shape[0]):
-        y = peaks_array_new[i]
-        mask_nan = np.isnan(y)
-        y = y[~mask_nan]
-        x = peaks_template[~mask_nan]
-        coefs = poly.polyfit(x, y, order)
-        ffit= poly.Polynomial(coefs)
-        yfit = ffit(peaks_template)
-        peaks_array_new[i][mask_nan] = yfit[mask_nan]
+    # fill the missing fibers by fitting with the template, all columns at once
+    mask_nan = np.isnan(peaks_array_new)
+    coefs, rms = polyfit_batch(peaks_template, peaks_array_new, order)
+    yfit = poly.polyval(peaks_template, coefs.T)
+    peaks_array_new[mask_nan] = yfit[mask_nan]
 
     if verbose:
         print("---- peaks_array_new.shape: ", peaks_array_new.shape)
@@ -463,61 +600,86 @@ def _add_missing_fibers(peaks_array, peaks_template, ids,
     return peaks_array_new
 
 
-def _find_missing_fibers_LSB(y_data, y_template, 
-                           rel_delta_y=1.5, verbose=False):
-    """Add missing fibers to peaks array for LSB. """
-
-    if verbose:
-        print("!!!! Finding missing fibers for LSB")
-        print("!!!! # of default fibers: ", len(y_template))
-        n_missing = len(y_template) - len(y_data)
-        print("!!!! # of missing fibers: ", n_missing)
+def fill_bundle_gaps(y_middle, pts_pick, y_max, n_half, verbose=True):
+    """
+    Find the missing fibers of each half bundle, between the bundle centers
+    pts_pick and the midpoints between them (0 and y_max at the ends)
+        y_middle: y of the traced fibers (x=middle)
+        n_half: number of fibers per half bundle, i.e., Nx of the IFU
+    Gaps wider than the median pitch p (+ sqrt(p)) are filled with fibers
+    p apart, from the center outwards: below a center from the lower side
+    of each gap, above a center from the upper side, and only as many as
+    are missing. All the gaps of a half bundle are filled in one pass.
+    Returns the y of the fibers to add (sorted).
+    """
+    y_middle = np.asarray(y_middle, dtype=np.float64)
+    pts_pick = np.asarray(pts_pick, dtype=np.float64)
+    pts_all = np.sort(np.concatenate([pts_pick, pts_pick[:-1]+np.diff(pts_pick)/2., [0, y_max]]))
+
+    y_add = []
+    n_seg = len(pts_all)-1
+    for i in range(n_seg):
+        y_seg = y_middle[(y_middle > pts_all[i]) & (y_middle <= pts_all[i+1])]
+        n_missing = n_half - len(y_seg)
+        if verbose:
+            print('Working on %d/%d to add %d fiber(s)'%(i+1, n_seg, n_missing))
+        if n_missing <= 0:
+            continue
+        if len(y_seg) < 2:
+            print('!!! Warning: too few fibers in %d/%d to fill its gaps. !!!'%(i+1, n_seg))
+            continue
+        pitch = np.median(np.diff(y_seg))
+        y_all = np.concatenate([[pts_all[i]], y_seg, [pts_all[i+1]]])
+        gaps = np.diff(y_all)
+
+        #### fibers that fit in each wide gap, the nearest gaps to the center first
+        thresh = pitch + np.sqrt(pitch)
+        n_fit = np.where(gaps > thresh, np.ceil((gaps-thresh)/pitch), 0).astype(int)
+        order = np.arange(len(gaps))[::-1] if i%2==0 else np.arange(len(gaps))
+        n_take = np.diff(np.minimum(np.cumsum(n_fit[order]), n_missing), prepend=0)
+        if np.sum(n_take) < n_missing:
+            print('!!! Warning: only %d of %d missing fiber(s) fit in %d/%d. !!!'%(
+                np.sum(n_take), n_missing, i+1, n_seg))
+
+        idx = np.repeat(order, n_take)
+        step = np.arange(len(idx)) - np.repeat(np.cumsum(n_take)-n_take, n_take) + 1
+        if i%2==0:
+            y_new = y_all[idx] + step*pitch
+        else:
+            y_new = y_all[idx+1] - step*pitch
+        if verbose:
+            print('==== diff_med', pitch, y_new)
+        y_add.append(y_new)
 
-    # analyze peaks_template
-    diff_template = np.diff(y_template, axis=0)
-    max_diff_template = np.max(diff_template, axis=0)
+    if len(y_add) == 0:
+        return np.array([])
+    return np.sort(np.concatenate(y_add))
 
-    # find the missing fibers
-    diff_data = np.diff(y_data)
-    med_diff_data = np.median(diff_data)
 
-    if verbose:
-        print("!!!! med_diff_data:", max_diff_template)
-        print("!!!! cut: ", max_diff_template*rel_delta_y)
-
-    # add negative values to gaps in y_data
-    y_data_new = y_data.copy()
-    idx, cts = 0, 0
-    while idx < len(y_data)-1:
-        temp_diff = np.abs(y_data_new[idx+cts+1]) - np.abs(y_data_new[idx+cts])
-        if temp_diff > max_diff_template*rel_delta_y:
-            if verbose:
-                print("!!!! :", idx+1, temp_diff)
-
-            y_data_new = np.insert(
-                y_data_new, 
-                idx+cts+1, 
-                -(np.abs(y_data_new[idx+cts]) + med_diff_data)
-                )
-            cts += 1
-        else:
-            idx += 1
-
-    # if the last element is missing, add it
-    # Note that the last element is not checked in the while loop
-    while len(y_data_new) < len(y_template):
-        y_data_new = np.append(
-            y_data_new,
-            -(np.abs(y_data_new[-1]) + med_diff_data)
-            )
+def _new_figure(figsize, num=None, headless=False):
+    """
+    Create a figure for diagnostic plots
+        headless: draw on an Agg canvas that never opens a window
+    """
+    if headless:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+    else:
+        fig = plt.figure(num, figsize=figsize)
+    return fig
 
-    # get the added ids
-    ids = np.where(y_data_new < 0)[0] + 1
 
-    return ids 
+def _show_or_save(fig, save_path=None):
+    """Show the figure and block, or save it to save_path if given. """
+    fig.tight_layout()
+    if save_path is None:
+        plt.show()
+    else:
+        fig.savefig(save_path)
 
 
-def _plt_gaps(peaks_cmax, peaks_template, ids_add, shoe, ifu_type):
+def _plt_gaps(peaks_cmax, peaks_template, ids_add, shoe, ifu_type,
+              save_path=None):
     """Plot a view of gaps of the column max vs. the template. """
 
     x_gap_template = np.arange(len(peaks_template)-1)+1
@@ -527,7 +689,7 @@ def _plt_gaps(peaks_cmax, peaks_template, ids_add, shoe, ifu_type):
     diff_cmax = np.diff(peaks_cmax)
 
     # plot the gaps
-    fig = plt.figure(figsize=(12, 6))
+    fig = _new_figure((12, 6), headless=save_path is not None)
     fig.clf()
     ax = fig.add_subplot(111)
     ax.plot(x_gap_template, diff_template, 'ko', label='template')
@@ -549,44 +711,60 @@ def _plt_gaps(peaks_cmax, peaks_template, ids_add, shoe, ifu_type):
     ax.set_xlabel('Gap #')
     ax.set_ylabel('Gap size (pixels)')
 
-    # tight the figure
-    plt.tight_layout()
-    plt.show()
-
-    # save the plot
-    #plt.savefig('gaps.png')
+    # tight the figure, and show or save it
+    _show_or_save(fig, save_path)
 
 
+@timed()
 def _fit_aperture_traces(peaks_array, col_centers, curve_params, 
-                        order=4, verbose=False):
-    """Fit aperture traces. """
+                        order=4, verbose=False, model='aperture'):
+    """
+    Fit aperture traces.
+        model: 'aperture' fits each aperture independently; 'surface' fits
+            a global 2D model of all apertures (see utils_fit.TraceSurface)
+    Returns traces_array, traces_coefs, and the residual rms of each aperture
+    """
 
     # transfer the peaks_array back up to the original data coordinates
-    traces_array = []
-    for column in range(len(peaks_array)):
-        x_temp = func_parabola(peaks_array[column], curve_params[0], 
-                               curve_params[1], curve_params[3])
-        traces_temp = col_centers[column] + x_temp
-        traces_array.append(traces_temp)
-    traces_array = np.array(traces_array)
-
-    # fit the traces
-    traces_coefs = []
-    for  i in range(len(peaks_array[0])):
-        traces_col = traces_array[:, i]
-        traces_val = peaks_array[:, i]
-        mask_good = (~np.isnan(traces_val)) & (traces_val > 0)
-        temp_coefs = poly.polyfit(traces_col[mask_good], traces_val[mask_good], order)
-        traces_coefs.append(temp_coefs)
-    traces_coefs = np.array(traces_coefs)    
-
-    return traces_array, traces_coefs
+    x_temp = func_parabola(peaks_array, curve_params[0], 
+                           curve_params[1], curve_params[3])
+    traces_array = np.asarray(col_centers)[:, None] + x_temp
+
+    # fit the traces of all apertures at once
+    mask_good = (~np.isnan(peaks_array)) & (peaks_array > 0)
+    if model == 'surface':
+        n_aper = peaks_array.shape[1]
+        fibers = np.broadcast_to(np.arange(n_aper), peaks_array.shape)
+        surface = TraceSurface(n_aper, order_x=order).fit(
+            fibers[mask_good], traces_array[mask_good], peaks_array[mask_good],
+            fiber_pos=np.nanmedian(np.abs(peaks_array), axis=0))
+        traces_coefs = surface.get_poly_coefs()
+
+        residuals = np.where(mask_good, peaks_array 
+                             - surface(fibers, np.nan_to_num(traces_array)), 0.)
+        n_good = np.sum(mask_good, axis=0)
+        traces_rms = np.sqrt(np.sum(residuals**2, axis=0) / np.maximum(n_good, 1))
+        traces_rms[n_good == 0] = np.nan
+    else:
+        traces_coefs, traces_rms = polyfit_batch(traces_array.T, peaks_array.T, 
+                                                 order, mask_good.T)
+
+    if verbose:
+        print("---- rms of the aperture traces (median, max): %.3f, %.3f"
+              %(np.nanmedian(traces_rms), np.nanmax(traces_rms)))
+
+    return traces_array, traces_coefs, traces_rms
 
 
+@timed()
 def do_trace_v2(trace, curve_params, 
                 shoe, ifu_type, bin_y,
-                trace_params=None, verbose=False, plot=True):
-    """Do trace. """
+                trace_params=None, verbose=False, plot=True,
+                headless=False, fig_dir=None):
+    """
+    Do trace.
+        headless: never block on plots; save them to fig_dir (if given)
+    """
 
     # get the columnspec array from the trace data
     if trace_params is None:
@@ -651,14 +829,19 @@ def do_trace_v2(trace, curve_params,
             = _fit_template_to_column_max(peaks_gap_template, peaks_gap_cmax,
                                          peaks_template, order=4)
 
-        # find the missing fibers
-        ids_add = _find_missing_fibers(peaks_cmax, peaks_template_cmax,
-                                      delta_y=aper_half_width*2.0, verbose=True)
+        y_model, anchor = peaks_template_cmax, True
     else:   
         # i.e., ifu_type == 'LSB'
         # LSB has no distingushed group gaps, so use the template directly
-        ids_add = _find_missing_fibers_LSB(peaks_cmax, peaks_template, 
-                                          rel_delta_y=1.5, verbose=True)
+        y_model, anchor = peaks_template, False
+
+    # align the column max to the model by their spacings
+    alignment = align_peaks_to_model(peaks_cmax, y_model, tol=aper_half_width,
+                                     anchor=anchor, verbose=True)
+    ids_add = alignment['missing']
+    if len(alignment['spurious']) > 0:
+        print("++++ Removed spurious peaks: ", alignment['spurious'])
+        peaks_array = np.delete(peaks_array, alignment['spurious']-1, axis=1)
     print("++++ # of added fibers: ", len(ids_add))
     print("++++ Added IDs: ", ids_add)
 
@@ -667,13 +850,16 @@ def do_trace_v2(trace, curve_params,
                                      ids_add, verbose=True)
 
     # plot a view of gaps of the column max vs. the template
-    if plot:
-        _plt_gaps(peaks_array[column_max], peaks_template, ids_add, 
-                 shoe, ifu_type)
+    if plot and not (headless and fig_dir is None):
+        save_path = _get_fig_path(fig_dir, shoe, ifu_type, 'gaps') \
+            if headless else None
+        run_in_main(_plt_gaps, peaks_array[column_max], peaks_template, ids_add, 
+                    shoe, ifu_type, save_path=save_path)
 
     # fit the aperture traces
-    traces_array, traces_coefs \
-        = _fit_aperture_traces(peaks_array, col_centers, curve_params)
+    traces_array, traces_coefs, traces_rms \
+        = _fit_aperture_traces(peaks_array, col_centers, curve_params,
+                               verbose=verbose)
     n_aper = len(traces_array[0])
 
     return traces_array, traces_coefs, n_aper, aper_half_width
@@ -722,14 +908,18 @@ def _plot_spec_window(spec, rel_height, col_num, flag_success,
     plt.show()
 
 
-def _plot_first_peaks(peaks1, mask_good, col_num):
+def _plot_first_peaks(peaks1, mask_good, col_num, excluded_columns=None,
+                      save_path=None):
     """
     plot the first peaks
+        excluded_columns: columns already excluded, e.g., automatically
+        save_path: save the figure there instead of picking interactively
     """
-    excluded_columns = []   # stores indices of selected (right-clicked) points
+    # stores indices of selected (right-clicked) points
+    excluded_columns = [] if excluded_columns is None else list(excluded_columns)
     selecting_mode = [False]  # toggled with 's' / 'Esc'
 
-    fig = plt.figure(figsize=(12,6))
+    fig = _new_figure((12,6), headless=save_path is not None)
     fig.clf()
     ax = fig.add_subplot(111)
     ax.set_title("Press 'Shift+S' to enter selecting mode, 'Esc' to quit selecting mode")
@@ -797,26 +987,33 @@ def _plot_first_peaks(peaks1, mask_good, col_num):
         print(f"excluded_columns = {excluded_columns}")
         _refresh_highlight()
 
-    cid_key   = fig.canvas.mpl_connect("key_press_event", on_key)
-    cid_click = fig.canvas.mpl_connect("button_press_event", on_click)
+    if save_path is None:
+        cid_key   = fig.canvas.mpl_connect("key_press_event", on_key)
+        cid_click = fig.canvas.mpl_connect("button_press_event", on_click)
+    else:
+        ax.set_title("Automatically excluded columns")
+        _refresh_highlight()
 
     ax.legend(loc="upper right")
-    plt.tight_layout()
-    plt.show()
+    _show_or_save(fig, save_path)
 
     return excluded_columns
 
 
-def _plot_peaks_array(peaks_array, mask_good, col_num):
+def _plot_peaks_array(peaks_array, mask_good, col_num, excluded_columns=None,
+                      save_path=None):
     """ 
     plot peaks_array for all columns
+        excluded_columns: columns already excluded, e.g., automatically
+        save_path: save the figure there instead of picking interactively
     """
 
-    excluded_columns = []   # stores indices of selected (right-clicked) points
+    # stores indices of selected (right-clicked) points
+    excluded_columns = [] if excluded_columns is None else list(excluded_columns)
     selecting_mode = [False]  # toggled with 's' / 'Esc'
     vlines = {} # to store vertical line artists for easy updating
 
-    fig = plt.figure(6, figsize=(10,10))
+    fig = _new_figure((10,10), num=6, headless=save_path is not None)
     fig.clf()
     ax = fig.add_subplot(111)
     ax.set_title("Press 'Shift+S' to enter selecting mode, 'Esc' to quit selecting mode")
@@ -830,6 +1027,9 @@ def _plot_peaks_array(peaks_array, mask_good, col_num):
             
     ax.axvline(x=col_num, color='gray', linestyle='--', label='Middle Column')
 
+    for col in excluded_columns:
+        vlines[col] = ax.axvline(x=col, color="red", linewidth=1.2, alpha=0.7)
+
     # Status text in the top-left corner
     status_text = ax.text(0.01, 0.97, "Mode: NORMAL",
                           transform=ax.transAxes, va="top",
@@ -877,16 +1077,84 @@ def _plot_peaks_array(peaks_array, mask_good, col_num):
         print(f"excluded_columns = {excluded_columns}")
         fig.canvas.draw_idle()
 
-    cid_key   = fig.canvas.mpl_connect("key_press_event", on_key)
-    cid_click = fig.canvas.mpl_connect("button_press_event", on_click)
+    if save_path is None:
+        cid_key   = fig.canvas.mpl_connect("key_press_event", on_key)
+        cid_click = fig.canvas.mpl_connect("button_press_event", on_click)
+    else:
+        ax.set_title("Automatically excluded columns")
 
     ax.legend(loc="upper right")
-    plt.tight_layout()
-    plt.show()
+    _show_or_save(fig, save_path)
 
     return excluded_columns
 
 
+def _get_fig_path(fig_dir, shoe, ifu_type, name):
+    """Get the path of a diagnostic figure, or None without fig_dir. """
+    if fig_dir is None:
+        return None
+    if not os.path.exists(fig_dir):
+        os.makedirs(fig_dir)
+    return os.path.join(fig_dir, '%s_%s_%s.png'%(shoe, ifu_type, name))
+
+
+def _get_mad_outliers(values, n_sigma=5.0, min_scale=0.1):
+    """
+    Get a mask of outliers by the median absolute deviation (MAD)
+        min_scale: lower limit of the scale, for nearly constant values
+    """
+    med = np.median(values)
+    scale = 1.4826 * np.median(np.abs(values - med))
+    return np.abs(values - med) > n_sigma * np.max([scale, min_scale])
+
+
+def _reject_first_peaks(peaks1, mask_good, window=5, n_sigma=5.0,
+                        min_scale=0.1):
+    """
+    Reject jumps of the first peaks automatically (for the headless mode)
+    Residuals from a running median of the good first peaks are clipped by
+    the MAD. Returns the list of rejected columns.
+    """
+    cols = np.where(mask_good & np.isfinite(peaks1))[0]
+    if len(cols) < window:
+        return []
+
+    peaks_smooth = ndimage.median_filter(peaks1[cols], size=window, mode='nearest')
+    mask_out = _get_mad_outliers(peaks1[cols] - peaks_smooth, n_sigma, min_scale)
+
+    return cols[mask_out].tolist()
+
+
+def _reject_columns_by_residuals(peaks_array, mask_good, order=4, n_sigma=5.0,
+                                 min_scale=0.1, n_iter=3):
+    """
+    Reject columns of peaks_array automatically (for the headless mode)
+    Each fiber is fitted by a polynomial along the good columns. A column is
+    rejected if its median absolute residual is an outlier by the MAD.
+    Returns the list of rejected columns.
+    """
+    cols = np.where(mask_good)[0]
+    mask_out = np.zeros(len(cols), dtype=bool)
+    for i in range(n_iter):
+        if np.sum(~mask_out) <= order+1:
+            break
+
+        # fit all fibers at once, since they share the same columns
+        coefs = poly.polyfit(cols[~mask_out], peaks_array[cols[~mask_out]], order)
+        residuals = peaks_array[cols] - poly.polyval(cols, coefs).T
+        res_col = np.median(np.abs(residuals), axis=1)
+
+        # clip against the statistics of the columns kept so far
+        med = np.median(res_col[~mask_out])
+        scale = 1.4826 * np.median(np.abs(res_col[~mask_out] - med))
+        mask_new = res_col > med + n_sigma * np.max([scale, min_scale])
+        if np.array_equal(mask_new, mask_out):
+            break
+        mask_out = mask_new
+
+    return cols[mask_out].tolist()
+
+
 def _get_one_fiber_window(center, width, ratio):
     """
     Calculate the window for one fiber
@@ -961,6 +1229,7 @@ def _find_one_peak(spec, spec_max, peak_init, col_num, rel_height=0.25,
         return None
 
 
+@timed()
 def _find_all_first_peaks(columnspec_array, med_dif_pos_model, 
                           rel_thresh=0.3, rel_width_max=1.5, rel_height=0.25):
     # Find all first peaks in columnspec_array
@@ -995,6 +1264,7 @@ def _find_all_first_peaks(columnspec_array, med_dif_pos_model,
             peaks1.append(peak1)
         else:
             print("Fail to find peak automatically, roll back to initial value:", col)
+            count('first_peaks_failed')
             peaks1.append(np.nan)
 
             # if col>0:
@@ -1003,6 +1273,127 @@ def _find_all_first_peaks(columnspec_array, med_dif_pos_model,
     return np.array(peaks1)
 
 
+def _make_fiber_comb(n_pix, positions, weights, sigma):
+    """Make a synthetic comb of Gaussian fibers on pixels 0..n_pix-1. """
+    y = np.arange(n_pix)[:, None]
+    return np.sum(weights * np.exp(-0.5*((y - positions)/sigma)**2), axis=1)
+
+
+def _get_parabolic_peak(values, idx):
+    """Refine the argmax idx of each row of values by a parabola. """
+    rows = np.arange(len(values))
+    n = values.shape[1]
+    v0 = values[rows, (idx-1) % n]
+    v1 = values[rows, idx]
+    v2 = values[rows, (idx+1) % n]
+    denom = v0 - 2*v1 + v2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.where(denom < 0, 0.5*(v0-v2)/denom, 0.)
+    return idx + np.clip(delta, -0.5, 0.5)
+
+
+def _measure_comb_scale(specs, comb, pitch, scale_range=(0.9, 1.1), n_log=4096):
+    """
+    Measure the scale of the fiber comb in each column by the cross-
+    correlation of the amplitude spectra on a log-resampled frequency axis,
+    where a scale becomes a shift (independent of any shift in pixels)
+    """
+    n_fft = 2*specs.shape[1]
+    freqs = np.fft.rfftfreq(n_fft)
+    amp_specs = np.abs(np.fft.rfft(specs, n_fft, axis=1))
+    amp_comb = np.abs(np.fft.rfft(comb, n_fft))
+
+    # resample to a log frequency axis around the first harmonics of the pitch
+    log_f = np.linspace(np.log(0.5/pitch), np.log(np.min([2.5/pitch, 0.5])), n_log)
+    idx = np.clip(np.searchsorted(freqs, np.exp(log_f)), 1, len(freqs)-1)
+    w = (np.exp(log_f) - freqs[idx-1]) / (freqs[idx] - freqs[idx-1])
+    amp_specs_log = amp_specs[:, idx-1]*(1-w) + amp_specs[:, idx]*w
+    amp_comb_log = amp_comb[idx-1]*(1-w) + amp_comb[idx]*w
+    amp_specs_log -= np.mean(amp_specs_log, axis=1, keepdims=True)
+    amp_comb_log -= np.mean(amp_comb_log)
+
+    cc = np.fft.irfft(np.fft.rfft(amp_specs_log, 2*n_log, axis=1) 
+                      * np.conj(np.fft.rfft(amp_comb_log, 2*n_log)), 2*n_log, axis=1)
+
+    # a scale a moves the amplitude spectrum from f to f/a
+    d_log = log_f[1] - log_f[0]
+    lags = np.fft.fftfreq(2*n_log, 1./(2*n_log))
+    mask_lag = (lags >= -np.log(scale_range[1])/d_log) & (lags <= -np.log(scale_range[0])/d_log)
+    idx_max = np.argmax(np.where(mask_lag, cc, -np.inf), axis=1)
+    lag = _get_parabolic_peak(cc, idx_max)
+    lag = np.where(lag >= n_log, lag - 2*n_log, lag)
+
+    return np.exp(-lag*d_log)
+
+
+@timed()
+def _register_fiber_model(columnspec_array, pos_model, good_model, 
+                          fit_scale=False, scale_range=(0.9, 1.1), verbose=False):
+    """
+    Register the fiber position model to all columns at once
+    A synthetic comb of the good fibers is cross-correlated with every
+    column spectrum by FFT to find the shift of each column. With fit_scale, 
+    a common scale is measured first (see _measure_comb_scale).
+    Returns the initial positions of every fiber in every column (n_col, 
+    n_fiber) and the scale.
+    """
+    specs = np.array([np.asarray(columnspec_array[col].spec, dtype=float) 
+                      for col in range(len(columnspec_array))])
+    pixel0 = np.array([columnspec_array[col].pixel.value[0] 
+                       for col in range(len(columnspec_array))])
+    n_col, n_pix = specs.shape
+    specs = specs - np.median(specs, axis=1, keepdims=True)
+    specs[specs < 0] = 0.
+
+    pitch = np.median(np.diff(pos_model))
+    weights = np.where(good_model > 0, 1., 0.)
+    positions = pos_model - pos_model[0]
+
+    scale = 1.
+    if fit_scale:
+        comb = _make_fiber_comb(n_pix, positions + 0.5*(n_pix - positions[-1]),
+                                weights, pitch/4.)
+        scales = _measure_comb_scale(specs, comb, pitch, scale_range)
+        scale = np.median(scales)
+        if verbose:
+            print("++++ scale of the fiber model (median, std): %.4f, %.4f"
+                  %(scale, np.std(scales)))
+
+    # cross-correlate with the comb starting at pixel 0
+    comb = _make_fiber_comb(n_pix, scale*positions, weights, scale*pitch/4.)
+    n_fft = 2*n_pix
+    cc = np.fft.irfft(np.fft.rfft(specs, n_fft, axis=1) 
+                      * np.conj(np.fft.rfft(comb, n_fft)), n_fft, axis=1)
+    shifts = _get_parabolic_peak(cc, np.argmax(cc, axis=1))
+    shifts = np.where(shifts >= n_pix, shifts - n_fft, shifts)
+
+    peaks_init = pixel0[:, None] + shifts[:, None] + scale*positions[None, :]
+
+    return peaks_init, scale
+
+
+@timed()
+def _find_all_peaks_in_one_column_seeded(columnspec_array, col_num, peaks_init,
+                                         med_dif_pos_model, rel_width_max):
+    """
+    Find all peaks in one column from initial positions of every fiber
+    Missing peaks keep the initial positions and are flagged in mask_bad.
+    """
+    pixel = columnspec_array[col_num].pixel.value
+    spec = columnspec_array[col_num].spec
+
+    peaks_find = _find_peaks_in_windows(spec, np.max(spec), pixel, peaks_init,
+                                        med_dif_pos_model, rel_width_max)
+    mask_bad = np.isnan(peaks_find)
+    peaks = np.where(mask_bad, peaks_init, peaks_find)
+    print("Missing Peaks:", np.sum(mask_bad))
+    print("Missing Fiber IDs:", np.where(mask_bad)[0]+1)
+    print(f"Find {np.sum(~mask_bad)} out of {len(peaks)}")
+
+    return peaks, mask_bad
+
+
+@timed()
 def _find_all_peaks_in_one_column(columnspec_array, col_num, peak1, 
                                   pos_model, dif_pos_model, med_dif_pos_model,
                                   rel_width_max):
@@ -1047,60 +1438,162 @@ def _find_all_peaks_in_one_column(columnspec_array, col_num, peak1,
     return peaks, mask_bad
 
 
-def _find_peaks_in_next_column(peaks_prev, columnspec_array, col_num, mask_bad,
-                               peak1_offset, dif_pos_peaks,
-                               med_dif_pos_model, rel_width_max):
-    # use the peaks of template column to get peaks to the next column
-    # dif_pos_peaks = np.append(0, np.diff(peaks_prev))
+def _find_peaks_in_windows(spec, spec_max, pixel, peaks_init, width, ratio,
+                           rel_height=0.25):
+    """
+    Find one peak in each of many fiber windows at once
+        spec: the column spectrum
+        spec_max: the maximum of the column spectrum
+        pixel: the pixel positions of the column spectrum
+        peaks_init: the initial guesses of the peak positions
+        width, ratio: same as in _get_one_fiber_window
+    This is an array version of calling _find_one_peak on every window.
+    Windows where no peak is found are returned as NaN.
+    """
+    n_spec = len(spec)
+    peaks_init = np.asarray(peaks_init, dtype=float)
+    peaks = np.full(len(peaks_init), np.nan)
+    if len(peaks_init) == 0:
+        return peaks
+
+    # same windows as _get_one_fiber_window, padded to a common length
+    lower = (peaks_init - 0.5 * width * ratio).astype(int)
+    upper = (peaks_init + 0.5 * width * ratio).astype(int)
+    n_win = np.minimum(upper, n_spec) - lower
+    n_max = max(int(np.max(n_win)), 1)
+    offs = np.arange(n_max)
+    mask_win = offs[None, :] < n_win[:, None]
+    idx_spec = np.clip(lower[:, None] + offs[None, :], 0, n_spec-1)
+    spec_win = np.where(mask_win, spec[idx_spec], -np.inf)
+    win_max = np.max(spec_win, axis=1)
+
+    # skip windows that are out of range or too low
+    mask_ok = (lower >= 0) & (n_win > 0) & (win_max >= spec_max * rel_height)
+    spec_norm = spec_win / np.where(mask_ok, win_max, 1.)[:, None]
+    rows = np.arange(len(peaks_init))
+
+    idx_peak0 = (peaks_init - lower).astype(int)
+    mask_ok &= (idx_peak0 >= 0) & (idx_peak0 < n_win)
+    idx_peak0 = np.clip(idx_peak0, 0, n_max-1)
+
+    # the minima on both sides of the initial peak
+    spec_norm_inf = np.where(mask_win, spec_norm, np.inf)
+    mask_left = offs[None, :] <= idx_peak0[:, None]
+    mask_right = offs[None, :] >= idx_peak0[:, None]
+    idx_min_left = np.argmin(np.where(mask_left, spec_norm_inf, np.inf), axis=1)
+    idx_min_right = np.argmin(np.where(mask_right, spec_norm_inf, np.inf), axis=1)
+
+    # raise the relative height above both minima
+    spec_norm_min = np.maximum(spec_norm[rows, idx_min_left],
+                               spec_norm[rows, idx_min_right])
+    rel_heights = np.full(len(peaks_init), float(rel_height))
+    mask_raise = spec_norm_min > rel_heights
+    while np.any(mask_raise):
+        rel_heights[mask_raise] += 0.05
+        mask_raise &= (rel_heights <= 0.95) & (spec_norm_min > rel_heights)
+
+    # get the left and right positions when spec_norm crosses rel_height
+    mask_cross = mask_left & (offs[None, :] >= idx_min_left[:, None]) \
+        & (spec_norm >= rel_heights[:, None])
+    idx_left = np.argmax(mask_cross, axis=1)
+    mask_ok &= np.any(mask_cross, axis=1)
+
+    mask_cross = mask_right & (offs[None, :] <= idx_min_right[:, None]) \
+        & (spec_norm <= rel_heights[:, None])
+    idx_right = np.argmax(mask_cross, axis=1)
+    mask_ok &= np.any(mask_cross, axis=1)
+    mask_ok &= (idx_left > 0) & (idx_right > 0)
+
+    # interpolate the crossing positions (padded windows are masked out)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y1, y2 = spec_norm[rows, idx_left-1], spec_norm[rows, idx_left]
+        mask_ok &= y1 < y2
+        frac = np.clip((rel_heights - y1) / (y2 - y1), 0., 1.)
+        x_left = idx_left - 1 + frac
+
+        y1, y2 = spec_norm[rows, idx_right-1], spec_norm[rows, idx_right]
+        mask_ok &= y1 > y2
+        frac = np.clip((y1 - rel_heights) / (y1 - y2), 0., 1.)
+        x_right = idx_right - 1 + frac
+
+    x_center = 0.5 * (x_left + x_right)
+    peaks[mask_ok] = pixel[lower[mask_ok]] + x_center[mask_ok]
 
-    # find peaks one-by-one
+    return peaks
+
+
+def _find_peaks_in_next_column(peaks_prev, columnspec_array, col_num, mask_bad,
+                               peak1_offset, med_dif_pos_model, rel_width_max):
+    # use the peaks of the previous column, shifted by the offset of the first
+    # peaks, as the initial guesses and search all fibers at once
     pixel_next = columnspec_array[col_num].pixel.value
     spec_next = columnspec_array[col_num].spec
     spec_next_max = np.max(spec_next)
 
-    peaks_next_init = np.zeros_like(peaks_prev, dtype=float)
-    peaks_next = np.zeros_like(peaks_prev, dtype=float)
+    peaks_next_init = np.abs(peaks_prev) + peak1_offset
+    peaks_find = _find_peaks_in_windows(
+        spec_next, spec_next_max, pixel_next, peaks_next_init,
+        med_dif_pos_model, rel_width_max, rel_height=0.25)
 
-    count_missing = 0
-    fid_missing = []
-    for i in range(0, len(peaks_prev)):
-        if i == 0:
-            peak_next_init = np.abs(peaks_prev[0]) + peak1_offset
-        else:
-            peak_next_init = np.abs(peaks_next[i-1]) + dif_pos_peaks[i]
-        # peak_next_init = np.abs(peaks_prev[i]) + peak1_offset
-        peaks_next_init[i] = peak_next_init
-        peaks_next[i] = peak_next_init
+    # bad fibers are not searched, and missing peaks keep the initial guesses
+    mask_found = ~np.isnan(peaks_find) & ~mask_bad
+    peaks_next = np.where(mask_found, peaks_find, peaks_next_init)
 
-        if mask_bad[i]:
-            continue
-
-        lower, upper = _get_one_fiber_window(
-            peak_next_init, med_dif_pos_model, rel_width_max)
-        peak_find = _find_one_peak(
-            spec_next[lower:upper], spec_next_max, peak_next_init-lower, col_num, 
-            rel_height=0.25, plot=False)
-
-        if peak_find is not None:
-            peaks_next[i] = pixel_next[lower] + peak_find
-        else:
-            count_missing += 1
-            fid_missing.append(i+1)
-
-    fid_missing = np.array(fid_missing)
+    fid_missing = np.where(~mask_found & ~mask_bad)[0] + 1
+    count_missing = len(fid_missing)
+    count('peaks_found', np.sum(mask_found))
+    count('peaks_missing', count_missing)
     print("Working on column:", col_num)
     print("    Extra Missing Peaks:", count_missing)
     print("    Extra Missing Fiber IDs:", fid_missing)
     print(f"    Find {np.sum(peaks_next > 0)} out of {len(peaks_next)}")
 
-    #_plot_spec(pixel_next, spec_next, peaks_next_init, peaks_next, col_num-1)
-
     return peaks_next
 
+
+def _propagate_peaks(peaks_mid, columnspec_array, col_num, cols, mask_good,
+                     mask_bad, peaks1, med_dif_pos_model, rel_width_max):
+    """
+    Propagate the peaks of the middle column to the columns in cols
+        cols: columns ordered outward from col_num, i.e., one direction
+    Each good column starts from the nearest good column toward col_num.
+    Returns a dict of {column: peaks}.
+    """
+    peaks_side = {}
+    col_prev, peaks_prev = col_num, peaks_mid
+    for i, col in enumerate(cols):
+        progress('propagating peaks', i, len(cols))
+        if not mask_good[col]:
+            continue
+
+        peaks_temp = _find_peaks_in_next_column(
+            peaks_prev, columnspec_array, col, mask_bad,
+            peak1_offset=peaks1[col]-peaks1[col_prev],
+            med_dif_pos_model=med_dif_pos_model,
+            rel_width_max=rel_width_max)
+        peaks_side[col] = peaks_temp
+        col_prev, peaks_prev = col, peaks_temp
+
+    return peaks_side
+
+
+@timed()
 def do_trace_v3(trace, curve_params, 
                 shoe, ifu_type, bin_y,
-                trace_params=None, verbose=False, plot=True):
-    """Do trace. """
+                trace_params=None, verbose=False, plot=True,
+                headless=False, fig_dir=None, trace_model='aperture',
+                seed='first_peak', fit_scale=False):
+    """
+    Do trace.
+        headless: replace the manual column exclusion by automatic outlier
+            rejection, and save the diagnostic figures to fig_dir (if given)
+        trace_model: 'aperture' or 'surface', see _fit_aperture_traces
+        seed: 'first_peak' finds the first fiber in each column; 'fft'
+            registers the fiber model to all columns (_register_fiber_model)
+        fit_scale: also fit the scale of the fiber model with seed='fft'
+    Returns traces_array, traces_coefs, n_aper, aper_half_width, and a dict of
+    the columns excluded after checking the first peaks and the peaks array.
+    """
 
     # fine-tune parameters for finding peaks
     rel_thresh=0.3
@@ -1116,8 +1609,10 @@ def do_trace_v3(trace, curve_params,
     # get the median offset
     if shoe == 'b':
         pos_model = fiber_model[:, 2] / bin_y
+        good_model = fiber_model[:, 1]
     else:
         pos_model = fiber_model[:, 5] / bin_y
+        good_model = fiber_model[:, 4]
 
     dif_pos_model = np.append(0, np.diff(pos_model))
     med_dif_pos_model = np.median(dif_pos_model)
@@ -1156,7 +1651,13 @@ def do_trace_v3(trace, curve_params,
     print("++++ prominence_cut: ", prominence_cut)
 
     # Step 2: find all first peaks in the columnspec_array
-    peaks1 = _find_all_first_peaks(columnspec_array, med_dif_pos_model)
+    if seed == 'fft':
+        peaks_seed, scale = _register_fiber_model(
+            columnspec_array, pos_model, good_model, fit_scale=fit_scale,
+            verbose=verbose)
+        peaks1 = peaks_seed[:, 0]
+    else:
+        peaks1 = _find_all_first_peaks(columnspec_array, med_dif_pos_model)
 
     ## mask out bad first peaks based on the difference between the peaks
     d1_peaks1 = np.append(0, np.diff(peaks1))
@@ -1167,9 +1668,17 @@ def do_trace_v3(trace, curve_params,
     # mask_good[:16] = False # first 16 fibers always bad
     print("---- Automatic selection of first peaks:", np.sum(mask_good), "out of", len(peaks1))
 
-    excluded_columns = _plot_first_peaks(peaks1, mask_good, col_num)
-    mask_good[excluded_columns] = False
-    print("---- Manually excluded columns:", excluded_columns)
+    if headless:
+        excluded_first = _reject_first_peaks(peaks1, mask_good)
+        if fig_dir is not None:
+            _plot_first_peaks(peaks1, mask_good, col_num, excluded_first,
+                save_path=_get_fig_path(fig_dir, shoe, ifu_type, 'first_peaks'))
+        print("---- Automatically excluded columns:", excluded_first)
+    else:
+        with stage('manual_exclusion'):
+            excluded_first = run_in_main(_plot_first_peaks, peaks1, mask_good, col_num)
+        print("---- Manually excluded columns:", excluded_first)
+    mask_good[excluded_first] = False
     print("---- Final selection of first peaks:", np.sum(mask_good), "out of", len(peaks1))
 
     # Step 3: find all peaks in the middle column
@@ -1177,63 +1686,205 @@ def do_trace_v3(trace, curve_params,
     peak1 = peaks1[col_num]
     print(f'---- Working on column {col_num} out of {n_col}')
 
-    peaks, mask_bad = _find_all_peaks_in_one_column(
-        columnspec_array, col_num, peak1, pos_model, dif_pos_model, 
-        med_dif_pos_model, rel_width_max)
+    if seed == 'fft':
+        peaks, mask_bad = _find_all_peaks_in_one_column_seeded(
+            columnspec_array, col_num, peaks_seed[col_num], 
+            med_dif_pos_model, rel_width_max)
+    else:
+        peaks, mask_bad = _find_all_peaks_in_one_column(
+            columnspec_array, col_num, peak1, pos_model, dif_pos_model, 
+            med_dif_pos_model, rel_width_max)
     # print("Peaks in the middle column:", peaks)
     print("---- Bad/missing fibers in the middle column:", np.where(mask_bad)[0]+1)
 
-    dif_pos_peaks_mid = np.append(0, np.diff(peaks))
-
     # Step 4: find the peaks in the next column based on the peaks in the middle column, and so on
     peaks_array = np.zeros((len(columnspec_array), len(peaks)), dtype=float)
     peaks_array[col_num] = peaks
 
-    ## find peaks for all columns to the left of col_num
-    for col in range(col_num-1, 0, -1):
-        if mask_good[col]:
-            col_prev = col + 1
-            while mask_good[col_prev] == False and col_prev < len(columnspec_array)-1:
-                col_prev += 1
-
-            if col_prev < len(columnspec_array):
-                peaks_temp = _find_peaks_in_next_column(
-                    peaks_array[col_prev], columnspec_array, col, mask_bad,
-                    peak1_offset=peaks1[col]-peaks1[col_prev], 
-                    dif_pos_peaks=dif_pos_peaks_mid,
-                    med_dif_pos_model=med_dif_pos_model, 
-                    rel_width_max=rel_width_max)
-                peaks_array[col] = peaks_temp
-            else:
-                print("No good previous column found for column:", col)
-
-    ## find peaks for all columns to the right of col_num
-    for col in range(col_num+1, len(columnspec_array)-1):
-        if mask_good[col]:
-            col_prev = col - 1
-            while mask_good[col_prev] == False and col_prev > 0:
-                col_prev -= 1
-
-            if col_prev > 0:
-                peaks_temp = _find_peaks_in_next_column(
-                    peaks_array[col_prev], columnspec_array, col, mask_bad,
-                    peak1_offset=peaks1[col]-peaks1[col_prev], 
-                    dif_pos_peaks=dif_pos_peaks_mid,
-                    med_dif_pos_model=med_dif_pos_model, 
-                    rel_width_max=rel_width_max)
-                peaks_array[col] = peaks_temp
-            else:
-                print("No good previous column found for column:", col)
-
-    excluded_columns = _plot_peaks_array(peaks_array, mask_good, col_num)
-    mask_good[excluded_columns] = False
+    ## the left and right sides share no state; each starts from the middle column
+    cols_sides = [range(col_num-1, 0, -1), range(col_num+1, len(columnspec_array)-1)]
+    with stage('propagate'):
+        peaks_sides = [_propagate_peaks(peaks, columnspec_array, col_num, cols,
+                                        mask_good=mask_good, mask_bad=mask_bad, 
+                                        peaks1=peaks1, 
+                                        med_dif_pos_model=med_dif_pos_model,
+                                        rel_width_max=rel_width_max)
+                       for cols in cols_sides]
+
+    for peaks_side in peaks_sides:
+        for col, peaks_temp in peaks_side.items():
+            peaks_array[col] = peaks_temp
+
+    if headless:
+        excluded_array = _reject_columns_by_residuals(peaks_array, mask_good)
+        if fig_dir is not None:
+            _plot_peaks_array(peaks_array, mask_good, col_num, excluded_array,
+                save_path=_get_fig_path(fig_dir, shoe, ifu_type, 'peaks_array'))
+        print("---- Automatically excluded columns after checking peaks array:", excluded_array)
+    else:
+        with stage('manual_exclusion'):
+            excluded_array = run_in_main(_plot_peaks_array, peaks_array, mask_good, col_num)
+        print("---- Manually excluded columns after checking peaks array:", excluded_array)
+    mask_good[excluded_array] = False
     peaks_array[~mask_good] = np.nan
-    print("---- Manually excluded columns after checking peaks array:", excluded_columns)
+    count('columns', len(mask_good))
+    count('columns_excluded', np.sum(~mask_good))
     print("---- Final selection of columns after checking peaks array:", np.sum(mask_good), "out of", len(peaks1))
 
     # Step 5: fit the aperture traces
-    traces_array, traces_coefs \
-        = _fit_aperture_traces(peaks_array, col_centers, curve_params)
+    traces_array, traces_coefs, traces_rms \
+        = _fit_aperture_traces(peaks_array, col_centers, curve_params,
+                               verbose=verbose, model=trace_model)
     n_aper = len(traces_array[0])
 
-    return traces_array, traces_coefs, n_aper, aper_half_width
+    excluded = {'first_peaks': excluded_first, 'peaks_array': excluded_array}
+
+    return traces_array, traces_coefs, n_aper, aper_half_width, excluded
+
+
+def _predict_peaks_from_coefs(traces_coefs, col_centers, curve_params, n_iter=5):
+    """
+    Predict the peaks of known traces in the reshaped columns, (n_col, n_aper)
+    The traces are y(x) on the original data, where x = col_center + 
+    parabola(y), so y is solved iteratively (the traces are nearly flat).
+    """
+    cols = np.asarray(col_centers, dtype=float)[:, None]
+    coefs = np.asarray(traces_coefs).T
+    peaks = poly.polyval(cols + curve_params[3], coefs, tensor=False)
+    for i in range(n_iter):
+        x_temp = func_parabola(peaks, curve_params[0], curve_params[1], curve_params[3])
+        peaks = poly.polyval(cols + x_temp, coefs, tensor=False)
+    return peaks
+
+
+def _measure_global_offset(columnspec, peaks_pred, max_shift, step=0.25):
+    """
+    Measure the global offset of predicted peaks in one column, by the shift
+    maximizing the summed column spectrum at the shifted peaks
+    """
+    pixel = columnspec.pixel.value
+    spec = np.asarray(columnspec.spec, dtype=float)
+    shifts = np.arange(-max_shift, max_shift+step, step)
+    score = np.sum(np.interp(peaks_pred[None, :] + shifts[:, None], pixel, spec,
+                             left=0., right=0.), axis=1)
+    return shifts[np.argmax(score)]
+
+
+def _fit_global_transform(peaks_find, peaks_pred, col_centers, n_iter=3, n_sigma=4.0):
+    """
+    Fit a global offset, scale and tilt to the differences between found and
+    predicted peaks: dy = d0 + scale*(y_pred - y_c) + tilt*(x - x_c)
+    Returns the params (d0, scale, tilt) and the centers (y_c, x_c).
+    """
+    cols = np.broadcast_to(np.asarray(col_centers, dtype=float)[:, None], peaks_pred.shape)
+    mask = np.isfinite(peaks_find)
+    y_c, x_c = np.median(peaks_pred[mask]), np.median(cols[mask])
+    dy = (peaks_find - peaks_pred)[mask]
+    design = np.vstack([np.ones(len(dy)), peaks_pred[mask]-y_c, cols[mask]-x_c]).T
+
+    mask_fit = np.ones(len(dy), dtype=bool)
+    for i in range(n_iter):
+        params = np.linalg.lstsq(design[mask_fit], dy[mask_fit], rcond=None)[0]
+        residuals = dy - design @ params
+        mask_fit = ~_get_mad_outliers(residuals, n_sigma, min_scale=0.05)
+
+    return params, (y_c, x_c)
+
+
+def _find_peaks_in_columns(columnspec_array, peaks_init, width, ratio):
+    """
+    Find the peaks of all columns in windows around peaks_init (n_col, n_aper)
+    Peaks not found are NaN.
+    """
+    peaks = np.full(peaks_init.shape, np.nan)
+    for col in range(len(columnspec_array)):
+        spec = columnspec_array[col].spec
+        pixel = columnspec_array[col].pixel.value
+        peaks[col] = _find_peaks_in_windows(spec, np.max(spec), pixel, 
+                                            peaks_init[col], width, ratio)
+    return peaks
+
+
+@timed()
+def do_trace_warm(trace, curve_params, prior_coefs, 
+                  prior_aper_half_width=None, trace_params=None,
+                  max_shift=20., verbose=False, trace_model='aperture'):
+    """
+    Do trace from the trace coefs of a previous night (warm start).
+    The prior traces are moved by a global offset, scale and tilt measured
+    on this frame, and then each aperture is refined in narrow windows. 
+    Finding all first peaks and propagating through columns is skipped.
+        prior_coefs: trace coefs loaded from a previous trace_coefs file
+        max_shift: search range of the global offset (pixels)
+    Returns the same as do_trace_v3; the dict instead lists the fibers kept
+    at the prior traces since too few of their peaks were found.
+    Raises ValueError if the prior traces do not match this frame.
+    """
+
+    # Step 1: get the columnspec array from the trace data
+    if trace_params is None:
+        trace_step=20 
+        n_lines=11
+    else:
+        trace_step = trace_params['trace_step']
+        n_lines = trace_params['n_lines']
+
+    columnspec_array = get_columnspec(trace, trace_step, n_lines)
+
+    col_centers = np.array(
+        [np.median(columnspec_array[i].columns) 
+         for i in range(0, len(columnspec_array))]
+        )
+    n_col = len(columnspec_array)
+    col_num = n_col // 2
+
+    if prior_aper_half_width is None:
+        aper_half_width = _preanalyze_columnspec_array(columnspec_array, None)[0]
+    else:
+        aper_half_width = prior_aper_half_width
+    print("++++ aper_half_width: ", aper_half_width)
+
+    # Step 2: predict the peaks by the prior traces
+    peaks_pred = _predict_peaks_from_coefs(prior_coefs, col_centers, curve_params)
+    med_dif_peaks = np.median(np.diff(peaks_pred[col_num]))
+    print("++++ med_dif_peaks: ", med_dif_peaks)
+
+    # Step 3: measure the global offset on the middle column, then refine 
+    # peaks in all columns and fit a global offset, scale and tilt
+    offset = _measure_global_offset(columnspec_array[col_num], peaks_pred[col_num],
+                                    max_shift)
+    print("++++ coarse offset: ", offset)
+
+    peaks_find = _find_peaks_in_columns(columnspec_array, peaks_pred+offset,
+                                        med_dif_peaks, ratio=1.0)
+    frac_found = np.mean(np.isfinite(peaks_find))
+    print("++++ fraction of peaks found: %.3f"%frac_found)
+    if frac_found < 0.5:
+        raise ValueError("The prior traces do not match this frame.")
+
+    params, (y_c, x_c) = _fit_global_transform(peaks_find, peaks_pred, col_centers)
+    print("++++ offset, scale, tilt: %.3f, %.3e, %.3e"%tuple(params))
+    peaks_pred = peaks_pred + params[0] + params[1]*(peaks_pred-y_c) \
+        + params[2]*(col_centers[:, None]-x_c)
+
+    # Step 4: refine each aperture in narrow windows
+    peaks_array = _find_peaks_in_columns(columnspec_array, peaks_pred,
+                                         med_dif_peaks, ratio=1.0)
+    mask_off = np.abs(peaks_array - peaks_pred) > 0.3*med_dif_peaks
+    peaks_array[mask_off] = np.nan
+
+    ## fibers with too few peaks are kept at the prior traces
+    n_found = np.sum(np.isfinite(peaks_array), axis=0)
+    fibers_prior = np.where(n_found < 0.5*n_col)[0]
+    peaks_array[:, fibers_prior] = peaks_pred[:, fibers_prior]
+    print("---- Fibers kept at the prior traces:", (fibers_prior+1).tolist())
+
+    # Step 5: fit the aperture traces
+    traces_array, traces_coefs, traces_rms \
+        = _fit_aperture_traces(peaks_array, col_centers, curve_params,
+                               verbose=verbose, model=trace_model)
+    n_aper = len(traces_array[0])
+
+    excluded = {'fibers_prior': (fibers_prior+1).tolist()}
+
+    return traces_array, traces_coefs, n_aper, aper_half_width, excluded